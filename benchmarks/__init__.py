@@ -0,0 +1,6 @@
+"""Benchmarks for the Movie Collection App.
+
+Run a benchmark from the repository root, e.g. `python -m benchmarks.load`.
+The query budgets of the routes are checked by the tests, see
+`tests/test_queries.py`.
+"""
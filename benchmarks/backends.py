@@ -0,0 +1,125 @@
+"""Concurrent write benchmark: SQLite against PostgreSQL.
+
+Every thread commits small transactions, each adding one movie and
+updating its collection, the way `newMovie` does. The benchmark reports
+commits per second, the 95th percentile latency of a commit and the
+number of failed commits (e.g. "database is locked" on SQLite) for a
+growing number of threads.
+
+SQLite runs on a temporary file. PostgreSQL runs on the database given by
+the URL argument or BENCHMARK_POSTGRES_URL; its tables are dropped and
+created again, so do not point it at real data.
+
+Usage:
+    python -m benchmarks.backends [postgres_url] [seconds_per_run]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from moviecollection import database_setup as db_setup
+from moviecollection.database_setup import Collection, Movie, User
+
+THREADS = (1, 2, 4, 8, 16)
+COLLECTIONS = 10
+
+
+def prepare(url):
+    """Creates fresh tables with one user and some collections."""
+    db_setup.database_url = url
+    db_setup.create_database()
+    db_setup.create_all()
+    engine = db_setup.setup_engine()
+    session = sessionmaker(bind=engine)()
+    session.add(User(id=1, name='Benchmark', email='bench@example.com'))
+    session.add_all([Collection(id=c, name='Collection %d' % c, user_id=1)
+                     for c in range(1, COLLECTIONS + 1)])
+    session.commit()
+    session.close()
+    engine.dispose()
+
+
+def run(url, threads, seconds):
+    """Lets `threads` threads commit for `seconds` seconds.
+
+    :returns: (commits per second, p95 latency in ms, failed commits)
+    """
+    engine = db_setup.make_engine(url, pool_size=threads, max_overflow=0)
+    Session = sessionmaker(bind=engine)
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    deadline = time.time() + seconds
+
+    def worker(n):
+        session = Session()
+        own = []
+        i = 0
+        while time.time() < deadline:
+            collection_id = (n + i) % COLLECTIONS + 1
+            i += 1
+            start = time.time()
+            try:
+                session.add(Movie(name='Movie %d-%d' % (n, i),
+                                  director='Director', genre='Drama',
+                                  year='2000', collection_id=collection_id,
+                                  user_id=1))
+                session.query(Collection).filter_by(id=collection_id).update(
+                    {Collection.updated_at: datetime.utcnow()})
+                session.commit()
+                own.append(time.time() - start)
+            except OperationalError:
+                session.rollback()
+                with lock:
+                    failures[0] += 1
+        session.close()
+        with lock:
+            latencies.extend(own)
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+    engine.dispose()
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0
+    return len(latencies) / elapsed, p95, failures[0]
+
+
+def main(argv):
+    postgres_url = argv[1] if len(argv) > 1 else os.environ.get(
+        'BENCHMARK_POSTGRES_URL')
+    seconds = float(argv[2]) if len(argv) > 2 else 3
+
+    tmpdir = tempfile.mkdtemp()
+    backends = [('sqlite', 'sqlite:///' + os.path.join(tmpdir, 'bench.db'))]
+    if postgres_url:
+        backends.append(('postgresql', postgres_url))
+    else:
+        print('No PostgreSQL URL given, benchmarking SQLite only.')
+    try:
+        print('%-11s %7s %12s %10s %8s' % ('backend', 'threads', 'commits/s',
+                                           'p95 (ms)', 'failed'))
+        for name, url in backends:
+            for threads in THREADS:
+                prepare(url)
+                rate, p95, failed = run(url, threads, seconds)
+                print('%-11s %7d %12.0f %10.1f %8d' % (name, threads, rate,
+                                                      p95, failed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
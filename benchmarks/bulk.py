@@ -0,0 +1,87 @@
+"""Bulk import throughput benchmark.
+
+Writes a synthetic CSV file, with the vocabulary of the search benchmark,
+imports it into a temporary SQLite database
+with `bulk.import_movies()` and reports rows per second of the import,
+which queues the search index jobs, and of running those jobs afterwards.
+The target is 50000 rows per second for the import; the FTS5 index, with
+its prefix indexes, costs more per row and is filled in the background.
+
+Usage:
+    python -m benchmarks.bulk [rows]
+"""
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from moviecollection import app
+from moviecollection import bulk
+from moviecollection import database_setup as db_setup
+from moviecollection import jobs
+from moviecollection.database_setup import Collection, User
+from benchmarks.search import GENRES, WORDS
+
+TARGET = 50000  # rows per second
+
+
+def make_csv(rows):
+    rnd = random.Random(0)
+    buf = io.StringIO()
+    buf.write('name,director,genre,year,description\n')
+    for m in range(rows):
+        buf.write('%s,%s %s,%s,%d,%s\n' % (
+            ' '.join(rnd.sample(WORDS, 3)).title(),
+            rnd.choice(WORDS).title(), rnd.choice(WORDS).title(),
+            rnd.choice(GENRES), 1950 + m % 70,
+            ' '.join(rnd.sample(WORDS, 8))))
+    return buf.getvalue()
+
+
+def run(data):
+    """ Returns the movies imported, the seconds of the import and the
+    seconds of the index jobs it queued.
+    """
+    session = db_setup.Session()
+    try:
+        start = time.time()
+        result = bulk.import_movies(session, bulk.read_csv(io.StringIO(data)),
+                                    user_id=1, collection_id=1)
+        imported = time.time()
+    finally:
+        db_setup.Session.remove()
+    jobs.work(burst=True)
+    return result['imported'], imported - start, time.time() - imported
+
+
+def main(rows):
+    tmp = tempfile.mkdtemp()
+    try:
+        db_setup.database_url = 'sqlite:///' + os.path.join(tmp, 'bulk.db')
+        db_setup.create_all()
+        app.start_session()
+        session = db_setup.Session()
+        session.add(User(id=1, name='bench', email='bench@example.com'))
+        session.add(Collection(id=1, name='bench', user_id=1))
+        session.commit()
+        db_setup.Session.remove()
+        data = make_csv(rows)
+        print('%-24s %10s %10s %12s' % ('import', 'rows', 'seconds',
+                                        'rows/sec'))
+        imported, elapsed, indexing = run(data)
+        for label, seconds in (('import', elapsed),
+                               ('search index jobs', indexing),
+                               ('import and index', elapsed + indexing)):
+            print('%-24s %10d %10.2f %12.0f' % (label, imported, seconds,
+                                                 imported / seconds))
+        print('target: %d rows/sec -> %s' % (
+            TARGET, 'ok' if imported / elapsed >= TARGET else 'below target'))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,95 @@
+"""Lookup latency benchmark for the indexes on the hot lookup columns.
+
+Seeds a temporary SQLite database with a large number of movies, drops the
+secondary indexes and times the lookups used by the views. Then it adds the
+indexes back with `database_setup.migrate()` and times the same lookups
+again.
+
+Usage:
+    python -m benchmarks.indexes [movies]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from moviecollection import database_setup as db_setup
+from moviecollection.database_setup import User, Collection, Movie
+
+USERS = 1000
+COLLECTIONS = 10000
+BATCH = 50000
+
+
+def seed(engine, movies):
+    """Bulk inserts users, collections and `movies` movies."""
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(),
+                     [dict(id=u, name='User %d' % u, email='user%d@example.com' % u)
+                      for u in range(1, USERS + 1)])
+        conn.execute(Collection.__table__.insert(),
+                     [dict(id=c, name='Collection %d' % c,
+                           user_id=c % USERS + 1)
+                      for c in range(1, COLLECTIONS + 1)])
+    for start in range(0, movies, BATCH):
+        with engine.begin() as conn:
+            conn.execute(Movie.__table__.insert(),
+                         [dict(name='Movie %d' % m, director='Director',
+                               genre='Drama', year='2000',
+                               user_id=m % USERS + 1,
+                               collection_id=m % COLLECTIONS + 1)
+                          for m in range(start, min(start + BATCH, movies))])
+
+
+def drop_indexes(engine):
+    for table in db_setup.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            engine.execute('DROP INDEX IF EXISTS %s' % index.name)
+
+
+def time_lookups(engine, repeat=50):
+    """Returns the mean latency in milliseconds of each hot lookup."""
+    lookups = (
+        ('movie.collection_id',
+         'SELECT * FROM movie WHERE collection_id = ?', COLLECTIONS // 2),
+        ('user.email',
+         'SELECT * FROM user WHERE email = ?', 'user%d@example.com' % (USERS // 2)),
+        ('collection.user_id',
+         'SELECT * FROM collection WHERE user_id = ?', USERS // 2),
+    )
+    results = []
+    for name, statement, value in lookups:
+        start = time.time()
+        for _ in range(repeat):
+            engine.execute(statement, (value,)).fetchall()
+        results.append((name, (time.time() - start) * 1000.0 / repeat))
+    return results
+
+
+def main(argv):
+    movies = int(argv[1]) if len(argv) > 1 else 1000000
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_setup.database_url = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+        db_setup.create_all()
+        engine = create_engine(db_setup.database_url)
+        seed(engine, movies)
+        drop_indexes(engine)
+        before = time_lookups(engine)
+        db_setup.migrate()
+        after = time_lookups(engine)
+
+        print('%d movies' % movies)
+        print('lookup                 no index (ms)   index (ms)')
+        for (name, slow), (_, fast) in zip(before, after):
+            print('%-20s %15.3f %12.3f' % (name, slow, fast))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,91 @@
+"""Load benchmark: requests per second by number of worker threads.
+
+Seeds a temporary SQLite database, then lets a growing number of threads
+fire requests at the JSON API through the Flask test client. Every thread
+uses its own scoped session and pooled connection, so throughput should
+grow with the number of threads instead of serializing on one session.
+
+Usage:
+    python -m benchmarks.load [requests_per_run] [max_threads]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import time
+
+from moviecollection import app
+from moviecollection import database_setup as db_setup
+from moviecollection.database_setup import User, Collection, Movie
+
+
+def seed(collections=20, movies_per_collection=50):
+    """Fills the benchmark database with synthetic rows."""
+    session = app.session
+    user = User(name='Benchmark', email='bench@example.com', picture='')
+    session.add(user)
+    session.flush()
+    for c in range(collections):
+        collection = Collection(name='Collection %d' % c, user_id=user.id)
+        session.add(collection)
+        session.flush()
+        session.add_all([Movie(name='Movie %d' % m, director='Director',
+                               genre='Drama', year='2000',
+                               description='Synthetic movie',
+                               collection_id=collection.id, user_id=user.id)
+                         for m in range(movies_per_collection)])
+    session.commit()
+    session.remove()
+    return collections
+
+
+def run(threads, total_requests, collections):
+    """Runs `total_requests` requests spread over `threads` threads.
+
+    :returns: Requests per second.
+    """
+    per_thread = total_requests // threads
+
+    def worker(offset):
+        client = app.test_client()
+        for i in range(per_thread):
+            collection_id = (offset + i) % collections + 1
+            response = client.get('/collection/%d/movie/JSON' % collection_id)
+            assert response.status_code == 200, response.status
+
+    workers = [threading.Thread(target=worker, args=(n,))
+               for n in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return per_thread * threads / (time.time() - start)
+
+
+def main(argv):
+    total_requests = int(argv[1]) if len(argv) > 1 else 2000
+    max_threads = int(argv[2]) if len(argv) > 2 else 8
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_setup.database_url = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+        db_setup.create_all()
+        app.secret_key = 'benchmark'
+        app.config['DATABASE_POOL_SIZE'] = max_threads
+        app.start_session()
+        collections = seed()
+
+        print('threads  requests/sec')
+        threads = 1
+        while threads <= max_threads:
+            print('%7d  %12.1f' % (threads,
+                                   run(threads, total_requests, collections)))
+            threads *= 2
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
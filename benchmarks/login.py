@@ -0,0 +1,258 @@
+"""Login latency benchmark against a local stub of the OAuth providers.
+
+Starts a stub of the Google and Facebook endpoints on a local port, which
+answers every call after a fixed delay, and points `login.py` at it. Then
+threads log in through `/gconnect` and `/fbconnect` with the Flask test
+client, each login in a new session, in three ways:
+
+    unpooled    A new connection for every call, one call after the other
+                (how the views called the providers before).
+    pooled      The shared session of `outbound.py`, with independent calls
+                made at the same time.
+    cached      Pooled, and with the caches of verified tokens and user ids
+                of `login.py`. The stub hands out the same token each time,
+                which is the best case: Google hands out a new token for
+                each code exchange, so real logins rarely skip the tokeninfo
+                call, and mostly save the user lookup.
+
+The first two run with the caches turned off.
+
+It reports logins per second, the p50 and p95 latency of a login, and the
+connections the stub accepted. The stub speaks plain HTTP, so the saving
+of the TLS handshakes to the real providers is not included.
+
+Usage:
+    python -m benchmarks.login [delay_ms] [logins] [threads]
+"""
+import base64
+import json
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import httplib2
+import requests
+
+from moviecollection import app
+from moviecollection import database_setup as db_setup
+from moviecollection import login
+from moviecollection import outbound
+from moviecollection.cache import MemoryCache
+from moviecollection.database_setup import User
+
+GOOGLE_ID = '1234567890'
+
+
+def id_token():
+    """ Returns an unsigned ID token; oauth2client only decodes it. """
+    claims = base64.urlsafe_b64encode(json.dumps(
+        {'sub': GOOGLE_ID}).encode('utf-8')).decode('ascii').rstrip('=')
+    return 'header.%s.signature' % claims
+
+
+# Answers of the stub by path.
+ANSWERS = {
+    '/token': {'access_token': 'google-token', 'token_type': 'Bearer',
+               'expires_in': 3600, 'id_token': id_token()},
+    '/tokeninfo': {'user_id': GOOGLE_ID, 'issued_to': login.app_token},
+    '/userinfo': {'name': 'Google User', 'email': 'google@example.com',
+                  'picture': 'https://example.com/google.png'},
+    '/oauth/access_token': 'access_token=facebook-token&expires=5183999',
+    '/v2.5/me': {'name': 'Facebook User', 'id': '42',
+                 'email': 'facebook@example.com'},
+    '/v2.5/me/picture': {'data': {'url': 'https://example.com/fb.png'}},
+}
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        ThreadingMixIn.process_request(self, request, client_address)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Answers after the delay of the server, keeping connections open. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # Headers and body are sent separately; do not wait for the ACK of
+        # the headers on a kept-alive connection.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def answer(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        time.sleep(self.server.delay)
+        answer = ANSWERS.get(self.path.split('?')[0])
+        if answer is None:
+            self.send_response(404)
+            body = b''
+        else:
+            self.send_response(200)
+            if isinstance(answer, dict):
+                body = json.dumps(answer).encode('utf-8')
+                self.send_header('Content-Type', 'application/json')
+            else:
+                body = answer.encode('utf-8')
+                self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST = do_DELETE = answer
+
+    def log_message(self, *args):
+        pass
+
+
+def point_at(base_url):
+    """ Sends the calls of `login.py` to the stub. """
+    login.GOOGLE_TOKENINFO_URL = base_url + '/tokeninfo'
+    login.GOOGLE_USERINFO_URL = base_url + '/userinfo'
+    login.FACEBOOK_GRAPH_URL = base_url
+    flow_from_clientsecrets = login.flow_from_clientsecrets
+
+    def stub_flow(*args, **kwargs):
+        flow = flow_from_clientsecrets(*args, **kwargs)
+        flow.token_uri = base_url + '/token'
+        return flow
+    login.flow_from_clientsecrets = stub_flow
+
+
+@contextmanager
+def unpooled():
+    """ Makes `outbound` open a connection per call and call one by one. """
+    originals = (outbound.session, outbound.concurrently,
+                 outbound.httplib2_http)
+
+    @contextmanager
+    def new_http():
+        yield httplib2.Http(timeout=outbound.READ_TIMEOUT)
+
+    outbound.session = requests.Session
+    outbound.concurrently = lambda *calls: [call() for call in calls]
+    outbound.httplib2_http = new_http
+    try:
+        yield
+    finally:
+        (outbound.session, outbound.concurrently,
+         outbound.httplib2_http) = originals
+
+
+@contextmanager
+def uncached():
+    """ Turns the token and user id caches of `login.py` off. """
+    originals = login.verified_tokens, login.user_ids
+    login.verified_tokens = MemoryCache(max_entries=0)
+    login.user_ids = MemoryCache(max_entries=0)
+    try:
+        yield
+    finally:
+        login.verified_tokens, login.user_ids = originals
+
+
+def log_in(provider):
+    """ Logs in through a new session; returns the seconds it took. """
+    client = app.test_client()
+    with client.session_transaction() as login_session:
+        login_session['state'] = 'state'
+    start = time.time()
+    response = client.post('/%sconnect?state=state' % provider,
+                           data='one-time-code')
+    elapsed = time.time() - start
+    assert response.status_code == 200, response.get_data()
+    return elapsed
+
+
+def run(provider, logins, threads):
+    """ Returns (logins per second, p50 and p95 latency in ms). """
+    latencies = []
+    per_thread = logins // threads
+
+    def worker():
+        for _ in range(per_thread):
+            latencies.append(log_in(provider))
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.time()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return (len(latencies) / elapsed,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.95)] * 1000)
+
+
+def main(argv):
+    delay = (float(argv[1]) if len(argv) > 1 else 50) / 1000
+    logins = int(argv[2]) if len(argv) > 2 else 200
+    threads = int(argv[3]) if len(argv) > 3 else 8
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_setup.database_url = 'sqlite:///' + os.path.join(tmpdir,
+                                                            'login.db')
+        db_setup.create_all()
+        app.secret_key = 'login'
+        app.config['TESTING'] = True
+        app.start_session()
+        # The users of the stub log in again and again.
+        app.session.add_all([
+            User(name=user['name'], email=user['email'], picture='')
+            for user in (ANSWERS['/userinfo'], ANSWERS['/v2.5/me'])])
+        app.session.commit()
+        app.session.remove()
+
+        stub = StubServer(('127.0.0.1', 0), StubHandler)
+        stub.delay = delay
+        thread = threading.Thread(target=stub.serve_forever)
+        thread.daemon = True
+        thread.start()
+        point_at('http://127.0.0.1:%d' % stub.server_address[1])
+
+        print('%d logins by %d threads, %.0f ms per provider call' % (
+            logins, threads, delay * 1000))
+        print('%-10s %-10s %10s %9s %9s %12s' % (
+            'provider', 'calls', 'logins/s', 'p50 (ms)', 'p95 (ms)',
+            'connections'))
+        for provider in ('g', 'fb'):
+            for label in ('unpooled', 'pooled', 'cached'):
+                stub.connections = 0
+                if label == 'unpooled':
+                    with uncached(), unpooled():
+                        result = run(provider, logins, threads)
+                elif label == 'pooled':
+                    with uncached():
+                        result = run(provider, logins, threads)
+                else:
+                    result = run(provider, logins, threads)
+                print('%-10s %-10s %10.1f %9.0f %9.0f %12d' % (
+                    (provider + 'connect', label) + result +
+                    (stub.connections,)))
+        stub.shutdown()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,693 @@
+"""Route benchmark: latency, throughput and memory of every route.
+
+Seeds a synthetic database at the given scale, starts the app on a local
+port in a child process and drives every route of `views.py` and
+`api_JSON_ATOM.py` over HTTP with a number of concurrent client threads.
+The clients are logged in as user 1 through a session cookie signed with
+the benchmark's secret key, so no OAuth provider is involved, and send the
+CSRF token of that session with their forms.
+
+Each route runs on its own for --requests requests, read routes first,
+then forms that add or change rows, then deletes, whose targets are added
+to the database right before. A mixed phase then sends --mixed requests
+spread over the routes by their WEIGHT, deletes excluded. For each phase
+the benchmark reports the requests per second, the p50, p95 and p99
+latency and the failed requests (status 0 for connection errors, or 4xx
+and 5xx). The peak RSS of the server and of the client process is
+reported at the end.
+
+The results are written as JSON, by default to 'routes-<commit>.json',
+and --baseline compares them with an earlier file:
+
+    git checkout old; python -m benchmarks.routes --output old.json
+    git checkout new; python -m benchmarks.routes --baseline old.json
+
+The response cache is off by default, so that every request does its
+work; --cache memory measures the cached pages. The database is a
+temporary SQLite file unless --database-url is given. Its tables are
+dropped and created again, so do not point it at real data. Background
+jobs, e.g. for deleted collections, are queued but not run.
+
+Usage:
+    python -m benchmarks.routes [--users 20] [--collections 200]
+        [--movies 20000] [--requests 200] [--mixed 2000] [--concurrency 8]
+        [--seed 0] [--cache none] [--database-url URL] [--metrics]
+        [--output FILE] [--baseline FILE]
+"""
+import argparse
+import json
+import logging
+import math
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    from http.client import HTTPConnection, HTTPException
+    from urllib.parse import quote, urlencode
+except ImportError:  # Python 2
+    from httplib import HTTPConnection, HTTPException
+    from urllib import quote, urlencode
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+from sqlalchemy.orm import sessionmaker
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from moviecollection import app
+from moviecollection import database_setup as db_setup
+from moviecollection import search
+from moviecollection import thumbnails
+from moviecollection.database_setup import Collection, Movie, User
+from benchmarks.search import GENRES, WORDS
+
+SECRET_KEY = 'routes-benchmark'
+CSRF_TOKEN = 'routes-benchmark-csrf-token'
+
+# Rows per INSERT statement while seeding.
+BATCH = 10000
+
+# Requests per route sent before measuring, e.g. to load the templates.
+WARMUP = 3
+
+# Rows in the CSV of a bulk import and changes in a batch request.
+BULK_ROWS = 20
+BATCH_CHANGES = 10
+
+# Size of the synthetic cover image and its thumbnail in bytes.
+COVER_SIZE = 50000
+
+# Share of the mixed phase by route. Routes missing here are not mixed.
+WEIGHT = {
+    'GET /': 20,
+    'GET /collection/<id>/movie/': 20,
+    'GET /search': 6,
+    'GET /cover/<file>': 4,
+    'GET /cover/<size>/<file>': 10,
+    'GET /collection/JSON': 4,
+    'GET /collection/<id>/movie/JSON': 6,
+    'GET /collection/<id>/movie/<id>/JSON': 4,
+    'GET /search/JSON': 4,
+    'GET /collection/atom': 2,
+    'GET /collection/<id>/movie/atom': 2,
+    'GET /collection/<id>/movie/<id>/atom': 1,
+    'GET /collection/<id>/<id>/edit': 2,
+    'GET /collection/<id>/movie/new': 1,
+    'POST /collection/<id>/movie/new': 2,
+    'POST /collection/<id>/<id>/edit': 2,
+    'POST /collection/new': 1,
+}
+
+
+##############################################################################
+# Synthetic catalog
+##############################################################################
+class Catalog(object):
+    """ Layout of the seeded rows, to pick ids without querying.
+
+    Collection c belongs to user (c - 1) % users + 1 and movie m to
+    collection (m - 1) % collections + 1, so user 1 owns collections 1,
+    1 + users, 1 + 2 * users and so on.
+    """
+
+    def __init__(self, users, collections, movies):
+        self.users = users
+        self.collections = collections
+        self.movies = movies
+        self.own_collections = list(range(1, collections + 1, users))
+
+    def owner(self, collection_id):
+        return (collection_id - 1) % self.users + 1
+
+    def collection_of(self, movie_id):
+        return (movie_id - 1) % self.collections + 1
+
+    def collection(self, rnd):
+        """ Returns any collection. """
+        return rnd.randint(1, self.collections)
+
+    def movie(self, rnd):
+        """ Returns (collection id, movie id) of any movie. """
+        movie_id = rnd.randint(1, self.movies)
+        return self.collection_of(movie_id), movie_id
+
+    def own_collection(self, rnd):
+        """ Returns a collection of user 1. """
+        return rnd.choice(self.own_collections)
+
+    def own_movie(self, rnd):
+        """ Returns (collection id, movie id) of a movie of user 1. """
+        collection_id = self.own_collection(rnd)
+        count = (self.movies - collection_id) // self.collections + 1
+        return (collection_id,
+                collection_id + rnd.randrange(count) * self.collections)
+
+
+def movie_values(rnd, number):
+    """ Returns the text columns of a synthetic movie. """
+    return dict(name=' '.join(rnd.sample(WORDS, 3)).title(),
+                director='%s %s' % (rnd.choice(WORDS).title(),
+                                    rnd.choice(WORDS).title()),
+                genre=rnd.choice(GENRES), year=str(1950 + number % 70),
+                description=' '.join(rnd.sample(WORDS, 8)))
+
+
+def seed(catalog, rnd):
+    """ Fills the new database with the rows of the catalog. """
+    engine = db_setup.setup_engine()
+    try:
+        with engine.begin() as connection:
+            connection.execute(User.__table__.insert(), [
+                dict(id=u, name='User %d' % u,
+                     email='user%d@example.com' % u, picture='')
+                for u in range(1, catalog.users + 1)])
+            connection.execute(Collection.__table__.insert(), [
+                dict(id=c, name='Collection %d' % c,
+                     user_id=catalog.owner(c))
+                for c in range(1, catalog.collections + 1)])
+            for first in range(1, catalog.movies + 1, BATCH):
+                last = min(first + BATCH, catalog.movies + 1)
+                rows = []
+                for m in range(first, last):
+                    row = movie_values(rnd, m)
+                    collection_id = catalog.collection_of(m)
+                    row.update(id=m, collection_id=collection_id,
+                               user_id=catalog.owner(collection_id))
+                    rows.append(row)
+                connection.execute(Movie.__table__.insert(), rows)
+            session = sessionmaker(bind=connection)()
+            search.index_new_movies(session, 1, catalog.movies)
+            session.close()
+            db_setup.count_movies(connection)
+    finally:
+        engine.dispose()
+
+
+def add_spare_collections(count):
+    """ Adds empty collections of user 1 to be deleted.
+
+    Returns:
+        Their ids.
+    """
+    engine = db_setup.setup_engine()
+    session = sessionmaker(bind=engine)()
+    try:
+        collections = [Collection(name='Spare %d' % n, user_id=1)
+                       for n in range(count)]
+        session.add_all(collections)
+        session.commit()
+        return [collection.id for collection in collections]
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def add_spare_movies(count, rnd):
+    """ Adds movies to collection 1 to be deleted.
+
+    Returns:
+        (collection id, movie id) of each.
+    """
+    engine = db_setup.setup_engine()
+    session = sessionmaker(bind=engine)()
+    try:
+        movies = [Movie(collection_id=1, user_id=1, **movie_values(rnd, n))
+                  for n in range(count)]
+        session.add_all(movies)
+        session.flush()
+        for movie in movies:
+            search.index_movie(session, movie)
+        session.commit()
+        return [(1, movie.id) for movie in movies]
+    finally:
+        session.close()
+        engine.dispose()
+
+
+##############################################################################
+# Routes
+##############################################################################
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded',
+                'X-CSRFToken': CSRF_TOKEN}
+
+
+def get(path):
+    return 'GET', path, None, {}
+
+
+def post(path, fields):
+    fields = dict(fields, _csrf_token=CSRF_TOKEN)
+    return 'POST', path, urlencode(sorted(fields.items())), FORM_HEADERS
+
+
+def movie_form(rnd, image_source):
+    fields = movie_values(rnd, rnd.randrange(70))
+    fields['image_source'] = image_source
+    return fields
+
+
+def bulk_csv(rnd):
+    lines = ['name,director,genre,year,description']
+    for n in range(BULK_ROWS):
+        row = movie_values(rnd, n)
+        lines.append('%(name)s,%(director)s,%(genre)s,%(year)s,'
+                     '%(description)s' % row)
+    return '\n'.join(lines) + '\n'
+
+
+def routes(catalog):
+    """ Returns the routes as (name, build, prepare).
+
+    `build(rnd, targets)` returns a request (method, path, body, headers).
+    `prepare(count, rnd)` adds the rows a route deletes and returns them as
+    its targets, one per request; None for routes that delete nothing.
+    """
+    c = catalog
+    size = thumbnails.THUMBNAIL_SIZES[0]
+
+    def own_movie_path(rnd, action):
+        collection_id, movie_id = c.own_movie(rnd)
+        return '/collection/%d/%d/%s' % (collection_id, movie_id, action)
+
+    def batch(rnd, targets):
+        # A batch may change each movie only once.
+        movie_ids = set()
+        while len(movie_ids) < BATCH_CHANGES:
+            movie_ids.add(c.own_movie(rnd)[1])
+        changes = [{'op': 'edit', 'id': movie_id,
+                    'fields': {'year': str(rnd.randint(1950, 2019))}}
+                   for movie_id in sorted(movie_ids)]
+        return ('POST', '/movie/batch', json.dumps({'changes': changes}),
+                {'Content-Type': 'application/json',
+                 'X-CSRFToken': CSRF_TOKEN})
+
+    def bulk_import(rnd, targets):
+        return ('POST', '/collection/%d/movie/bulk' % c.own_collection(rnd),
+                bulk_csv(rnd), {'Content-Type': 'text/csv',
+                                'X-CSRFToken': CSRF_TOKEN})
+
+    return [
+        # views.py
+        ('GET /', lambda rnd, targets: get('/'), None),
+        ('GET /collection/<id>/movie/', lambda rnd, targets: get(
+            '/collection/%d/movie/' % c.collection(rnd)), None),
+        ('GET /collection/new', lambda rnd, targets: get(
+            '/collection/new'), None),
+        ('GET /collection/<id>/edit/', lambda rnd, targets: get(
+            '/collection/%d/edit/' % c.own_collection(rnd)), None),
+        ('GET /collection/<id>/delete/', lambda rnd, targets: get(
+            '/collection/%d/delete/' % c.own_collection(rnd)), None),
+        ('GET /collection/<id>/movie/new', lambda rnd, targets: get(
+            '/collection/%d/movie/new' % c.own_collection(rnd)), None),
+        ('GET /collection/<id>/<id>/edit', lambda rnd, targets: get(
+            own_movie_path(rnd, 'edit')), None),
+        ('GET /collection/<id>/<id>/delete', lambda rnd, targets: get(
+            own_movie_path(rnd, 'delete')), None),
+        ('GET /search', lambda rnd, targets: get(
+            '/search?q=%s' % quote(rnd.choice(WORDS))), None),
+        ('GET /cover/<file>', lambda rnd, targets: get(
+            '/cover/cover.jpg'), None),
+        ('GET /cover/<size>/<file>', lambda rnd, targets: get(
+            '/cover/%d/cover.jpg' % size), None),
+        # api_JSON_ATOM.py
+        ('GET /collection/JSON', lambda rnd, targets: get(
+            '/collection/JSON'), None),
+        ('GET /collection/<id>/movie/JSON', lambda rnd, targets: get(
+            '/collection/%d/movie/JSON' % c.collection(rnd)), None),
+        ('GET /collection/<id>/movie/<id>/JSON', lambda rnd, targets: get(
+            '/collection/%d/movie/%d/JSON' % c.movie(rnd)), None),
+        ('GET /export', lambda rnd, targets: get(
+            '/export?collection_id=%d' % c.collection(rnd)), None),
+        ('GET /collection/<id>/movie/bulk', lambda rnd, targets: get(
+            '/collection/%d/movie/bulk?format=csv' % c.collection(rnd)),
+         None),
+        ('GET /search/JSON', lambda rnd, targets: get(
+            '/search/JSON?q=%s' % quote(rnd.choice(WORDS)[:4])), None),
+        ('GET /cache/JSON', lambda rnd, targets: get('/cache/JSON'), None),
+        ('GET /collection/atom', lambda rnd, targets: get(
+            '/collection/atom'), None),
+        ('GET /collection/<id>/movie/atom', lambda rnd, targets: get(
+            '/collection/%d/movie/atom' % c.collection(rnd)), None),
+        ('GET /collection/<id>/movie/<id>/atom', lambda rnd, targets: get(
+            '/collection/%d/movie/%d/atom' % c.movie(rnd)), None),
+        # Forms and API calls that add or change rows.
+        ('POST /collection/new', lambda rnd, targets: post(
+            '/collection/new',
+            {'collection': 'New %s' % rnd.choice(WORDS)}), None),
+        ('POST /collection/<id>/edit/', lambda rnd, targets: post(
+            '/collection/%d/edit/' % c.own_collection(rnd),
+            {'name': 'Renamed %s' % rnd.choice(WORDS)}), None),
+        ('POST /collection/<id>/movie/new', lambda rnd, targets: post(
+            '/collection/%d/movie/new' % c.own_collection(rnd),
+            movie_form(rnd, 'none')), None),
+        ('POST /collection/<id>/<id>/edit', lambda rnd, targets: post(
+            own_movie_path(rnd, 'edit'), movie_form(rnd, 'no_change')),
+         None),
+        ('POST /collection/<id>/movie/bulk', bulk_import, None),
+        ('POST /movie/batch', batch, None),
+        # Deletes, each of a row added for it.
+        ('POST /collection/<id>/delete/', lambda rnd, targets: post(
+            '/collection/%d/delete/' % next(targets), {}),
+         lambda count, rnd: add_spare_collections(count)),
+        ('POST /collection/<id>/<id>/delete', lambda rnd, targets: post(
+            '/collection/%d/%d/delete' % next(targets), {}),
+         add_spare_movies),
+    ]
+
+
+##############################################################################
+# Server
+##############################################################################
+class KeepAliveHandler(WSGIRequestHandler):
+    """ Keeps the connection of a client open between requests. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        WSGIRequestHandler.setup(self)
+        # The headers and the body are written separately; without this
+        # the body waits for the delayed ACK of the headers.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def serve(options, upload_folder, ports):
+    """ Runs the app in the child process until it is terminated. """
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    db_setup.database_url = options.database_url
+    app.secret_key = SECRET_KEY
+    app.config['CACHE_BACKEND'] = (None if options.cache == 'none'
+                                   else options.cache)
+    app.config['UPLOAD_FOLDER'] = upload_folder
+    app.config['METRICS'] = options.metrics
+    app.start_session()
+    server = make_server('127.0.0.1', 0, app, threaded=True,
+                         request_handler=KeepAliveHandler)
+    ports.put(server.port)
+    server.serve_forever()
+
+
+def write_covers(upload_folder, rnd):
+    """ Writes a synthetic cover and its smallest thumbnail. """
+    data = bytearray(rnd.getrandbits(8) for n in range(COVER_SIZE))
+    size = thumbnails.THUMBNAIL_SIZES[0]
+    for name in ('cover.jpg', thumbnails.thumbnail_name('cover.jpg', size)):
+        with open(os.path.join(upload_folder, name), 'wb') as image:
+            image.write(data)
+
+
+def session_cookie():
+    """ Returns the Cookie header of a login session of user 1. """
+    serializer = app.session_interface.get_signing_serializer(app)
+    value = serializer.dumps({
+        'username': 'User 1', 'user_id': 1, 'email': 'user1@example.com',
+        'picture': '', 'provider': 'google', '_csrf_token': CSRF_TOKEN})
+    return '%s=%s' % (app.session_cookie_name, value)
+
+
+##############################################################################
+# Load generator
+##############################################################################
+def drive(port, cookie, requests, results):
+    """ Sends requests over one connection, appending (seconds, status). """
+    connection = HTTPConnection('127.0.0.1', port, timeout=60)
+    connection.connect()
+    connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    for method, path, body, headers in requests:
+        headers = dict(headers, Cookie=cookie)
+        start = time.time()
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+        except (socket.error, HTTPException):
+            connection.close()
+            status = 0
+        results.append((time.time() - start, status))
+    connection.close()
+
+
+def percentile(values, p):
+    """ Returns the nearest-rank percentile of sorted values. """
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def run_phase(port, cookie, requests, concurrency):
+    """ Sends the requests over `concurrency` connections.
+
+    Returns:
+        Summary of the latencies and statuses.
+    """
+    results = []
+    threads = [threading.Thread(target=drive,
+                                args=(port, cookie,
+                                      requests[n::concurrency], results))
+               for n in range(min(concurrency, len(requests)))]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = sorted(seconds * 1000 for seconds, status in results)
+    statuses = {}
+    for seconds, status in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(results),
+        'errors': sum(count for status, count in statuses.items()
+                      if status == '0' or int(status) >= 400),
+        'statuses': statuses,
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(results) / elapsed, 1),
+        'mean_ms': round(sum(latencies) / len(latencies), 2),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'max_ms': round(latencies[-1], 2),
+    }
+
+
+def peak_rss(who):
+    """ Returns the peak resident memory in kB, or None. """
+    if resource is None:
+        return None
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports kB, macOS bytes.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def git_commit():
+    """ Returns the checked out commit, with '+' if there are changes. """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                         cwd=root).decode('ascii').strip()
+        changes = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=root)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('+' if changes.strip() else '')
+
+
+##############################################################################
+# Report
+##############################################################################
+def print_phase(name, result):
+    print('%-40s %8.1f %8.2f %8.2f %8.2f %6d' % (
+        name, result['requests_per_second'], result['p50_ms'],
+        result['p95_ms'], result['p99_ms'], result['errors']))
+
+
+def change(old, new):
+    if not old:
+        return '     -'
+    return '%+5.0f%%' % ((new - old) * 100.0 / old)
+
+
+def compare(baseline, results):
+    """ Prints the change of each phase against a baseline run. """
+    print('')
+    print('Against %s (%s)' % (baseline.get('commit'),
+                               baseline.get('date')))
+    if baseline.get('parameters') != results['parameters']:
+        print('Note: the runs have different parameters.')
+    print('%-40s %8s %8s %8s %8s' % ('route', 'req/s', 'p50', 'p95',
+                                     'p99'))
+    for name, result in sorted(results['phases'].items()):
+        old = baseline.get('phases', {}).get(name)
+        if old is None:
+            continue
+        print('%-40s %8s %8s %8s %8s' % (
+            name,
+            change(old['requests_per_second'], result['requests_per_second']),
+            change(old['p50_ms'], result['p50_ms']),
+            change(old['p95_ms'], result['p95_ms']),
+            change(old['p99_ms'], result['p99_ms'])))
+    for who in ('server', 'client'):
+        old = baseline.get('peak_rss_kb', {}).get(who)
+        new = results['peak_rss_kb'][who]
+        if old and new:
+            print('peak RSS %s: %d kB -> %d kB (%s)' % (
+                who, old, new, change(old, new).strip()))
+
+
+##############################################################################
+# Main
+##############################################################################
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.routes',
+        description='Load test of every route of the app.')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--collections', type=int, default=200)
+    parser.add_argument('--movies', type=int, default=20000)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--mixed', type=int, default=2000,
+                        help='requests of the mixed phase')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='client connections')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the data and the requests')
+    parser.add_argument('--cache', choices=('none', 'memory', 'disk'),
+                        default='none', help='response cache backend')
+    parser.add_argument('--database-url',
+                        help='database to use; its tables are dropped')
+    parser.add_argument('--metrics', action='store_true',
+                        help='turn on the instrumentation of metrics.py')
+    parser.add_argument('--output', help='JSON file of the results')
+    parser.add_argument('--baseline', help='JSON file of an earlier run')
+    options = parser.parse_args(argv)
+    if not 1 <= options.users <= options.collections <= options.movies:
+        parser.error('needs 1 <= users <= collections <= movies')
+    return options
+
+
+def main(argv):
+    options = parse_arguments(argv)
+    tmpdir = tempfile.mkdtemp()
+    server = None
+    try:
+        if options.database_url is None:
+            options.database_url = 'sqlite:///' + os.path.join(
+                tmpdir, 'moviecollections.db')
+        db_setup.database_url = options.database_url
+        db_setup.create_database()
+        db_setup.create_all()
+        catalog = Catalog(options.users, options.collections, options.movies)
+        start = time.time()
+        seed(catalog, random.Random(options.seed))
+        seed_seconds = time.time() - start
+        upload_folder = os.path.join(tmpdir, 'uploads')
+        os.mkdir(upload_folder)
+        write_covers(upload_folder, random.Random(options.seed))
+        print('Seeded %d users, %d collections and %d movies in %.1f s' % (
+            options.users, options.collections, options.movies,
+            seed_seconds))
+
+        ports = multiprocessing.Queue()
+        server = multiprocessing.Process(
+            target=serve, args=(options, upload_folder, ports))
+        server.start()
+        port = ports.get(timeout=60)
+        app.secret_key = SECRET_KEY
+        cookie = session_cookie()
+
+        route_list = routes(catalog)
+        for name, build, prepare in route_list:
+            if prepare is None:
+                rnd = random.Random('warmup %s' % name)
+                run_phase(port, cookie, [build(rnd, None)
+                                         for n in range(WARMUP)], 1)
+
+        phases = {}
+        print('%-40s %8s %8s %8s %8s %6s' % ('route', 'req/s', 'p50 ms',
+                                             'p95 ms', 'p99 ms', 'errors'))
+        for name, build, prepare in route_list:
+            rnd = random.Random('%d %s' % (options.seed, name))
+            targets = None
+            if prepare is not None:
+                targets = iter(prepare(options.requests, rnd))
+            requests = [build(rnd, targets)
+                        for n in range(options.requests)]
+            phases[name] = run_phase(port, cookie, requests,
+                                     options.concurrency)
+            print_phase(name, phases[name])
+
+        rnd = random.Random('%d mixed' % options.seed)
+        builds = dict((name, build) for name, build, prepare in route_list)
+        mixed = sorted(WEIGHT)
+        weights = [WEIGHT[name] for name in mixed]
+        requests = []
+        for n in range(options.mixed):
+            # Python 2 has no random.choices().
+            pick = rnd.uniform(0, sum(weights))
+            for name, weight in zip(mixed, weights):
+                pick -= weight
+                if pick <= 0:
+                    break
+            requests.append(builds[name](rnd, None))
+        phases['mixed'] = run_phase(port, cookie, requests,
+                                    options.concurrency)
+        print_phase('mixed', phases['mixed'])
+
+        server.terminate()
+        server.join()
+        server = None
+        peak = {'server': peak_rss(getattr(resource, 'RUSAGE_CHILDREN',
+                                           None)),
+                'client': peak_rss(getattr(resource, 'RUSAGE_SELF', None))}
+        print('Peak RSS: server %s kB, client %s kB' % (peak['server'],
+                                                        peak['client']))
+
+        parameters = dict((key, value) for key, value
+                          in sorted(vars(options).items())
+                          if key not in ('output', 'baseline'))
+        parameters['database'] = options.database_url.split(':', 1)[0]
+        del parameters['database_url']
+        results = {
+            'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'parameters': parameters,
+            'seed_seconds': round(seed_seconds, 3),
+            'phases': phases,
+            'peak_rss_kb': peak,
+        }
+        output = options.output or 'routes-%s.json' % (
+            (results['commit'] or 'unknown')[:12])
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Results written to %s' % output)
+
+        if options.baseline:
+            with open(options.baseline) as f:
+                compare(json.load(f), results)
+        failed = sum(result['errors'] for result in phases.values())
+        return 1 if failed else 0
+    finally:
+        if server is not None:
+            server.terminate()
+            server.join()
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,100 @@
+"""Search latency benchmark: FTS5 index against LIKE scans.
+
+Seeds a temporary SQLite database with synthetic movies, builds the
+full-text index and compares the latency of `search.search()` with a naive
+LIKE scan over the same columns.
+
+The LIKE scan is unranked and stops after the first page of matches, so it
+is fast for words that occur in many rows. Its cost shows for selective
+words, where it reads the whole table. FTS5 reads only the matching rows,
+but ranks all of them, so broad prefixes cost more than selective words.
+
+Usage:
+    python -m benchmarks.search [movies]
+"""
+import os
+import random
+import sys
+import shutil
+import tempfile
+import time
+
+from sqlalchemy import or_
+
+from moviecollection import app
+from moviecollection import database_setup as db_setup
+from moviecollection import search
+from moviecollection.database_setup import Movie
+
+# Synthetic vocabulary of 20**3 = 8000 words, so that words are about as
+# selective as in real titles and descriptions.
+SYLLABLES = ('ka mo ri ten sul bar vek don lia pra gor nis tam el zu fen '
+             'ob chi ras mut').split()
+WORDS = [a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES]
+GENRES = ('Action', 'Adventure', 'Comedy', 'Drama', 'Horror', 'Sci-Fi')
+BATCH = 50000
+
+# Single words, two words, a genre plus a word and a prefix.
+QUERIES = ('kamori', 'tensulbar donlia', 'horror vekgor', 'pramut',
+           'zufe')
+
+
+def seed(engine, movies):
+    rnd = random.Random(0)
+    for start in range(0, movies, BATCH):
+        with engine.begin() as conn:
+            conn.execute(Movie.__table__.insert(), [
+                dict(name=' '.join(rnd.sample(WORDS, 3)).title(),
+                     director='%s %s' % (rnd.choice(WORDS).title(),
+                                         rnd.choice(WORDS).title()),
+                     genre=rnd.choice(GENRES), year=str(1950 + m % 70),
+                     description=' '.join(rnd.sample(WORDS, 8)),
+                     collection_id=1, user_id=1)
+                for m in range(start, min(start + BATCH, movies))])
+
+
+def like_search(session, terms, limit=search.DEFAULT_RESULTS):
+    """ Naive search: every word has to occur in one of the columns. """
+    query = session.query(Movie)
+    for word in terms.split():
+        pattern = '%' + word + '%'
+        query = query.filter(or_(Movie.name.like(pattern),
+                                 Movie.director.like(pattern),
+                                 Movie.genre.like(pattern),
+                                 Movie.description.like(pattern)))
+    return query.limit(limit).all()
+
+
+def timed(function, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        function()
+    return (time.time() - start) * 1000.0 / repeat
+
+
+def main(argv):
+    movies = int(argv[1]) if len(argv) > 1 else 1000000
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_setup.database_url = 'sqlite:///' + os.path.join(tmpdir, 'search.db')
+        db_setup.create_all()
+        app.start_session()
+        seed(db_setup.get_engine(), movies)
+        session = app.session
+        search.rebuild_index(session)
+        session.commit()
+
+        print('%d movies' % movies)
+        print('query              fts5 (ms)   LIKE (ms)')
+        for terms in QUERIES:
+            fts = timed(lambda: search.search(session, terms), 20)
+            like = timed(lambda: like_search(session, terms), 3)
+            print('%-16s %11.3f %11.3f' % (terms, fts, like))
+        session.remove()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
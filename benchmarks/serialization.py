@@ -0,0 +1,115 @@
+"""JSON serialization benchmark: ORM objects and jsonify against plain rows.
+
+Seeds a temporary SQLite database with movies, then builds the JSON
+document of the movie list API from all of them in three ways:
+
+    orm+jsonify   Movie objects, `serialize` and Flask's jsonify (before).
+    rows+json     Column rows and `fastjson` with the json module.
+    rows+orjson   Column rows and `fastjson` with orjson, if installed.
+
+It reports the time to load the movies, to turn them into dictionaries and
+to encode them, and the movies per second over all three steps.
+
+Usage:
+    python -m benchmarks.serialization [movies] [repeats]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from flask import jsonify
+
+from moviecollection import app
+from moviecollection import database_setup as db_setup
+from moviecollection import fastjson
+from moviecollection.database_setup import Collection, Movie, User
+
+
+def seed(movies):
+    session = app.session
+    session.add(User(id=1, name='Benchmark', email='bench@example.com'))
+    session.add(Collection(id=1, name='Collection', user_id=1))
+    session.flush()
+    session.execute(Movie.__table__.insert(), [
+        dict(name='Movie %d' % m, director='Director %d' % (m % 500),
+             genre='Drama', year=str(1950 + m % 70),
+             description='Synthetic movie number %d' % m,
+             collection_id=1, user_id=1)
+        for m in range(movies)])
+    session.commit()
+    session.remove()
+
+
+def orm_jsonify():
+    movies = app.session.query(Movie).all()
+    loaded = time.time()
+    data = [movie.serialize for movie in movies]
+    converted = time.time()
+    jsonify(Movies=data, next=None).get_data()
+    return loaded, converted
+
+
+def rows_fastjson():
+    movies = fastjson.rows(app.session, Movie).all()
+    loaded = time.time()
+    data = fastjson.movie_dicts(movies)
+    converted = time.time()
+    fastjson.response(Movies=data, next=None).get_data()
+    return loaded, converted
+
+
+def measure(method, repeats):
+    """Returns the best (load, convert, encode) times in seconds."""
+    best = None
+    for _ in range(repeats):
+        with app.test_request_context():
+            start = time.time()
+            loaded, converted = method()
+            end = time.time()
+            app.session.remove()
+        times = (loaded - start, converted - loaded, end - converted)
+        if best is None or sum(times) < sum(best):
+            best = times
+    return best
+
+
+def main(argv):
+    movies = int(argv[1]) if len(argv) > 1 else 100000
+    repeats = int(argv[2]) if len(argv) > 2 else 3
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        db_setup.database_url = 'sqlite:///' + os.path.join(tmpdir,
+                                                            'bench.db')
+        db_setup.create_all()
+        app.start_session()
+        seed(movies)
+
+        orjson = fastjson.orjson
+        methods = [('orm+jsonify', orm_jsonify, None),
+                   ('rows+json', rows_fastjson, None)]
+        if orjson is not None:
+            methods.append(('rows+orjson', rows_fastjson, orjson))
+        else:
+            print('orjson is not installed, skipping rows+orjson.')
+
+        print('%d movies, best of %d' % (movies, repeats))
+        print('%-12s %9s %11s %10s %10s %10s' % (
+            'method', 'load (ms)', 'dicts (ms)', 'json (ms)', 'total (ms)',
+            'movies/s'))
+        for name, method, encoder in methods:
+            fastjson.orjson = encoder
+            times = measure(method, repeats)
+            total = sum(times)
+            print('%-12s %9.0f %11.0f %10.0f %10.0f %10.0f' % (
+                (name,) + tuple(t * 1000 for t in times) +
+                (total * 1000, movies / total)))
+        fastjson.orjson = orjson
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
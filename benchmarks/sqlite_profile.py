@@ -0,0 +1,160 @@
+"""SQLite concurrency benchmark: default settings against the tuned profile.
+
+Reader processes load a page of movies of a collection, the query of
+`showMovies`, while writer processes commit batches of new movies. Separate
+processes keep the GIL out of the measurement, so waiting for locks shows.
+The benchmark runs once with SQLite's defaults (rollback journal, one pool)
+and once with the `sqlite_pragmas` of `database_setup.py` and the read
+pool. It reports reads per second and their p95 and worst latency, commits
+per second and failed operations ("database is locked").
+
+Usage:
+    python -m benchmarks.sqlite_profile [seconds] [readers] [writers]
+"""
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+from moviecollection import database_setup as db_setup
+from moviecollection.database_setup import Collection, Movie, User
+
+COLLECTIONS = 20
+MOVIES = 20000
+
+# Movies added per commit, like a small bulk import.
+WRITE_BATCH = 200
+
+TUNED_PRAGMAS = db_setup.sqlite_pragmas
+
+
+def connect(path, tuned):
+    """Sets up the engines of a profile in the current process."""
+    db_setup.engine = db_setup.replicas = None
+    db_setup.database_url = 'sqlite:///' + path
+    db_setup.sqlite_pragmas = TUNED_PRAGMAS if tuned else ()
+    db_setup.get_engine(read_pool=1 if tuned else 0, replica_urls=[],
+                        pool_size=1)
+
+
+def seed(path, tuned):
+    """Creates and fills the database of a profile."""
+    db_setup.database_url = 'sqlite:///' + path
+    db_setup.create_all()
+    connect(path, tuned)
+    session = db_setup.Session()
+    session.add(User(id=1, name='Benchmark', email='bench@example.com'))
+    session.add_all([Collection(id=c, name='Collection %d' % c, user_id=1)
+                     for c in range(1, COLLECTIONS + 1)])
+    session.flush()
+    session.execute(Movie.__table__.insert(), [
+        dict(name='Movie %d' % m, director='Director', genre='Drama',
+             year='2000', collection_id=m % COLLECTIONS + 1, user_id=1)
+        for m in range(MOVIES)])
+    session.commit()
+    db_setup.Session.remove()
+    db_setup.engine.dispose()
+
+
+def reader(path, tuned, deadline, n, results):
+    connect(path, tuned)
+    latencies = []
+    failures = 0
+    i = 0
+    while time.time() < deadline:
+        session = db_setup.Session()
+        session.info['read_only'] = True
+        start = time.time()
+        try:
+            session.query(Movie.id, Movie.name).filter_by(
+                collection_id=(n + i) % COLLECTIONS + 1).order_by(
+                Movie.id).limit(100).all()
+            latencies.append(time.time() - start)
+        except OperationalError:
+            failures += 1
+        db_setup.Session.remove()
+        i += 1
+    results.put(('read', latencies, failures))
+
+
+def writer(path, tuned, deadline, n, results):
+    connect(path, tuned)
+    commits = 0
+    failures = 0
+    i = 0
+    while time.time() < deadline:
+        session = db_setup.Session()
+        collection_id = (n + i) % COLLECTIONS + 1
+        try:
+            session.execute(Movie.__table__.insert(), [
+                dict(name='New %d-%d-%d' % (n, i, m), director='Director',
+                     genre='Drama', collection_id=collection_id, user_id=1)
+                for m in range(WRITE_BATCH)])
+            session.query(Collection).filter_by(id=collection_id).update(
+                {Collection.updated_at: datetime.utcnow()})
+            session.commit()
+            commits += 1
+        except OperationalError:
+            session.rollback()
+            failures += 1
+        db_setup.Session.remove()
+        i += 1
+    results.put(('write', commits, failures))
+
+
+def run(path, tuned, seconds, readers, writers):
+    """Runs reader and writer processes for `seconds` seconds."""
+    results = multiprocessing.Queue()
+    deadline = time.time() + 0.5 + seconds
+    processes = ([multiprocessing.Process(
+        target=reader, args=(path, tuned, deadline, n, results))
+        for n in range(readers)] + [multiprocessing.Process(
+            target=writer, args=(path, tuned, deadline, n, results))
+        for n in range(writers)])
+    for p in processes:
+        p.start()
+    latencies = []
+    commits = failures = 0
+    for _ in processes:
+        kind, value, failed = results.get()
+        failures += failed
+        if kind == 'read':
+            latencies.extend(value)
+        else:
+            commits += value
+    for p in processes:
+        p.join()
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    return (len(latencies) / seconds, p95, latencies[-1] * 1000,
+            commits / seconds, failures)
+
+
+def main(argv):
+    seconds = float(argv[1]) if len(argv) > 1 else 5
+    readers = int(argv[2]) if len(argv) > 2 else 4
+    writers = int(argv[3]) if len(argv) > 3 else 2
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print('%d readers, %d writers, %g s per profile'
+              % (readers, writers, seconds))
+        print('%-8s %9s %9s %10s %10s %7s' % (
+            'profile', 'reads/s', 'p95 (ms)', 'max (ms)', 'commits/s',
+            'failed'))
+        for name, tuned in (('default', False), ('tuned', True)):
+            path = os.path.join(tmpdir, name + '.db')
+            seed(path, tuned)
+            result = run(path, tuned, seconds, readers, writers)
+            print('%-8s %9.0f %9.1f %10.1f %10.0f %7d' % ((name,) + result))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -1,16 +1,15 @@
-from moviecollection import app
-import uuid
+import sys
+from moviecollection import server
 
 # Item Catalog project main app.
-# Run this file as 'python catalog_app.py' to initialize the server.
+# Run this file as 'python movie_app.py' to start the server. It runs preforked
+# worker processes, see moviecollection/server.py for the options, and needs a
+# fixed SECRET_KEY in the environment or in the settings file named by the
+# MOVIECOLLECTION_SETTINGS environment variable.
 # Before running this app, ensure that the database is setup by running 'database_setup.py'.
 
-app.start_session()
-app.secret_key = uuid.uuid4().hex  # 'secret_key'
-app.debug = True
+# 'python movie_app.py --debug' runs the development server instead. It reloads
+# itself each time it notices a code change; the debugging console allows code to
+# be executed directly on the server, so never use it in production.
 
-# If debug is enabled, the server will reload itself each time it notices a code change.
-# it is advisable to turn debug off in production.
-# The debugging console allows code to be executed directly on the server.
-
-app.run(host='0.0.0.0', port=5000)  # Tells the web-server on the vagrant machine to listen on all public IP-addresses.
+sys.exit(server.main())
@@ -0,0 +1,10 @@
+import sys
+from moviecollection import bulk
+
+# Bulk import and export of movies.
+# Run 'python movie_bulk.py import --user 1 --collection 2 movies.csv' to load
+# movies from a CSV, JSON or NDJSON file, and 'python movie_bulk.py export
+# --format csv --output movies.csv' to write them in the same format.
+# Before running this script, ensure that the database is setup by running 'database_setup.py'.
+
+sys.exit(bulk.main())
@@ -1,9 +1,36 @@
-from flask import Flask
+import time
+from flask import Flask, Request, request, session as login_session
 from moviecollection import database_setup as db_setup
 from moviecollection.database_setup import User, Collection, Movie
 
 app = Flask(__name__)
 
+
+def body_limit(config_key, default):
+    """Decorator giving a view a request body limit of its own.
+
+    The limit is the config key `config_key`, or `default` bytes; other
+    views are limited by MAX_CONTENT_LENGTH. Put it below `app.route`.
+    """
+    def decorator(f):
+        f.body_limit = (config_key, default)
+        return f
+    return decorator
+
+
+class ViewLimitedRequest(Request):
+    """Request whose body limit depends on its view, see `body_limit()`."""
+
+    @property
+    def max_content_length(self):
+        limit = getattr(app.view_functions.get(self.endpoint), 'body_limit',
+                        None)
+        if limit is None:
+            return super(ViewLimitedRequest, self).max_content_length
+        return app.config.get(*limit)
+
+app.request_class = ViewLimitedRequest
+
 ##############################################################################
 # CSRF: for preventing cross-site request forgery
 ##############################################################################
@@ -11,17 +38,73 @@ app = Flask(__name__)
 import moviecollection.views
 import moviecollection.api_JSON_ATOM
 import moviecollection.login
+import moviecollection.metrics
 
 
 def start_session():
     """Gets a session (SQLAlchemy) with the database.
 
-    Gets a new session with the testing or production database and assigns
-    it to the global `session` variable. The session is also added as an
-    attribute to 'app'. See `database_setup.py` for db_api type and db_tables.
+    Creates the process-wide engine and assigns the thread-local session
+    registry to the attribute `session` of 'app'. Every request works with
+    its own Session, which is closed in `shutdown_session()`. The config key
+    DATABASE_URL selects the database, and the pool can be tuned with the
+    config keys DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW,
+    DATABASE_POOL_RECYCLE and DATABASE_POOL_PRE_PING. GET and HEAD
+    requests read from the replicas in DATABASE_REPLICA_URLS (a list), which
+    may be DATABASE_REPLICA_LAG seconds behind, see `route_session()`.
+    Without replicas on SQLite, they use a separate pool of
+    DATABASE_READ_POOL_SIZE read-only connections (0 turns it off). See
+    `database_setup.py` for the default URL and db_tables. The config key
+    METRICS turns on the instrumentation in `metrics.py`.
 
     """
-    app.session = db_setup.get_database_session()
+    pool_options = {}
+    for key, option in (('DATABASE_POOL_SIZE', 'pool_size'),
+                        ('DATABASE_MAX_OVERFLOW', 'max_overflow'),
+                        ('DATABASE_POOL_RECYCLE', 'pool_recycle'),
+                        ('DATABASE_POOL_PRE_PING', 'pool_pre_ping')):
+        if key in app.config:
+            pool_options[option] = app.config[key]
+    app.session = db_setup.get_database_session(
+        app.config.get('DATABASE_URL'),
+        read_pool=app.config.get('DATABASE_READ_POOL_SIZE'),
+        replica_urls=app.config.get('DATABASE_REPLICA_URLS'),
+        replica_lag=app.config.get('DATABASE_REPLICA_LAG'), **pool_options)
+    moviecollection.metrics.install()
+
+
+@app.before_request
+def route_session():
+    """Marks the session of GET and HEAD requests as read-only.
+
+    Their queries then use a replica, see `RoutingSession`, unless the user
+    wrote something during the replica lag, so that the page shown after
+    the redirect of a form contains the change.
+    """
+    session = getattr(app, 'session', None)
+    if session is not None:
+        session().info['read_only'] = (
+            request.method in ('GET', 'HEAD') and
+            login_session.get('read_primary_until', 0) < time.time())
+
+
+@app.after_request
+def remember_write(response):
+    """Lets the next requests of a user who wrote read from the primary."""
+    session = getattr(app, 'session', None)
+    replicas = db_setup.replicas
+    if (replicas is not None and replicas.max_lag and session is not None
+            and session.registry.has() and session().info.get('committed')):
+        login_session['read_primary_until'] = time.time() + replicas.max_lag
+    return response
+
+
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    """Returns the connection of the request's session to the pool."""
+    session = getattr(app, 'session', None)
+    if session is not None:
+        session.remove()
 # Access start_session method using a reference to app.
 app.start_session = start_session
 
@@ -1,28 +1,297 @@
-from flask import jsonify, render_template
-from moviecollection import app
+import hashlib
+from datetime import datetime
+from functools import wraps
+from flask import Response, abort, jsonify, make_response, render_template, request, stream_with_context, url_for
+from sqlalchemy import func
+from werkzeug.http import is_resource_modified
+from moviecollection import app, body_limit
+from moviecollection import bulk
+from moviecollection import export
+from moviecollection import fastjson
+from moviecollection import search
+from moviecollection.cache import cached, collection_tags, collections_tags, response_cache
+from moviecollection.database_setup import Collection, Movie
+from moviecollection.login import login_session
+from moviecollection.metrics import LOCAL_ADDRESSES
 
 
+##############################################################################
+# Keyset pagination
+##############################################################################
+# Number of rows returned per page if the client does not ask for a limit.
+DEFAULT_PAGE_SIZE = 100
+
+# Upper bound for the `limit` query parameter.
+MAX_PAGE_SIZE = 1000
+
+# Number of rows loaded per round trip while streaming a feed page.
+FEED_BATCH_SIZE = 100
+
+
+def page_limit():
+    """ Returns the page size requested with the `limit` query parameter. """
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def paginate(query, column):
+    """ Returns one page of a query, using the keyset (seek) method.
+
+    Reads the query parameters `limit` (page size) and `after` (the cursor
+    returned with the previous page) from the request. Instead of an OFFSET,
+    the page starts with a `column > after` condition on the indexed
+    column, so deep pages cost as much as the first one.
+
+    Args:
+        query: SQLAlchemy query selecting the rows to paginate.
+        column: Unique, ordered column used as the cursor, e.g. Movie.id.
+
+    Returns:
+        rows: The rows of the requested page.
+        next_cursor: Value for `after` to fetch the next page, or None if
+            this is the last page.
+    """
+    limit = page_limit()
+    after = request.args.get('after', type=int)
+    if after is not None:
+        query = query.filter(column > after)
+    # Fetch one extra row to find out whether there is a next page.
+    rows = query.order_by(column).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = getattr(rows[-1], column.key)
+    return rows, next_cursor
+
+
+class FeedPage(object):
+    """ One page of a paged Atom feed (RFC 5005), loaded while it is rendered.
+
+    The page is selected by the query parameters `limit` and either `after`
+    (rows following that cursor) or `before` (rows preceding it). Like
+    `paginate()`, pages seek on the indexed cursor column instead of using
+    an OFFSET. The cursors of the page are read first, from the index only,
+    so the links to the neighbouring pages (`first_url`, `prev_url` and
+    `next_url`) can be rendered in the feed head, before the entries.
+
+    Iterating the page then streams its rows from the database in batches
+    of FEED_BATCH_SIZE.
+    """
+
+    def __init__(self, query, column):
+        self.query = query
+        self.column = column
+        self.limit = page_limit()
+        self.after = request.args.get('after', type=int)
+        self.before = request.args.get('before', type=int)
+        self.first_cursor = None
+        self.last_cursor = None
+        self.next_cursor = None
+        if self.before is not None:
+            self._seek_before()
+        else:
+            self._seek_after()
+
+    def _cursors(self, condition, order):
+        """Reads the cursors of at most one page and one more row."""
+        query = self.query.with_entities(self.column)
+        if condition is not None:
+            query = query.filter(condition)
+        return [row[0] for row in query.order_by(order).limit(self.limit + 1)]
+
+    def _seek_after(self):
+        condition = None
+        if self.after is not None:
+            condition = self.column > self.after
+        cursors = self._cursors(condition, self.column)
+        if len(cursors) > self.limit:
+            # The extra row shows that there is a next page.
+            cursors = cursors[:self.limit]
+            self.next_cursor = cursors[-1]
+        if cursors:
+            self.first_cursor, self.last_cursor = cursors[0], cursors[-1]
+        # Rows before the cursor make a previous page; the cursor row itself
+        # may have been deleted since.
+        self.has_prev = self.after is not None and self.query.with_entities(
+            self.column).filter(self.column <= self.after).first() is not None
+
+    def _seek_before(self):
+        cursors = self._cursors(self.column < self.before,
+                                self.column.desc())
+        self.has_prev = len(cursors) > self.limit
+        cursors = cursors[:self.limit]
+        if cursors:
+            self.first_cursor, self.last_cursor = cursors[-1], cursors[0]
+            # The page ends right in front of the `before` cursor row.
+            self.next_cursor = self.last_cursor
+
+    def __iter__(self):
+        if self.first_cursor is None:
+            return
+        rows = (self.query.filter(self.column >= self.first_cursor,
+                                  self.column <= self.last_cursor)
+                .order_by(self.column).limit(self.limit))
+        for row in rows.yield_per(FEED_BATCH_SIZE):
+            yield row
+
+    def _url(self, **cursor):
+        args = dict(request.view_args, limit=self.limit, **cursor)
+        return url_for(request.endpoint, _external=True, **args)
+
+    @property
+    def first_url(self):
+        return self._url()
+
+    @property
+    def prev_url(self):
+        if not self.has_prev or self.first_cursor is None:
+            return None
+        return self._url(before=self.first_cursor)
+
+    @property
+    def next_url(self):
+        if self.next_cursor is None:
+            return None
+        return self._url(after=self.next_cursor)
+
+
+def stream_template(template_name, **context):
+    """ Renders a template piece by piece into a streamed response body.
+
+    The request context stays alive until the template is fully rendered,
+    so lazily loaded rows can be read from the session while streaming.
+    """
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(20)
+    return stream_with_context(stream)
+
+
+##############################################################################
+# HTTP conditional requests (ETag / Last-Modified)
+##############################################################################
+def conditional(validators, last_modified=True):
+    """ Decorator that answers conditional GET requests with 304.
+
+    Before the view runs, `validators` is called with the view arguments.
+    It returns a tuple of values that change whenever the response changes
+    (row counts, highest ids, `updated_at` times), read with one aggregate
+    query. A strong ETag is derived from these values and the request path;
+    the latest datetime among them is sent as Last-Modified. If the
+    request's If-None-Match or If-Modified-Since header still matches, a
+    304 response is returned without calling the view.
+
+    Args:
+        validators: Function returning the validator tuple, or None if the
+            response should not be conditional.
+        last_modified: Send Last-Modified. Lists whose rows can be deleted
+            without a trace turn it off: deleting a row that is not the
+            latest leaves the latest time as it was, only the ETag changes.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            values = validators(**kwargs)
+            if values is None:
+                return f(*args, **kwargs)
+            key = repr((request.full_path,) + tuple(values))
+            etag = hashlib.sha1(key.encode('utf-8')).hexdigest()
+            dates = [v for v in values if isinstance(v, datetime)]
+            modified = max(dates) if dates and last_modified else None
+            if not is_resource_modified(request.environ, etag=etag,
+                                        last_modified=modified):
+                response = app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if modified is not None:
+                response.last_modified = modified
+            return response
+        return decorated_function
+    return decorator
+
+
+def collections_validators():
+    """ Validators for the list of all collections. """
+    return app.session.query(func.count(Collection.id),
+                             func.max(Collection.id),
+                             func.max(Collection.updated_at)).one()
+
+
+def collection_validators(collection_id):
+    """ Validators for the movies of a collection and the collection. """
+    collection_updated = app.session.query(Collection.updated_at).filter(
+        Collection.id == collection_id).as_scalar()
+    return app.session.query(func.count(Movie.id),
+                             func.max(Movie.id),
+                             func.max(Movie.updated_at),
+                             collection_updated).filter(
+        Movie.collection_id == collection_id).one()
+
+
+def movie_validators(collection_id, movie_id):
+    """ Validators for a single movie and its collection. """
+    return app.session.query(Movie.id, Movie.updated_at,
+                             Collection.updated_at).filter(
+        Movie.id == movie_id, Collection.id == collection_id).first()
+
+
+def export_validators():
+    """ Validators for the movies selected by the export filters. """
+    try:
+        movies = export.iter_movies(
+            app.session,
+            collection_id=request.args.get('collection_id', type=int),
+            user_id=request.args.get('user_id', type=int),
+            updated_since=export.parse_timestamp(
+                request.args['updated_since'])
+            if request.args.get('updated_since') else None)
+    except ValueError:
+        return None
+    return movies.order_by(None).with_entities(
+        func.count(Movie.id), func.max(Movie.id),
+        func.max(Movie.updated_at)).one()
+
 
 ##############################################################################
 # JSON APIs to view Collection Information
 ##############################################################################
 @app.route('/collection/JSON')
+@cached(collections_tags)
+@conditional(collections_validators, last_modified=False)
 def collectionsJSON():
-    """ Returns all collections in JSON format. """
-    collections = app.Collection().all()
-    return jsonify(Collections=[c.serialize for c in collections])
+    """ Returns one page of collections in JSON format.
+
+    Query parameters `limit` and `after` select the page, see `paginate()`.
+    """
+    collections, next_cursor = paginate(
+        fastjson.rows(app.session, Collection), Collection.id)
+    return fastjson.response(
+        Collections=[Collection.serialize_row(c) for c in collections],
+        next=next_cursor)
 
 
 @app.route('/collection/<int:collection_id>/movie/JSON')
+@cached(collection_tags)
+@conditional(collection_validators)
 def collectionJSON(collection_id):
-    """ Returns all movies of a distinct collection in JSON format.
+    """ Returns one page of movies of a distinct collection in JSON format.
+
+    Query parameters `limit` and `after` select the page, see `paginate()`.
     :param collection_id:
     """
-    movies = app.Movie().filter_by(collection_id=collection_id).all()
-    return jsonify(Movies=[a.serialize for a in movies])
+    movies, next_cursor = paginate(
+        fastjson.rows(app.session, Movie).filter(
+            Movie.collection_id == collection_id), Movie.id)
+    return fastjson.response(Movies=fastjson.movie_dicts(movies),
+                             next=next_cursor)
 
 
 @app.route('/collection/<int:collection_id>/movie/<int:movie_id>/JSON')
+@cached(collection_tags)
+@conditional(movie_validators)
 def movieJSON(collection_id, movie_id):
     """ Returns a distinct album in JSON format
     :param collection_id:
@@ -30,32 +299,219 @@ def movieJSON(collection_id, movie_id):
     Args:
         movie_id:
     """
-    collection = app.Collection().filter_by(id=collection_id).one()
-    movie = app.Movie().filter_by(id=movie_id).one()
-    return jsonify(movie=movie.serialize, collection=collection.serialize)
+    collection = fastjson.rows(app.session, Collection).filter(
+        Collection.id == collection_id).one()
+    movie = fastjson.rows(app.session, Movie).filter(
+        Movie.id == movie_id).one()
+    return fastjson.response(movie=fastjson.movie_dicts([movie])[0],
+                             collection=Collection.serialize_row(collection))
+
+
+@app.route('/export')
+@conditional(export_validators, last_modified=False)
+def exportJSON():
+    """ Streams the whole movie catalog in JSON or NDJSON format.
+
+    Query parameters:
+        format: 'json' (default), 'ndjson' or 'csv'.
+        collection_id: Only export movies of this collection.
+        user_id: Only export movies created by this user.
+        updated_since: Only export movies changed since this UTC timestamp.
+    """
+    output_format = request.args.get('format', 'json')
+    if output_format not in export.GENERATORS:
+        return jsonify(error='Unknown format: %s' % output_format), 400
+    updated_since = request.args.get('updated_since')
+    if updated_since:
+        try:
+            updated_since = export.parse_timestamp(updated_since)
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+
+    movies = export.iter_movies(
+        app.session,
+        collection_id=request.args.get('collection_id', type=int),
+        user_id=request.args.get('user_id', type=int),
+        updated_since=updated_since or None)
+    # Keep the request context (and its session) alive while streaming.
+    return Response(stream_with_context(
+        export.GENERATORS[output_format](movies)),
+        mimetype=export.MIMETYPES[output_format])
+
+
+@app.route('/collection/<int:collection_id>/movie/bulk')
+def bulkExport(collection_id):
+    """ Streams the movies of a collection in the bulk import format.
+
+    Query parameters:
+        format: 'json' (default), 'ndjson' or 'csv'.
+    """
+    output_format = request.args.get('format', 'json')
+    if output_format not in export.GENERATORS:
+        return jsonify(error='Unknown format: %s' % output_format), 400
+    movies = export.iter_movies(app.session, collection_id=collection_id)
+    return Response(stream_with_context(
+        export.GENERATORS[output_format](movies)),
+        mimetype=export.MIMETYPES[output_format])
+
+
+# Largest body of a bulk import, in bytes.
+BULK_MAX_CONTENT_LENGTH = 1024 * 1024 * 1024
+
+# Request content types accepted by `bulkImport`.
+BULK_FORMATS = {
+    'text/csv': 'csv',
+    'application/json': 'json',
+    'application/x-ndjson': 'ndjson',
+}
+
+
+@app.route('/collection/<int:collection_id>/movie/bulk', methods=['POST'])
+@body_limit('BULK_MAX_CONTENT_LENGTH', BULK_MAX_CONTENT_LENGTH)
+def bulkImport(collection_id):
+    """ Adds the movies in the request body to a collection.
+
+    The body is CSV, JSON or NDJSON as written by `bulkExport`, selected by
+    the Content-Type header or the `format` query parameter. Only the
+    creator of the collection may import. See `bulk.import_movies()`.
+    The body is read as a stream, and may be up to
+    BULK_MAX_CONTENT_LENGTH bytes (config key of the same name).
+
+    Returns:
+        JSON with the number of `imported` movies, the number of `failed`
+        rows and the `errors` of the first invalid rows. With status 400
+        if the body is malformed, which stops the import; the movies
+        counted as imported up to there stay imported.
+    """
+    if 'username' not in login_session:
+        return jsonify(error='Login required'), 401
+    collection = app.Collection().filter_by(id=collection_id).first()
+    if collection is None:
+        return jsonify(error='Unknown collection'), 404
+    if collection.user_id != login_session['user_id']:
+        return jsonify(error='Not the creator of this collection'), 403
+    input_format = request.args.get('format') or BULK_FORMATS.get(
+        request.mimetype)
+    if input_format not in bulk.READERS:
+        return jsonify(error='Unknown format, send Content-Type %s'
+                       % ' or '.join(sorted(BULK_FORMATS))), 415
+    rows = bulk.READERS[input_format](bulk.text_stream(request.stream))
+    try:
+        result = bulk.import_movies(app.session, rows,
+                                    login_session['user_id'], collection_id)
+    except bulk.MalformedInput as e:
+        # Batches before the malformed part of the body stay imported.
+        app.session.rollback()
+        return jsonify(error='Malformed %s: %s' % (input_format, e),
+                       **e.result), 400
+    return jsonify(result)
+
+
+@app.route('/movie/batch', methods=['POST'])
+def batchChanges():
+    """ Edits, moves and deletes movies in one transaction.
+
+    The body is JSON {"changes": [...]}, for example:
+
+        {"changes": [
+            {"op": "edit", "id": 1, "fields": {"year": "1999"}},
+            {"op": "move", "id": 2, "collection_id": 3},
+            {"op": "delete", "id": 4}]}
+
+    See `bulk.apply_changes()`. Either all changes are applied or none.
+
+    Returns:
+        JSON with `applied` and per-change `results`; status 200 if the
+        changes were applied, 403 if a collection is not the user's own,
+        400 if a change is invalid.
+    """
+    if 'username' not in login_session:
+        return jsonify(error='Login required'), 401
+    body = request.get_json(silent=True)
+    changes = body.get('changes') if isinstance(body, dict) else None
+    if not isinstance(changes, list):
+        return jsonify(error='Expected JSON {"changes": [...]}'), 400
+    if len(changes) > bulk.MAX_CHANGES:
+        return jsonify(error='More than %d changes' % bulk.MAX_CHANGES), 400
+    applied, results = bulk.apply_changes(app.session,
+                                          login_session['user_id'], changes)
+    status = 200
+    if not applied:
+        app.session.rollback()
+        statuses = set(result['status'] for result in results)
+        status = 403 if 'forbidden' in statuses else 400
+    return jsonify(applied=applied, results=results), status
+
+
+@app.route('/search/JSON')
+def searchJSON():
+    """ Returns the movies matching a search text in JSON format.
+
+    Query parameters:
+        q: The search text. Words are matched as prefixes.
+        limit: Number of movies per page.
+        page: Number of the result page, starting at 1.
+    """
+    terms = request.args.get('q', '')
+    limit = request.args.get('limit', search.DEFAULT_RESULTS, type=int)
+    limit = max(1, min(limit, search.MAX_RESULTS))
+    page = max(1, request.args.get('page', 1, type=int))
+    movies = search.search(app.session, terms, limit=limit + 1,
+                           offset=(page - 1) * limit)
+    next_page = page + 1 if len(movies) > limit else None
+    return fastjson.response(Movies=[a.serialize for a in movies[:limit]],
+                             next=next_page)
+
+
+@app.route('/cache/JSON')
+def cacheJSON():
+    """ Returns the hit/miss counters and size of the response cache.
+
+    Only answered for requests from the local machine; 404 otherwise. The
+    counters are those of the worker process answering the request.
+    """
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        abort(404)
+    return jsonify(cache=response_cache.stats())
 
 
 ##############################################################################
 # ATOM APIs to view Collection Information
 ##############################################################################
 @app.route('/collection/atom')
+@conditional(collections_validators, last_modified=False)
 def collectionsATOM():
-    """ Returns all collections in Atom format. """
+    """ Streams one page of collections as a paged Atom feed.
+
+    Query parameters `limit`, `after` and `before` select the page, see
+    `FeedPage`.
+    """
 
-    collections = app.Collection().all()
-    return render_template('collections.xml', collections=collections)
+    collections = FeedPage(app.Collection(), Collection.id)
+    return Response(stream_template('collections.xml', collections=collections),
+                    mimetype='application/atom+xml')
 
 
 @app.route('/collection/<int:collection_id>/movie/atom')
+@conditional(collection_validators)
 def collectionATOM(collection_id):
-    """ Returns all albums of a distinct collection in Atom format. """
+    """ Streams one page of movies of a distinct collection as an Atom feed.
+
+    Query parameters `limit`, `after` and `before` select the page, see
+    `FeedPage`.
+    """
 
     collection = app.Collection().filter_by(id=collection_id).one()
-    movies = app.Movie().filter_by(collection_id=collection_id).all()
-    return render_template('movies.xml', movies=movies, collection=collection)
+    movies = FeedPage(app.Movie().filter_by(collection_id=collection_id),
+                      Movie.id)
+    return Response(stream_template('movies.xml', movies=movies,
+                                    collection=collection),
+                    mimetype='application/atom+xml')
 
 
 @app.route('/collection/<int:collection_id>/movie/<int:movie_id>/atom')
+@cached(collection_tags)
+@conditional(movie_validators)
 def movieATOM(collection_id, movie_id):
     """ Returns a distinct album in Atom format """
 
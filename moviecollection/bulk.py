@@ -0,0 +1,508 @@
+"""Bulk import of movies from CSV, JSON or NDJSON, and batched changes.
+
+The import reads the formats written by `export.py`, so an export can be
+loaded into another catalog. Rows are validated one by one; invalid rows
+are skipped and reported with their row number, all others are inserted in
+batches of BATCH_SIZE, one transaction and one executemany of multi-row
+INSERTs per batch. The `id`, `user_id` and `updated_at` columns of the
+input are ignored; `collection_id` is used unless a collection is given.
+Each batch queues an 'index_movies' job, which adds its movies to the
+search index after the import; until then, search does not find them.
+
+It is served on `/collection/<id>/movie/bulk` in `api_JSON_ATOM.py` and can
+be run from the command line, see `movie_bulk.py`:
+
+    python movie_bulk.py import --user ID [--collection ID]
+        [--format csv] FILE
+    python movie_bulk.py export [--format csv] [--collection ID] ...
+
+`apply_changes()` edits, moves and deletes many movies in one transaction
+for the `/movie/batch` route.
+"""
+import csv
+import io
+import json
+import re
+from datetime import datetime
+from itertools import chain
+from sqlalchemy import func
+from moviecollection import cache
+from moviecollection import counters
+from moviecollection import database_setup as db_setup
+from moviecollection import jobs
+from moviecollection import search
+from moviecollection import storage
+from moviecollection.database_setup import Collection, Movie
+
+# Number of movies inserted per transaction.
+BATCH_SIZE = 5000
+
+# Movies per multi-row INSERT statement; 100 rows of 8 columns stay below
+# the 999 parameters older SQLite versions allow per statement.
+INSERT_PAGE_SIZE = 100
+
+# Stop reporting errors after this many; the count is still returned.
+MAX_ERRORS = 100
+
+# Imported columns: (name, maximum length, required).
+FIELDS = (('name', 250, True),
+          ('director', 250, True),
+          ('genre', 100, True),
+          ('year', 4, False),
+          ('description', 250, False))
+
+YEAR = re.compile(r'^\d{4}$')
+
+# Upper bound for the number of changes in one batch.
+MAX_CHANGES = 1000
+
+# Kinds of changes accepted by `apply_changes()`.
+CHANGE_OPS = ('edit', 'move', 'delete')
+
+
+class MalformedInput(ValueError):
+    """ Raised when the rest of an import cannot be read.
+
+    Attributes:
+        result: Result of `import_movies()` up to the malformed part. The
+            `imported` movies are committed.
+    """
+
+    def __init__(self, message, result):
+        ValueError.__init__(self, message)
+        self.result = result
+
+
+def read_csv(stream):
+    """ Yields the rows of a CSV file with a header line as dictionaries. """
+    reader = csv.reader(stream)
+    header = next(reader, [])
+    for row in reader:
+        yield dict(zip(header, row))
+
+
+def read_ndjson(stream):
+    """ Yields the rows of newline-delimited JSON; blank lines are skipped.
+
+    Lines that are not a JSON object are yielded as None, so they are
+    reported as invalid rows.
+    """
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield row if isinstance(row, dict) else None
+
+
+def read_json(stream):
+    """ Yields the movies of a {"Movies": [...]} document or a JSON list. """
+    document = json.load(stream)
+    if isinstance(document, dict):
+        document = document.get('Movies')
+    if not isinstance(document, list):
+        raise ValueError('Expected a list of movies or {"Movies": [...]}')
+    for row in document:
+        yield row if isinstance(row, dict) else None
+
+
+READERS = {
+    'csv': read_csv,
+    'json': read_json,
+    'ndjson': read_ndjson,
+}
+
+
+def text_stream(stream, encoding='utf-8'):
+    """ Wraps a binary file object, e.g. a request body, for the readers. """
+    return io.TextIOWrapper(stream, encoding=encoding, newline='')
+
+
+def validate_row(row):
+    """ Checks an input row and returns the values of the movie.
+
+    Args:
+        row: Dictionary of the input columns.
+
+    Returns:
+        values: List of the values of the FIELDS, or None if the row is
+            invalid.
+        error: Message describing why the row is invalid, or None.
+    """
+    if row is None:
+        return None, 'not an object'
+    values = []
+    for name, length, required in FIELDS:
+        value = row.get(name)
+        if value is None or value == '':
+            if required:
+                return None, '%s is required' % name
+            values.append(None)
+            continue
+        if not isinstance(value, str):
+            if name != 'year' or not isinstance(value, int):
+                return None, '%s must be a string' % name
+            value = str(value)
+        value = value.strip()
+        if len(value) > length:
+            return None, '%s is longer than %d characters' % (name, length)
+        values.append(value)
+    if values[3] is not None and not YEAR.match(values[3]):
+        return None, 'year must have four digits'
+    return values, None
+
+
+def import_movies(session, rows, user_id, collection_id=None,
+                  batch_size=BATCH_SIZE):
+    """ Validates and inserts movies in batched transactions.
+
+    Every batch is committed on its own, so an interrupted import keeps the
+    batches before. New movies are added to the movie counters of their
+    collections in the same transaction, which also queues the job adding
+    them to the search index, see `index_movies()`.
+
+    Args:
+        session: Session used to write to the database.
+        rows: Iterable of input dictionaries, e.g. from one of READERS.
+        user_id: User who is recorded as the creator of the movies.
+        collection_id: Collection of all movies; if None, each row needs a
+            `collection_id` of an existing collection.
+        batch_size: Number of movies inserted per transaction.
+
+    Returns:
+        Dictionary with the number of `imported` movies, the number of
+        `failed` rows and a list of `errors` ({'row': n, 'error': message})
+        with the first MAX_ERRORS invalid rows, counted from 1.
+
+    Raises:
+        MalformedInput: The input could not be read to the end.
+    """
+    result = {'imported': 0, 'failed': 0, 'errors': []}
+    collection_ids = set()
+    if collection_id is None:
+        known_collections = set(
+            row[0] for row in session.query(Collection.id))
+    batch = []
+
+    def fail(number, error):
+        result['failed'] += 1
+        if len(result['errors']) < MAX_ERRORS:
+            result['errors'].append({'row': number, 'error': error})
+
+    try:
+        for number, row in enumerate(rows, 1):
+            values, error = validate_row(row)
+            if error is not None:
+                fail(number, error)
+                continue
+            target = collection_id
+            if target is None:
+                try:
+                    target = int(row.get('collection_id'))
+                except (TypeError, ValueError):
+                    fail(number, 'collection_id is required')
+                    continue
+                if target not in known_collections:
+                    fail(number, 'collection %d does not exist' % target)
+                    continue
+            collection_ids.add(target)
+            values.append(target)
+            batch.append(values)
+            if len(batch) >= batch_size:
+                insert_batch(session, batch, user_id)
+                result['imported'] += len(batch)
+                batch = []
+        if batch:
+            insert_batch(session, batch, user_id)
+            result['imported'] += len(batch)
+    except (ValueError, csv.Error) as e:
+        raise MalformedInput(str(e), result)
+    finally:
+        # Also after an error, for the batches committed before.
+        if collection_ids:
+            cache.invalidate('collections')
+        for changed_id in collection_ids:
+            cache.invalidate('collection:%d' % changed_id)
+    return result
+
+
+def insert_batch(session, batch, user_id):
+    """ Inserts validated movies with multi-row INSERTs and commits them.
+
+    The rows go to the DB-API cursor directly, as SQLAlchemy's processing
+    of every parameter set costs more than the INSERT itself. Updating the
+    search index costs more than the INSERT too, so it is left to a job.
+
+    Returns:
+        The ids of the new movies, or None if the database cannot tell
+        (neither PostgreSQL nor SQLite).
+    """
+    connection = session.connection()
+    dialect = connection.dialect
+    columns = [name for name, length, required in FIELDS] + [
+        'collection_id', 'user_id', 'updated_at']
+    insert = 'INSERT INTO movie (%s) VALUES ' % ', '.join(columns)
+    # Converted once, instead of by the driver for every row.
+    process = Movie.updated_at.type.dialect_impl(dialect).bind_processor(
+        dialect)
+    now = datetime.utcnow()
+    extra = (user_id, process(now) if process else now)
+    rows = [tuple(values) + extra for values in batch]
+    cursor = connection.connection.cursor()
+    ids = None
+    try:
+        if dialect.driver == 'psycopg2':
+            # One multi-row INSERT per page instead of one per row.
+            from psycopg2.extras import execute_values
+            ids = [row[0] for row in execute_values(
+                cursor, insert + '%s RETURNING id', rows, page_size=1000,
+                fetch=True)]
+        else:
+            # Also multi-row INSERTs: SQLite spends about as much time per
+            # statement as per row.
+            placeholder = '?' if dialect.paramstyle == 'qmark' else '%s'
+            values = '(%s)' % ', '.join([placeholder] * len(columns))
+            pages = [list(chain.from_iterable(rows[start:start +
+                                                   INSERT_PAGE_SIZE]))
+                     for start in range(0, len(rows), INSERT_PAGE_SIZE)]
+            last = pages.pop()
+            if pages:
+                cursor.executemany(insert + ', '.join(
+                    [values] * INSERT_PAGE_SIZE), pages)
+            cursor.execute(insert + ', '.join(
+                [values] * (len(last) // len(columns))), last)
+    finally:
+        cursor.close()
+    if ids is None and dialect.name == 'sqlite':
+        # executemany returns no rows. The transaction holds SQLite's only
+        # write lock since the INSERT, and each new row got the highest id
+        # plus one, so the new movies are the rows with the highest ids.
+        last_id = session.query(func.max(Movie.id)).scalar()
+        ids = list(range(last_id - len(batch) + 1, last_id + 1))
+    if ids and search.dialect_name(session) == 'sqlite':
+        jobs.enqueue(session, 'index_movies', first_id=min(ids),
+                     last_id=max(ids))
+    # Rows end with the collection id, see `import_movies()`.
+    counters.update(session, added=[(values[-1], values[2], values[3])
+                                    for values in batch])
+    session.commit()
+    return ids
+
+
+@jobs.handler('index_movies')
+def index_movies(first_id, last_id):
+    """ Adds imported movies with ids in a range to the search index.
+
+    Movies edited or deleted since the import are indexed as they are now.
+    """
+    session = db_setup.Session()
+    search.reindex_movies(session, first_id, last_id)
+    session.commit()
+
+
+##############################################################################
+# Batched changes
+##############################################################################
+def validate_fields(fields):
+    """ Checks the new values of an edit, which may omit any column.
+
+    Returns:
+        values: Dictionary of the Movie columns to change, or None.
+        error: Message describing why the values are invalid, or None.
+    """
+    if not isinstance(fields, dict) or not fields:
+        return None, 'fields must be a non-empty object'
+    unknown = set(fields) - set(name for name, length, required in FIELDS)
+    if unknown:
+        return None, 'unknown fields: %s' % ', '.join(sorted(unknown))
+    # Fill in placeholders for omitted required columns, then drop them.
+    row = dict((name, '-') for name, length, required in FIELDS if required)
+    row.update(fields)
+    values, error = validate_row(row)
+    if error is not None:
+        return None, error
+    return dict((name, value) for (name, length, required), value
+                in zip(FIELDS, values) if name in fields), None
+
+
+def is_id(value):
+    """ Returns True if a JSON value is a row id: an int, but not a bool. """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def apply_changes(session, user_id, changes):
+    """ Edits, moves and deletes movies in one transaction.
+
+    Every change is a dictionary with the keys `op` ('edit', 'move' or
+    'delete') and `id` of the movie, plus `fields` with the new values for
+    an edit and `collection_id` of the target collection for a move. The
+    changes are only applied if all of them are valid and the user created
+    every collection involved; the collections are loaded and checked once,
+    not once per movie.
+
+    Args:
+        session: Session used to write to the database.
+        user_id: User making the changes.
+        changes: List of change dictionaries.
+
+    Returns:
+        applied: True if the changes were committed.
+        results: List with {'index', 'id', 'op', 'status'} per change, and
+            'error' if it is invalid. Status is 'ok', 'invalid' or
+            'forbidden'; with an invalid change none is applied.
+    """
+    results = []
+    movie_ids = set()
+    for index, change in enumerate(changes):
+        change = change if isinstance(change, dict) else {}
+        result = {'index': index, 'id': change.get('id'),
+                  'op': change.get('op'), 'status': 'ok'}
+        results.append(result)
+        if result['op'] not in CHANGE_OPS:
+            result['status'], result['error'] = 'invalid', 'unknown op'
+        elif not is_id(result['id']):
+            result['status'], result['error'] = 'invalid', 'id is required'
+        elif (result['op'] == 'move' and
+              not is_id(change.get('collection_id'))):
+            result['status'], result['error'] = (
+                'invalid', 'collection_id is required')
+        elif result['id'] in movie_ids:
+            result['status'], result['error'] = (
+                'invalid', 'movie changed more than once')
+        else:
+            movie_ids.add(result['id'])
+
+    movies = dict((movie.id, movie) for movie in session.query(Movie).filter(
+        Movie.id.in_(movie_ids))) if movie_ids else {}
+    collection_ids = set(movie.collection_id for movie in movies.values())
+    collection_ids.update(change['collection_id']
+                          for change, result in zip(changes, results)
+                          if result['status'] == 'ok' and
+                          result['op'] == 'move')
+    collections = dict(
+        (collection.id, collection) for collection in session.query(
+            Collection).filter(Collection.id.in_(collection_ids))
+    ) if collection_ids else {}
+    # One authorization check per collection.
+    allowed = dict((collection_id, collection.user_id == user_id)
+                   for collection_id, collection in collections.items())
+
+    values = {}
+    for change, result in zip(changes, results):
+        if result['status'] != 'ok':
+            continue
+        movie = movies.get(result['id'])
+        if movie is None:
+            result['status'], result['error'] = 'invalid', 'unknown movie'
+        elif not allowed.get(movie.collection_id):
+            result['status'], result['error'] = (
+                'forbidden', 'not the creator of collection %d'
+                % movie.collection_id)
+        elif result['op'] == 'edit':
+            values[movie.id], error = validate_fields(change.get('fields'))
+            if error is not None:
+                result['status'], result['error'] = 'invalid', error
+        elif result['op'] == 'move':
+            target = change.get('collection_id')
+            if target not in collections:
+                result['status'], result['error'] = (
+                    'invalid', 'unknown collection')
+            elif not allowed[target]:
+                result['status'], result['error'] = (
+                    'forbidden', 'not the creator of collection %d' % target)
+    if any(result['status'] != 'ok' for result in results):
+        return False, results
+
+    now = datetime.utcnow()
+    changed = set()
+    added, removed = [], []
+    for change, result in zip(changes, results):
+        movie = movies[result['id']]
+        changed.add(movie.collection_id)
+        removed.append(counters.key(movie))
+        if result['op'] == 'edit':
+            for name, value in values[movie.id].items():
+                setattr(movie, name, value)
+            search.index_movie(session, movie)
+            added.append(counters.key(movie))
+        elif result['op'] == 'move':
+            # Mark the old collection as changed for the Last-Modified header.
+            collections[movie.collection_id].updated_at = now
+            movie.collection_id = change['collection_id']
+            movie.updated_at = now
+            changed.add(movie.collection_id)
+            added.append(counters.key(movie))
+        else:
+            if movie.cover_source == 'local':
+                storage.release(session, movie.cover_image)
+            collections[movie.collection_id].updated_at = now
+            search.unindex_movie(session, movie.id)
+            session.delete(movie)
+    counted = counters.update(session, added=added, removed=removed)
+    session.commit()
+    if counted:
+        cache.invalidate('collections')
+    for collection_id in changed:
+        cache.invalidate('collection:%d' % collection_id)
+    return True, results
+
+
+def main(argv=None):
+    import argparse
+    import sys
+    from moviecollection import app
+    from moviecollection import export
+
+    parser = argparse.ArgumentParser(
+        description='Import or export movies in bulk.')
+    commands = parser.add_subparsers(dest='command')
+    importer = commands.add_parser('import', help='Load movies from a file.')
+    importer.add_argument('--format', choices=sorted(READERS),
+                          help='Input format; guessed from the file name.')
+    importer.add_argument('--user', type=int, dest='user_id', required=True,
+                          help='Id of the user creating the movies.')
+    importer.add_argument('--collection', type=int, dest='collection_id',
+                          help='Put all movies into this collection.')
+    importer.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    importer.add_argument('file', help="Input file, or '-' for stdin.")
+    commands.add_parser('export', add_help=False)
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['export']:
+        return export.main(argv[1:])
+    args = parser.parse_args(argv)
+    if args.command != 'import':
+        parser.print_usage()
+        return 1
+
+    input_format = args.format or args.file.rsplit('.', 1)[-1].lower()
+    if input_format not in READERS:
+        parser.error('Unknown format, use --format %s'
+                     % '|'.join(sorted(READERS)))
+    app.start_session()
+    if args.file == '-':
+        stream = text_stream(sys.stdin.buffer)
+    else:
+        stream = io.open(args.file, encoding='utf-8', newline='')
+    malformed = None
+    with stream:
+        try:
+            result = import_movies(app.session,
+                                   READERS[input_format](stream),
+                                   args.user_id, args.collection_id,
+                                   args.batch_size)
+        except MalformedInput as e:
+            malformed, result = e, e.result
+    app.session.remove()
+    if result['imported']:
+        print('Adding the movies to the search index...')
+        # Runs the queued jobs, which a server would otherwise run.
+        jobs.work(burst=True)
+    for error in result['errors']:
+        print('row %(row)d: %(error)s' % error)
+    if malformed is not None:
+        print('Malformed %s, stopped: %s' % (input_format, malformed))
+    print('Imported %d movies, %d rows failed.'
+          % (result['imported'], result['failed']))
+    return 1 if result['failed'] or malformed is not None else 0
@@ -0,0 +1,377 @@
+"""Response cache for the read-heavy pages and APIs.
+
+Responses of decorated views are stored in a pluggable backend:
+
+    MemoryCache: in-process LRU cache, one per worker process.
+    DiskCache: cache directory shared by all processes of the app user.
+
+Both backends expire entries after a TTL and evict the least recently used
+entries beyond a maximum number of entries. The backend is chosen with the
+config keys CACHE_BACKEND ('memory', 'disk' or None to disable the cache),
+CACHE_TTL (seconds), CACHE_MAX_ENTRIES and CACHE_DIR. Invalidations only
+reach the memory cache of the process that made them, so the production
+server uses 'disk' when it runs several workers, see `server.py`. The
+cache directory must belong to the user running the app and must not be
+writable by anybody else, as its files become responses.
+
+Cached responses are grouped by tags, e.g. 'collection:3'. A tag has a
+generation token that is part of the cache key of each of its responses.
+`invalidate()` replaces the token, so all responses of the tag are missed
+from then on and age out of the backend. The token also records the time of
+the invalidation: while replicas may still miss the change, responses of
+the tag are rendered from the primary database.
+"""
+import hashlib
+import json
+import os
+import stat
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import wraps
+from flask import request, session as login_session
+from moviecollection import app
+from moviecollection import database_setup as db_setup
+
+# Default settings, overridden by the config keys of the same name.
+CACHE_BACKEND = 'memory'
+CACHE_TTL = 300  # seconds
+CACHE_MAX_ENTRIES = 1000
+CACHE_DIR = os.path.join(app.instance_path, 'cache')
+
+# Response headers that are stored together with the body.
+CACHED_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+
+##############################################################################
+# Backends
+##############################################################################
+class MemoryCache(object):
+    """ In-process LRU cache with a TTL and a maximum number of entries. """
+
+    def __init__(self, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # Re-insert as the most recently used entry.
+            self._entries[key] = entry
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'backend': 'memory', 'entries': len(self._entries),
+                'max_entries': self.max_entries, 'evictions': self.evictions}
+
+
+def private_directory(path):
+    """ Creates a directory only the current user can use, or checks that
+    an existing one is.
+
+    Raises:
+        RuntimeError: The directory belongs to another user, is writable
+            by others, or is not a directory (e.g. a symbolic link).
+    """
+    if not os.path.lexists(path):
+        os.makedirs(path, 0o700)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise RuntimeError('%s is not a directory' % path)
+    if hasattr(os, 'geteuid') and info.st_uid != os.geteuid():
+        raise RuntimeError('%s belongs to another user' % path)
+    if info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise RuntimeError('%s is writable by other users' % path)
+
+
+class DiskCache(object):
+    """ Cache directory shared between processes.
+
+    Each entry is a file named after the hash of its key: a line of JSON
+    with the expiry time and the value, followed by the body of a cached
+    response. Values are JSON data or (body, status, headers) tuples of
+    responses. Files are replaced atomically, and their modification time
+    marks the last use, so the least recently used files are removed when
+    the directory holds more than `max_entries` files.
+    """
+
+    # Check the number of files after this many writes.
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, directory=CACHE_DIR, ttl=CACHE_TTL,
+                 max_entries=CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._writes = 0
+        private_directory(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = json.loads(f.readline().decode('utf-8'))
+                body = f.read()
+            expires = entry['expires']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        if expires < time.time():
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        if 'status' in entry:
+            return body, entry['status'], [tuple(header) for header
+                                           in entry['headers']]
+        return entry.get('value')
+
+    def set(self, key, value):
+        entry = {'expires': time.time() + self.ttl}
+        if isinstance(value, tuple):
+            body, entry['status'], entry['headers'] = value
+        else:
+            body, entry['value'] = b'', value
+        line = json.dumps(entry).encode('utf-8')
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(line + b'\n')
+            f.write(body)
+        os.rename(tmp_path, self._path(key))
+        self._writes += 1
+        if self._writes % self.PRUNE_INTERVAL == 0:
+            self.prune()
+
+    def prune(self):
+        """ Removes the least recently used files beyond `max_entries`. """
+        paths = self._files()
+        if len(paths) <= self.max_entries:
+            return
+        paths.sort(key=lambda path: self._mtime(path))
+        for path in paths[:len(paths) - self.max_entries]:
+            self._remove(path)
+            self.evictions += 1
+
+    def clear(self):
+        for path in self._files():
+            self._remove(path)
+
+    def stats(self):
+        return {'backend': 'disk', 'entries': len(self._files()),
+                'max_entries': self.max_entries, 'evictions': self.evictions}
+
+    def _files(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if not name.endswith('.tmp')]
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return 0
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+##############################################################################
+# Response cache
+##############################################################################
+class ResponseCache(object):
+    """ Caches view responses by request path and tags, see module doc. """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._backend = None
+        self._configured = False
+        self._lock = threading.Lock()
+        self._count_lock = threading.Lock()
+
+    @property
+    def backend(self):
+        """ The backend selected by the app config, created on first use. """
+        if not self._configured:
+            with self._lock:
+                if not self._configured:
+                    self._backend = create_backend(app.config)
+                    self._configured = True
+        return self._backend
+
+    def reset(self):
+        """ Drops the backend so it is recreated from the app config. """
+        with self._lock:
+            self._backend = None
+            self._configured = False
+        with self._count_lock:
+            self.hits = self.misses = 0
+
+    def count(self, hit):
+        """ Counts a cache hit or miss; requests run in many threads. """
+        with self._count_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def generation(self, tag):
+        """ Returns the current generation token of a tag.
+
+        Tokens have the form '<time of invalidation>:<random hex>'.
+        """
+        key = 'generation:' + tag
+        token = self.backend.get(key)
+        if token is None:
+            # Never reuse a token, so evicted tags cannot serve stale data.
+            token = '0:' + uuid.uuid4().hex
+            self.backend.set(key, token)
+        return token
+
+    def invalidate(self, *tags):
+        """ Makes all cached responses of the given tags stale. """
+        if self.backend is None:
+            return
+        for tag in tags:
+            self.backend.set('generation:' + tag,
+                             '%d:%s' % (time.time(), uuid.uuid4().hex))
+
+    def key(self, tags, per_user):
+        """ Returns the cache key of the request and the time the most
+        recently invalidated of the tags was invalidated.
+        """
+        parts = [request.full_path]
+        if per_user:
+            parts.append(str(login_session.get('user_id')))
+        invalidated_at = 0
+        for tag in tags:
+            token = self.generation(tag)
+            parts.append(tag + '=' + token)
+            stamp = token.partition(':')[0]
+            if stamp.isdigit():
+                invalidated_at = max(invalidated_at, int(stamp))
+        return 'response:' + '|'.join(parts), invalidated_at
+
+    def stats(self):
+        stats = {'hits': self.hits, 'misses': self.misses}
+        if self.backend is not None:
+            stats.update(self.backend.stats())
+        else:
+            stats['backend'] = None
+        return stats
+
+
+def create_backend(config):
+    """ Returns the backend configured in `config`, or None. """
+    name = config.get('CACHE_BACKEND', CACHE_BACKEND)
+    ttl = config.get('CACHE_TTL', CACHE_TTL)
+    max_entries = config.get('CACHE_MAX_ENTRIES', CACHE_MAX_ENTRIES)
+    if name == 'memory':
+        return MemoryCache(ttl=ttl, max_entries=max_entries)
+    if name == 'disk':
+        return DiskCache(config.get('CACHE_DIR', CACHE_DIR), ttl=ttl,
+                         max_entries=max_entries)
+    return None
+
+
+response_cache = ResponseCache()
+
+
+def collections_tags(**kwargs):
+    """ Tags of responses listing all collections. """
+    return ('collections',)
+
+
+def collection_tags(collection_id, **kwargs):
+    """ Tags of responses showing a collection or its movies. """
+    return ('collection:%d' % collection_id,)
+
+
+def invalidate(*tags):
+    """ Makes all cached responses of the given tags stale. """
+    response_cache.invalidate(*tags)
+
+
+def cached(tags, per_user=False):
+    """ Decorator that serves a view's GET responses from the cache.
+
+    Only 200 responses are stored, without cookies. Streamed responses are
+    not stored, since that would read the whole body into memory first; the
+    paged Atom feeds are not cached for that reason. A cache hit is answered
+    with 304 if the stored ETag or Last-Modified matches the request.
+    Requests of a session with pending flash messages bypass the cache.
+
+    Args:
+        tags: Function returning the tags of the response, called with the
+            view arguments.
+        per_user: Cache a separate response for every logged in user.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if (response_cache.backend is None or request.method != 'GET'
+                    or '_flashes' in login_session):
+                return f(*args, **kwargs)
+            key, invalidated_at = response_cache.key(tags(**kwargs),
+                                                     per_user)
+            entry = response_cache.backend.get(key)
+            if entry is not None:
+                response_cache.count(True)
+                body, status, headers = entry
+                response = app.response_class(body, status=status,
+                                              headers=headers)
+                return response.make_conditional(request)
+            response_cache.count(False)
+            replicas = db_setup.replicas
+            if (replicas is not None and
+                    invalidated_at > time.time() - replicas.max_lag - 1):
+                # A replica may not have the change yet, and its old data
+                # would be cached under the new generation.
+                app.session().info['read_only'] = False
+            response = app.make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                headers = [(name, response.headers[name])
+                           for name in CACHED_HEADERS
+                           if name in response.headers]
+                response_cache.backend.set(
+                    key, (response.get_data(), response.status_code, headers))
+            return response
+        return decorated_function
+    return decorator
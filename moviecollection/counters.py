@@ -0,0 +1,77 @@
+"""Movie counters of collections: number of movies, genres and years.
+
+The counters are stored in columns of the collection, see
+`database_setup.Collection`, so the collections list does not count the
+movie table on every request. The write views keep them up to date by
+calling `update()` in the same transaction as the change to the movies:
+
+    old = counters.key(movie)
+    movie.genre = 'Drama'
+    if counters.update(session, added=[counters.key(movie)], removed=[old]):
+        cache.invalidate('collections')
+
+`database_setup.count_movies()` rebuilds them from the movie table, which
+`python database_setup.py recount` runs from the command line.
+"""
+from collections import Counter
+from datetime import datetime
+from moviecollection.database_setup import Collection, MovieCounts
+
+
+def key(movie):
+    """ Returns what the counters of a movie depend on.
+
+    Take the key before changing the collection, genre or year of a movie,
+    to pass it to `update()` as removed.
+    """
+    return movie.collection_id, movie.genre, movie.year
+
+
+def update(session, added=(), removed=()):
+    """ Adds movies to and removes movies from the counters.
+
+    The counters of each collection are read and written back while its
+    row is locked (on PostgreSQL; SQLite only has one writer anyway), so
+    concurrent changes to the same collection are not lost. The lock is
+    FOR NO KEY UPDATE, as new movies already hold a KEY SHARE lock on their
+    collection through the foreign key. The session is not committed.
+
+    Args:
+        session: Session of the transaction that changes the movies.
+        added: Keys of new movies, or of changed movies after the change.
+        removed: Keys of deleted movies, or of changed movies before the
+            change.
+
+    Returns:
+        True if the counters of any collection changed.
+    """
+    changes = {}
+    for sign, keys in ((1, added), (-1, removed)):
+        # Bulk imports pass thousands of keys, most of them repeated.
+        for (collection_id, genre, year), n in Counter(keys).items():
+            changes.setdefault(collection_id, MovieCounts()).add(
+                genre, year, sign * n)
+    now = datetime.utcnow()
+    changed = False
+    # A fixed order keeps two transactions from locking in opposite order.
+    for collection_id in sorted(changes):
+        change = changes[collection_id]
+        if change.is_empty():
+            continue
+        row = session.query(
+            Collection.movie_count, Collection.genre_counts,
+            Collection.year_counts).filter(
+            Collection.id == collection_id).with_for_update(
+            key_share=True).first()
+        if row is None:
+            # The collection was deleted, its movies go with it.
+            continue
+        counts = MovieCounts.load(*row)
+        counts.merge(change)
+        values = counts.values()
+        values['updated_at'] = now
+        session.query(Collection).filter(
+            Collection.id == collection_id).update(
+            values, synchronize_session=False)
+        changed = True
+    return changed
@@ -1,14 +1,29 @@
+import itertools
+import json
+import logging
 import os
-from sqlalchemy import Column as Col, ForeignKey, Integer, String as Str
+import threading
+import time
+import warnings
+from datetime import datetime
+from sqlalchemy import Column as Col, DateTime, ForeignKey, Index, Integer, String as Str, Text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import SAWarning
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy import (bindparam, create_engine, event, func, inspect,
+                        select, text)
+from sqlalchemy.sql.expression import CompoundSelect, Select, TextClause
 
 
 Base = declarative_base()
 
+log = logging.getLogger(__name__)
+
 ###############################################################################
-# Tables: User, Collection, Album
+# Tables: User, Collection, Movie, RemoteCover, Blob, Job
 ###############################################################################
 
 class User(Base):
@@ -23,7 +38,7 @@ class User(Base):
     """
     id = Col(Integer, primary_key=True)
     name = Col(Str(250), nullable=False)
-    email = Col(Str(250), nullable=False)
+    email = Col(Str(250), nullable=False, unique=True, index=True)
     picture = Col(Str(250))
 
     @property
@@ -45,12 +60,42 @@ class Collection(Base):
         id: Distinct collection id.
         name: Name of the collection.
         user_id: user who created the collection.
+        updated_at: UTC time of the last change to the collection itself,
+            including its movie counters.
+        movie_count: Number of movies in the collection.
+        genre_counts: JSON object with the number of movies per genre.
+        year_counts: JSON object with the number of movies per year.
+
+    The movie counters are kept up to date by `counters.py` and can be
+    rebuilt with `count_movies()`.
     """
 
     id = Col(Integer, primary_key=True)
     name = Col(Str(250), nullable=False)
-    user_id = Col(Integer, ForeignKey('user.id'))
+    user_id = Col(Integer, ForeignKey('user.id'), index=True)
     user = relationship(User)
+    updated_at = Col(DateTime, default=datetime.utcnow,
+                     onupdate=datetime.utcnow, index=True)
+    movie_count = Col(Integer, nullable=False, default=0)
+    genre_counts = Col(Text, nullable=False, default='{}')
+    year_counts = Col(Text, nullable=False, default='{}')
+
+    # Columns read by `serialize_row()`.
+    serialize_columns = ('id', 'name', 'movie_count', 'genre_counts',
+                         'year_counts')
+
+    @property
+    def genres(self):
+        """ Number of movies per genre. """
+        return json.loads(self.genre_counts or '{}')
+
+    @property
+    def year_range(self):
+        """ Earliest and latest year of the movies, or (None, None). """
+        years = json.loads(self.year_counts or '{}')
+        if not years:
+            return None, None
+        return min(years), max(years)
 
     # Decorator method
     @property
@@ -61,9 +106,24 @@ class Collection(Base):
         sent across and put it in a format that Flask can easily use.
         """
         # Returns object data in easily serializeable format
+        return self.serialize_row(self)
+
+    @staticmethod
+    def serialize_row(row):
+        """ Formats a collection like `serialize`.
+
+        Args:
+            row: Collection, or a query row with the `serialize_columns`,
+                which the JSON API reads without loading Collection objects.
+        """
+        years = json.loads(row.year_counts or '{}')
         return {
-            'id': self.id,
-            'name': self.name
+            'id': row.id,
+            'name': row.name,
+            'movie_count': row.movie_count,
+            'genres': json.loads(row.genre_counts or '{}'),
+            'year_min': min(years) if years else None,
+            'year_max': max(years) if years else None
         }
 
 class Movie(Base):
@@ -80,6 +140,7 @@ class Movie(Base):
         cover_image: filename or external path to the optional album cover image.
         user_id: user who created the movie entry.
         collection_id: collections where the movie belongs to.
+        updated_at: UTC time of the last change to the movie.
     """
 
     id = Col(Integer, primary_key=True)
@@ -90,10 +151,24 @@ class Movie(Base):
     description = Col(Str(250))
     cover_source = Col(Str(5))
     cover_image = Col(Str(250))
-    user_id = Col(Integer, ForeignKey('user.id'))
+    user_id = Col(Integer, ForeignKey('user.id'), index=True)
     user = relationship(User)
-    collection_id = Col(Integer, ForeignKey('collection.id'))
+    collection_id = Col(Integer, ForeignKey('collection.id'), index=True)
     collection = relationship(Collection)
+    updated_at = Col(DateTime, default=datetime.utcnow,
+                     onupdate=datetime.utcnow, index=True)
+    # Local copy of an external cover image, see `remote_covers.py`.
+    remote_cover = relationship(
+        'RemoteCover', uselist=False, viewonly=True,
+        primaryjoin='foreign(Movie.cover_image) == RemoteCover.url')
+
+    # Covers the per-collection aggregates used for HTTP validators.
+    __table_args__ = (Index('ix_movie_collection_id_updated_at',
+                            'collection_id', 'updated_at'),)
+
+    # Keys of `serialize`, which the JSON API reads as plain query rows.
+    serialize_columns = ('id', 'name', 'director', 'genre', 'year',
+                         'description')
 
     # Decorator method
     @property
@@ -109,77 +184,622 @@ class Movie(Base):
             'id': self.id,
             'name': self.name,
             'director': self.director,
-            'genre': self.director,
+            'genre': self.genre,
             'year': self.year,
             'description': self.description
         }
 
 
+class RemoteCover(Base):
+    __tablename__ = 'remote_cover'
+    """ Table for local copies of external cover images.
+
+    Columns:
+        id: Distinct remote cover id.
+        url: External URL of the image, as in Movie.cover_image.
+        blob: Name of the stored copy, see `storage.py`.
+        etag: ETag header of the last download, for conditional requests.
+        last_modified: Last-Modified header of the last download.
+        fetched_at: UTC time the copy was last downloaded or revalidated.
+        last_error: Error message of the last failed download.
+    """
+
+    id = Col(Integer, primary_key=True)
+    url = Col(Str(250), nullable=False, unique=True, index=True)
+    blob = Col(Str(80))
+    etag = Col(Str(250))
+    last_modified = Col(Str(64))
+    fetched_at = Col(DateTime)
+    last_error = Col(Text)
+
+
+class Blob(Base):
+    __tablename__ = 'blob'
+    """ Table for uploaded files stored under their content hash.
+
+    Columns:
+        name: File name in the upload folder; SHA-256 hex digest of the
+            content plus the file extension.
+        refcount: Number of movies using the file as cover image.
+        size: File size in bytes.
+        created_at: UTC time of the first upload.
+    """
+
+    name = Col(Str(80), primary_key=True)
+    refcount = Col(Integer, nullable=False, default=0)
+    size = Col(Integer)
+    created_at = Col(DateTime, default=datetime.utcnow)
+
+
+class Job(Base):
+    __tablename__ = 'job'
+    """ Table for background jobs, see `jobs.py`.
+
+    Columns:
+        id: Distinct job id.
+        kind: Name of the handler that runs the job.
+        payload: JSON encoded keyword arguments of the handler.
+        status: 'pending', 'running', 'done' or 'dead' (failed for good).
+        attempts: Number of times the job was started.
+        max_attempts: Attempts after which a failing job is dead.
+        run_after: UTC time before which the job is not started.
+        last_error: Error message of the last failed attempt.
+        created_at: UTC time the job was queued.
+        updated_at: UTC time of the last status change.
+    """
+
+    id = Col(Integer, primary_key=True)
+    kind = Col(Str(50), nullable=False)
+    payload = Col(Text, nullable=False, default='{}')
+    status = Col(Str(10), nullable=False, default='pending')
+    attempts = Col(Integer, nullable=False, default=0)
+    max_attempts = Col(Integer, nullable=False, default=5)
+    run_after = Col(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Col(Text)
+    created_at = Col(DateTime, default=datetime.utcnow)
+    updated_at = Col(DateTime, default=datetime.utcnow,
+                     onupdate=datetime.utcnow)
+
+    # Workers look for the oldest pending job that is due.
+    __table_args__ = (Index('ix_job_status_run_after', 'status', 'run_after'),)
+
+
+class MovieCounts(object):
+    """ Movie counters of a collection: total, per genre and per year.
+
+    Counts may be negative while they describe a change, see `counters.py`.
+    Only four-digit years are counted, and zero counts are left out.
+    """
+
+    def __init__(self, movies=0, genres=None, years=None):
+        self.movies = movies
+        self.genres = genres or {}
+        self.years = years or {}
+
+    @classmethod
+    def load(cls, movie_count, genre_counts, year_counts):
+        """ Returns the counters stored in the columns of a collection. """
+        return cls(movie_count or 0, json.loads(genre_counts or '{}'),
+                   json.loads(year_counts or '{}'))
+
+    def add(self, genre, year, n=1):
+        """ Counts `n` movies of a genre and year; negative `n` removes. """
+        self.movies += n
+        self._add(self.genres, genre, n)
+        if year and len(year) == 4 and year.isdigit():
+            self._add(self.years, year, n)
+
+    def merge(self, other):
+        """ Adds the counts of another MovieCounts. """
+        self.movies += other.movies
+        for genre, n in other.genres.items():
+            self._add(self.genres, genre, n)
+        for year, n in other.years.items():
+            self._add(self.years, year, n)
+
+    def is_empty(self):
+        return not (self.movies or self.genres or self.years)
+
+    def values(self):
+        """ Returns the column values of a collection with these counts. """
+        return {'movie_count': self.movies,
+                'genre_counts': json.dumps(self.genres, sort_keys=True),
+                'year_counts': json.dumps(self.years, sort_keys=True)}
+
+    @staticmethod
+    def _add(counts, key, n):
+        count = counts.get(key, 0) + n
+        if count:
+            counts[key] = count
+        else:
+            counts.pop(key, None)
+
+
 ###############################################################################
 # Functions
 ###############################################################################
-# Global variables for database API and database names - in this case, SQlite.
-sqlite_dbapi = 'sqlite:///'
-database_name = 'moviecollections.db'
+# URL of the database, e.g. 'postgresql://vagrant@localhost/moviecollections'
+# for PostgreSQL (see pg_config.sh). Set the environment variable or the app
+# config key DATABASE_URL to use another database than the SQLite file.
+default_database_url = 'sqlite:///moviecollections.db'
+database_url = os.environ.get('DATABASE_URL', default_database_url)
+
+# Name of the full-text search table over movies (SQLite FTS5).
+search_table = 'movie_fts'
+
+# On PostgreSQL, movies are searched through a GIN index over this document.
+search_index = 'ix_movie_search'
+search_document = ("to_tsvector('simple', coalesce(name, '') || ' ' || "
+                   "coalesce(director, '') || ' ' || coalesce(genre, '') || "
+                   "' ' || coalesce(description, ''))")
+
+# Connection pool settings for the process-wide engine. They can be overridden
+# through the keyword arguments of `get_engine()`.
+pool_size = 5
+max_overflow = 10
+pool_recycle = 3600  # seconds
+pool_pre_ping = True
+
+# Settings for every SQLite connection. In WAL mode, readers do not block the
+# writer and the writer does not block readers; NORMAL synchronous is still
+# safe against corruption in WAL mode and only syncs at checkpoints. Waiting
+# up to busy_timeout for the write lock avoids "database is locked" errors.
+sqlite_pragmas = (('journal_mode', 'WAL'),
+                  ('synchronous', 'NORMAL'),
+                  ('busy_timeout', 5000),  # milliseconds
+                  ('mmap_size', 256 * 1024 * 1024),  # bytes
+                  ('cache_size', -32000))  # negative: KiB per connection
+
+# Connections of the read pool used for read-only requests on SQLite; 0
+# sends all requests to the engine. Overridden by `get_engine()`.
+read_pool_size = 10
+
+# URLs of read-only copies (replicas) of the database, separated by commas.
+# Overridden by the `replica_urls` argument of `get_engine()`.
+replica_urls = [url.strip() for url in
+                os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+                if url.strip()]
+
+# Seconds between two health checks of the replicas.
+health_check_interval = 10
+
+# Seconds a replica may be behind the primary. For this long after a write,
+# the writing user and the response cache read from the primary.
+max_replica_lag = 5
+
+engine = None
+replicas = None
+
+
+class ReplicaSet(object):
+    """Engines serving read-only sessions, used in turn while healthy.
+
+    Every `health_check_interval` seconds, the next session that needs a
+    replica starts a background thread that checks that each of them
+    answers a query on the movie table. The session itself does not wait
+    for the check, which takes up to the connect timeout for a replica
+    that is down. Replicas failing the check are skipped until a later
+    check passes.
+    `max_lag` is 0 for the read pool on the primary's own SQLite file.
+    """
+
+    def __init__(self, engines, max_lag=max_replica_lag):
+        self.engines = engines
+        self.max_lag = max_lag
+        self.healthy = list(engines)
+        self.checked_at = time.time()
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+
+    def check(self):
+        """Checks all replicas and returns the healthy ones."""
+        healthy = []
+        for replica in self.engines:
+            try:
+                with replica.connect() as conn:
+                    conn.execute(select([Movie.id]).limit(1)).fetchall()
+            except Exception:
+                log.warning('Replica %r failed its health check',
+                            replica.url, exc_info=True)
+            else:
+                healthy.append(replica)
+        self.healthy = healthy
+        self.checked_at = time.time()
+        return healthy
+
+    def pick(self):
+        """Returns the next healthy replica, or None if there is none."""
+        if time.time() - self.checked_at > health_check_interval:
+            # Only one check at a time; sessions use the last result.
+            if self.lock.acquire(False):
+                thread = threading.Thread(target=self._check_in_background,
+                                          name='replica-health-check')
+                thread.daemon = True
+                thread.start()
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self.counter) % len(healthy)]
+
+    def _check_in_background(self):
+        try:
+            self.check()
+        except Exception:
+            log.exception('Replica health check failed')
+        finally:
+            self.lock.release()
+
+    def dispose(self):
+        for replica in self.engines:
+            replica.dispose()
+
+
+def is_read(clause):
+    """Returns True if a statement only reads, so a replica can run it.
+
+    SELECT statements, ORM queries and textual SELECTs read. Everything
+    else writes or is unknown, including flushes and `Session.connection()`,
+    which pass no statement.
+    """
+    if isinstance(clause, (Select, CompoundSelect)):
+        return True
+    if isinstance(clause, TextClause):
+        return clause.text.lstrip()[:6].upper() == 'SELECT'
+    return False
+
+
+class RoutingSession(OrmSession):
+    """Session sending the queries of read-only work to a replica.
+
+    A session is read-only if `info['read_only']` is set, e.g. by the app
+    for GET requests. It keeps the replica it picked first, so all its
+    queries see the same data. Only reading statements go to the replica,
+    see `is_read()`; writes always go to the engine (the primary), so a
+    read-only session that writes after all keeps working. Without a
+    healthy replica, everything goes to the primary.
+    """
 
-use_SQlite = True  # Boolean
+    def get_bind(self, mapper=None, clause=None):
+        if (replicas is not None and self.info.get('read_only')
+                and is_read(clause)):
+            if 'replica' not in self.info:
+                self.info['replica'] = replicas.pick()
+            if self.info['replica'] is not None:
+                return self.info['replica']
+        return super(RoutingSession, self).get_bind(mapper, clause)
 
-def get_database_session():
-    """Returns a session for executing queries.
 
-    Connects to a database, creates an engine and returns a session connection
-    to the engine.
+@event.listens_for(RoutingSession, 'after_commit')
+def record_commit(session):
+    """Notes in the session that it wrote to the primary."""
+    session.info['committed'] = True
+
+
+# Thread-local session registry. Each thread (and therefore each request) gets
+# its own Session, which is closed again by calling `Session.remove()`.
+Session = scoped_session(sessionmaker(class_=RoutingSession))
+
+
+def is_sqlite(url=None):
+    """Returns True if the URL (by default `database_url`) is a SQLite one."""
+    return make_url(url or database_url).get_backend_name() == 'sqlite'
+
+
+def set_sqlite_pragmas(dbapi_connection, pragmas):
+    """Applies PRAGMA settings to a new SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas:
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+def make_engine(url, read_only=False, **pool_options):
+    """Creates an engine with a connection pool tuned for the database.
+
+    SQLite connections get the `sqlite_pragmas` when they are opened.
+
+    Args:
+        url: Database URL.
+        read_only: Refuse writes on the connections.
+        pool_options: Optional overrides for `pool_size`, `max_overflow`,
+            `pool_recycle` and `pool_pre_ping`.
 
-    :returns: A SQLAlchemy Session instance.
+    :returns: A SQLAlchemy Engine instance.
     """
-    global engine
-    db_name = database_name
-    if use_SQlite:
-        engine = create_engine(sqlite_dbapi + db_name)
+    options = dict(pool_size=pool_size,
+                   max_overflow=max_overflow,
+                   pool_recycle=pool_recycle,
+                   pool_pre_ping=pool_pre_ping)
+    options.update(pool_options)
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite':
+        # SQLite connections are handed between the threads of the pool.
+        sqlite_engine = create_engine(
+            url, poolclass=QueuePool,
+            connect_args={'check_same_thread': False}, **options)
+        pragmas = sqlite_pragmas
+        if read_only:
+            pragmas += (('query_only', 'ON'),)
+        event.listen(sqlite_engine, 'connect',
+                     lambda connection, record:
+                     set_sqlite_pragmas(connection, pragmas))
+        return sqlite_engine
+    if url.get_backend_name() == 'postgresql':
+        # Reusing the most recent connection lets the pool shrink back to
+        # the connections it needs; the others reach pool_recycle.
+        options.setdefault('pool_use_lifo', True)
+        connect_args = options.setdefault('connect_args', {})
+        connect_args.setdefault('application_name', 'moviecollection')
+        # Fail fast on an unreachable server, e.g. a replica that is down.
+        connect_args.setdefault('connect_timeout', 5)
+        if read_only:
+            connect_args.setdefault(
+                'options', '-c default_transaction_read_only=on')
+        if url.get_driver_name() == 'psycopg2':
+            # Send executemany() as multi-row INSERTs, not row by row.
+            options.setdefault('executemany_mode', 'values')
+    return create_engine(url, **options)
+
+
+def get_engine(url=None, read_pool=None, replica_urls=None, replica_lag=None,
+               **pool_options):
+    """Returns the process-wide engine, creating it on the first call.
+
+    The engine owns a pool of database connections that is shared by all
+    threads. Later calls return the same engine and ignore the arguments.
+    Read-only sessions use the replicas, if there are replica URLs, see
+    `RoutingSession`. Without replicas on SQLite, a second engine with a
+    pool of read-only connections to the same file takes their place, so
+    readers do not wait for pool connections held by writers.
+
+    Args:
+        url: Database URL; defaults to `database_url`.
+        read_pool: Size of the read pool of each replica; defaults to
+            `read_pool_size`.
+        replica_urls: List of replica URLs; defaults to the module's
+            `replica_urls`.
+        replica_lag: Seconds replicas may be behind; defaults to
+            `max_replica_lag`.
+        pool_options: Optional overrides for `pool_size`, `max_overflow`,
+            `pool_recycle` and `pool_pre_ping`.
+
+    :returns: A SQLAlchemy Engine instance.
+    """
+    global engine, replicas, database_url
+    if engine is None:
+        database_url = url or database_url
+        engine = make_engine(database_url, **pool_options)
+        if read_pool is None:
+            read_pool = read_pool_size
+        if replica_urls is None:
+            replica_urls = globals()['replica_urls']
+        if replica_lag is None:
+            replica_lag = max_replica_lag
+        if not replica_urls and read_pool and is_sqlite():
+            # The read pool reads the same file, so it is never behind.
+            replica_urls, replica_lag = [database_url], 0
+        if replica_urls:
+            replicas = ReplicaSet([
+                make_engine(replica_url, read_only=True,
+                            pool_size=read_pool or pool_size)
+                for replica_url in replica_urls], replica_lag)
         Base.metadata.bind = engine
-    return sessionmaker(bind=engine)()
+        Session.configure(bind=engine)
+    return engine
+
+
+def get_database_session(url=None, **pool_options):
+    """Returns a session for executing queries.
+
+    Binds the thread-local session registry to the process-wide engine and
+    returns it. The registry proxies `query`, `add`, `commit` etc. to the
+    Session of the calling thread, so it can be shared by all requests.
+    Call `remove()` on it at the end of each request.
+
+    :returns: A SQLAlchemy scoped_session registry.
+    """
+    get_engine(url, **pool_options)
+    return Session
+
+
+def setup_engine():
+    """Returns an engine without a pool for creating and changing tables."""
+    return create_engine(database_url, poolclass=NullPool)
 
 
 def create_all():
     """Adds tables defined above to the database.
 
-    Deletes the database if it already exists and creates a new database in
-    its place. The tables are defined in file as classes that inherit a
-    ``declarative_base()`` instance.
-    :param echo:
+    Tables that already exist are kept. The tables are defined in file as
+    classes that inherit a ``declarative_base()`` instance.
     """
+    engine = setup_engine()
+    Base.metadata.create_all(engine)
+    create_search_index(engine)
+    engine.dispose()
 
-    db_name = database_name
-
-    if use_SQlite:
-        engine = create_engine(sqlite_dbapi + db_name)
-        Base.metadata.create_all(engine)
 
 def drop_all():
     """Deletes all tables from database.
     """
-    db_name = database_name
-    if use_SQlite:
-        engine = create_engine(sqlite_dbapi + db_name)
-        Base.metadata.drop_all(engine)
+    engine = setup_engine()
+    if is_sqlite():
+        engine.execute('DROP TABLE IF EXISTS %s' % search_table)
+    Base.metadata.drop_all(engine)
+    engine.dispose()
 
 
 def create_database():
     """Creates a new empty database.
 
-    Deletes the database if it already exists and creates a new database in
-    its place.
+    Deletes the SQLite database file if it already exists. Other databases
+    have to be created by their administration tools (see pg_config.sh);
+    their tables are dropped instead.
     """
-
-    db_name = database_name
-
-    try:
-        os.remove(db_name)
-    except OSError:
-        pass
-    create_engine(sqlite_dbapi + db_name)
+    if not is_sqlite():
+        drop_all()
+        return
+    path = make_url(database_url).database
+    if path and path != ':memory:':
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def add_column(engine, table, column):
+    """Adds a column of a model to an existing table.
+
+    Args:
+        engine: Engine connected to the database.
+        table: The Table the column belongs to.
+        column: The Column to add.
+    """
+    column_type = column.type.compile(dialect=engine.dialect)
+    with engine.begin() as conn:
+        conn.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s'
+                     % (table.name, column.name, column_type))
+        if column.default is not None:
+            if column.default.is_callable:
+                value = column.default.arg(None)
+            else:
+                value = column.default.arg
+            conn.execute(table.update().values({column.name: value}))
+
+
+def create_search_index(engine):
+    """Creates the full-text search table for movies if it does not exist.
+
+    On SQLite, the table is an FTS5 index over the searchable movie columns,
+    keyed by the movie id. It is filled from the movie table when it is
+    created and kept in sync by `search.py` afterwards. On PostgreSQL, a GIN
+    index over `search_document` is created instead, which the database
+    keeps in sync itself. Other databases are searched without an index.
+
+    Args:
+        engine: Engine connected to the database.
+
+    Returns:
+        True if the table or index was created.
+    """
+    if engine.dialect.name == 'postgresql':
+        if engine.execute(text('SELECT to_regclass(:name)'),
+                          name=search_index).scalar() is not None:
+            return False
+        engine.execute('CREATE INDEX %s ON movie USING gin ((%s))'
+                       % (search_index, search_document))
+        return True
+    if engine.dialect.name != 'sqlite':
+        return False
+    if search_table in inspect(engine).get_table_names():
+        return False
+    with engine.begin() as conn:
+        conn.execute("CREATE VIRTUAL TABLE %s USING fts5(name, director, "
+                     "genre, description, prefix='2 3')" % search_table)
+        conn.execute("INSERT INTO %s (rowid, name, director, genre, "
+                     "description) SELECT id, name, director, genre, "
+                     "coalesce(description, '') FROM movie" % search_table)
+    return True
+
+
+def count_movies(connection, collection_ids=None):
+    """Rebuilds the movie counters of collections from the movie table.
+
+    The collection rows are locked first (on PostgreSQL), so movie changes
+    that are committed later add their counts on top of the rebuilt ones.
+
+    Args:
+        connection: Connection with an open transaction.
+        collection_ids: Ids of the collections to recount; all if None.
+
+    Returns:
+        The number of collections recounted.
+    """
+    collection = Collection.__table__
+    movie = Movie.__table__
+    locked = select([collection.c.id]).with_for_update(key_share=True)
+    rows = select([movie.c.collection_id, movie.c.genre, movie.c.year,
+                   func.count()]).group_by(
+        movie.c.collection_id, movie.c.genre, movie.c.year)
+    if collection_ids is not None:
+        locked = locked.where(collection.c.id.in_(collection_ids))
+        rows = rows.where(movie.c.collection_id.in_(collection_ids))
+    counts = dict((row[0], MovieCounts())
+                  for row in connection.execute(locked))
+    for collection_id, genre, year, n in connection.execute(rows):
+        if collection_id in counts:
+            counts[collection_id].add(genre, year, n)
+    update = collection.update().where(
+        collection.c.id == bindparam('collection_id')).values(
+        movie_count=bindparam('movie_count'),
+        genre_counts=bindparam('genre_counts'),
+        year_counts=bindparam('year_counts'),
+        updated_at=datetime.utcnow())
+    params = []
+    for collection_id, movie_counts in counts.items():
+        values = movie_counts.values()
+        values['collection_id'] = collection_id
+        params.append(values)
+    if params:
+        connection.execute(update, params)
+    return len(params)
+
+
+def migrate():
+    """Brings an existing database up to date with the tables defined above.
+
+    Creates missing tables, adds missing columns and adds every index that
+    is declared on the models but missing in the database. Existing rows are
+    kept, unlike `create_database()`. Added columns are filled with their
+    default value, and the movie counters of the collections are rebuilt
+    when they are added.
+
+    :returns: A list with the names of the created columns and indexes.
+    """
+    created = []
+    engine = setup_engine()
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in columns:
+                add_column(engine, table, column)
+                created.append('%s.%s' % (table.name, column.name))
+        with warnings.catch_warnings():
+            # PostgreSQL cannot reflect the expression index for search.
+            warnings.simplefilter('ignore', SAWarning)
+            existing = set(i['name']
+                           for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+                created.append(index.name)
+    if create_search_index(engine):
+        created.append(search_index if engine.dialect.name == 'postgresql'
+                       else search_table)
+    if 'collection.movie_count' in created:
+        with engine.begin() as conn:
+            count_movies(conn)
+    engine.dispose()
+    return created
 
 
 if __name__ == '__main__':
-    create_database()
-    create_all()
+    import sys
+    if sys.argv[1:] == ['migrate']:
+        # Usage: python database_setup.py migrate
+        for name in migrate():
+            print('Created %s' % name)
+    elif sys.argv[1:2] == ['recount']:
+        # Usage: python database_setup.py recount [collection_id ...]
+        # Rebuilds the movie counters, e.g. after changes made by hand.
+        engine = setup_engine()
+        with engine.begin() as conn:
+            count = count_movies(
+                conn, [int(arg) for arg in sys.argv[2:]] or None)
+        engine.dispose()
+        print('Recounted the movies of %d collections' % count)
+    else:
+        create_database()
+        create_all()
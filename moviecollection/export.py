@@ -0,0 +1,178 @@
+"""Streaming export of the whole movie catalog.
+
+The export reads movies as plain rows in batches (`Query.yield_per`, a
+server-side cursor on PostgreSQL) and turns them into JSON or CSV text
+chunk by chunk, so memory use stays flat regardless of the size of the
+catalog. It is served
+by the `/export` route in `api_JSON_ATOM.py` and can be run from the
+command line:
+
+    python -m moviecollection.export [--format csv|json|ndjson]
+        [--collection ID] [--user ID] [--updated-since TIMESTAMP]
+        [--output FILE]
+"""
+import csv
+import io
+from datetime import datetime
+from moviecollection.database_setup import Movie
+from moviecollection.fastjson import dumps_text
+
+# Number of movies fetched from the database per round trip.
+BATCH_SIZE = 1000
+
+# Columns of an exported movie, in the order of the CSV header.
+EXPORT_FIELDS = ('id', 'name', 'director', 'genre', 'year', 'description',
+                 'collection_id', 'user_id', 'updated_at')
+
+# Formats accepted for the `updated_since` filter.
+TIMESTAMP_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                     '%Y-%m-%d %H:%M:%S', '%Y-%m-%d')
+
+
+def parse_timestamp(value):
+    """ Parses an ISO 8601 timestamp (UTC) as used by the export filters.
+
+    Args:
+        value: Timestamp such as '2016-09-15T12:00:00' or '2016-09-15'.
+
+    Returns:
+        A datetime instance.
+
+    Raises:
+        ValueError: The value does not match any of TIMESTAMP_FORMATS.
+    """
+    value = value.rstrip('Z')
+    for timestamp_format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, timestamp_format)
+        except ValueError:
+            pass
+    raise ValueError('Invalid timestamp: %s' % value)
+
+
+def export_row(movie):
+    """ Returns the exported fields of a movie row as a dictionary. """
+    row = dict(zip(EXPORT_FIELDS, movie))
+    if row['updated_at'] is not None:
+        row['updated_at'] = row['updated_at'].isoformat()
+    return row
+
+
+def iter_movies(session, collection_id=None, user_id=None,
+                updated_since=None, batch_size=BATCH_SIZE):
+    """ Yields the EXPORT_FIELDS of the movies in batches, ordered by id.
+
+    Args:
+        session: Session used to query the database.
+        collection_id: Only export movies of this collection.
+        user_id: Only export movies created by this user.
+        updated_since: Only export movies changed at or after this datetime.
+        batch_size: Number of movies loaded per round trip.
+    """
+    query = session.query(*[getattr(Movie, name) for name in EXPORT_FIELDS])
+    if collection_id is not None:
+        query = query.filter(Movie.collection_id == collection_id)
+    if user_id is not None:
+        query = query.filter(Movie.user_id == user_id)
+    if updated_since is not None:
+        query = query.filter(Movie.updated_at >= updated_since)
+    # A server-side cursor on PostgreSQL; SQLite reads rows lazily anyway.
+    return query.order_by(Movie.id).execution_options(
+        stream_results=True).yield_per(batch_size)
+
+
+def encode_batches(movies, batch_size=BATCH_SIZE):
+    """ Yields lists of up to `batch_size` movies encoded as JSON objects.
+
+    The encoded objects may contain characters that str.splitlines()
+    treats as line breaks, e.g. U+0085 and U+2028, so they are joined as
+    they are instead of being split out of a chunk again.
+    """
+    objects = []
+    for movie in movies:
+        objects.append(dumps_text(export_row(movie)))
+        if len(objects) >= batch_size:
+            yield objects
+            objects = []
+    if objects:
+        yield objects
+
+
+def generate_ndjson(movies, batch_size=BATCH_SIZE):
+    """ Yields newline-delimited JSON, one movie per line.
+
+    Lines are joined into chunks of `batch_size` movies.
+    """
+    for objects in encode_batches(movies, batch_size):
+        yield '\n'.join(objects) + '\n'
+
+
+def generate_json(movies, batch_size=BATCH_SIZE):
+    """ Yields a JSON document {"Movies": [...]} in chunks.
+
+    The document has the same shape as the response of `collectionJSON`.
+    """
+    yield '{"Movies": ['
+    separator = ''
+    for objects in encode_batches(movies, batch_size):
+        yield separator + ','.join(objects)
+        separator = ','
+    yield ']}\n'
+
+
+def generate_csv(movies, batch_size=BATCH_SIZE):
+    """ Yields CSV with a header line and one movie per line.
+
+    The columns are EXPORT_FIELDS; empty values are written as ''.
+    """
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, EXPORT_FIELDS, lineterminator='\n')
+    writer.writeheader()
+    for count, movie in enumerate(movies, 1):
+        writer.writerow(export_row(movie))
+        if count % batch_size == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+
+GENERATORS = {
+    'csv': generate_csv,
+    'json': generate_json,
+    'ndjson': generate_ndjson,
+}
+
+MIMETYPES = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def main(argv=None):
+    import argparse
+    import sys
+    from moviecollection import app
+
+    parser = argparse.ArgumentParser(description='Export the movie catalog.')
+    parser.add_argument('--format', choices=sorted(GENERATORS),
+                        default='json')
+    parser.add_argument('--collection', type=int, dest='collection_id')
+    parser.add_argument('--user', type=int, dest='user_id')
+    parser.add_argument('--updated-since', type=parse_timestamp)
+    parser.add_argument('--output', type=argparse.FileType('w'),
+                        default=sys.stdout)
+    args = parser.parse_args(argv)
+
+    app.start_session()
+    movies = iter_movies(app.session, collection_id=args.collection_id,
+                         user_id=args.user_id,
+                         updated_since=args.updated_since)
+    for chunk in GENERATORS[args.format](movies):
+        args.output.write(chunk)
+    app.session.remove()
+
+
+if __name__ == '__main__':
+    main()
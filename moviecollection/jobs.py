@@ -0,0 +1,312 @@
+"""Background jobs for slow side effects of the write views.
+
+Views queue a job with `enqueue()` in the same transaction as their own
+changes, so a job exists exactly when the change was committed. Jobs are
+stored in the `job` table and run by a pool of worker threads, started
+with `start_workers()`, or by a separate worker process:
+
+    python -m moviecollection.jobs work      # run a worker in the foreground
+    python -m moviecollection.jobs status    # queue depth by status and kind
+    python -m moviecollection.jobs retry     # queue dead jobs again
+
+A failing job is retried with exponential backoff. After `max_attempts`
+failures it is marked 'dead' and stays in the table for inspection. Done
+jobs are deleted by the workers after KEEP_DONE:
+
+    python -m moviecollection.jobs prune     # delete old done jobs now
+"""
+import json
+import os
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session as OrmSession
+from moviecollection import app
+from moviecollection import cache
+from moviecollection import database_setup as db_setup
+from moviecollection import search
+from moviecollection import thumbnails
+from moviecollection.database_setup import Job, Movie
+
+# Seconds a worker waits for new jobs before it looks into the table again.
+POLL_INTERVAL = 1.0
+
+# Delay before the first retry of a failed job; doubled for each attempt.
+RETRY_DELAY = 5  # seconds
+
+# Running jobs not finished after this time are assumed to be abandoned by
+# a worker that died, and are queued again.
+STALE_AFTER = timedelta(minutes=10)
+
+# Done jobs are deleted after this time; idle workers look for them every
+# PRUNE_INTERVAL seconds.
+KEEP_DONE = timedelta(days=1)
+PRUNE_INTERVAL = 3600
+
+# Movies deleted per transaction when a collection is deleted.
+DELETE_BATCH = 500
+
+HANDLERS = {}
+
+_wakeup = threading.Event()
+_workers = []
+_stopping = threading.Event()
+
+
+def handler(kind):
+    """ Decorator registering a function as the handler for a job kind. """
+    def decorator(f):
+        HANDLERS[kind] = f
+        return f
+    return decorator
+
+
+def enqueue(session, kind, run_after=None, **payload):
+    """ Adds a job to the session; it is queued when the session commits.
+
+    Args:
+        session: Session of the change that needs the job.
+        kind: Name of a registered handler.
+        run_after: UTC time before which the job is not started.
+        payload: JSON serializable keyword arguments for the handler.
+    """
+    if kind not in HANDLERS:
+        raise ValueError('Unknown job kind: %s' % kind)
+    session.add(Job(kind=kind, payload=json.dumps(payload, sort_keys=True),
+                    run_after=run_after or datetime.utcnow()))
+    session.info['jobs_queued'] = True
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def wake_workers(session):
+    """ Wakes the workers once the jobs of a session are committed; before,
+    they cannot see them.
+    """
+    if session.info.pop('jobs_queued', False):
+        _wakeup.set()
+
+
+@event.listens_for(OrmSession, 'after_rollback')
+def forget_jobs(session):
+    session.info.pop('jobs_queued', None)
+
+
+##############################################################################
+# Handlers
+##############################################################################
+@handler('thumbnails')
+def create_thumbnails(path, collection_id=None):
+    """ Creates the thumbnails of an uploaded cover. """
+    thumbnails.create_thumbnails(path)
+    if collection_id is not None:
+        # Cached pages still point at the original image.
+        cache.invalidate('collection:%d' % collection_id)
+
+
+@handler('remove_file')
+def remove_file(path):
+    """ Deletes an uploaded cover and its thumbnails. """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+    thumbnails.remove_thumbnails(path)
+
+
+@handler('delete_collection')
+def delete_collection(collection_id):
+    """ Deletes the movies of a deleted collection and their cover files. """
+    # Imported here, as the storage module registers its own handlers.
+    from moviecollection import storage
+    session = db_setup.Session()
+    while True:
+        movies = session.query(Movie).filter_by(
+            collection_id=collection_id).limit(DELETE_BATCH).all()
+        if not movies:
+            break
+        for movie in movies:
+            if movie.cover_source == 'local':
+                storage.release(session, movie.cover_image)
+            search.unindex_movie(session, movie.id)
+            session.delete(movie)
+        session.commit()
+
+
+##############################################################################
+# Workers
+##############################################################################
+def claim(session):
+    """ Marks the oldest due job as running and returns it, or None.
+
+    The job is only claimed if no other worker changed its status first, so
+    several worker processes can share the job table.
+    """
+    now = datetime.utcnow()
+    while True:
+        job = session.query(Job).filter(
+            Job.status == 'pending', Job.run_after <= now).order_by(
+            Job.id).first()
+        if job is None:
+            return None
+        claimed = session.query(Job).filter(
+            Job.id == job.id, Job.status == 'pending').update(
+            {Job.status: 'running', Job.attempts: Job.attempts + 1,
+             Job.updated_at: now}, synchronize_session=False)
+        session.commit()
+        if claimed:
+            session.refresh(job)
+            return job
+
+
+def run(session, job):
+    """ Runs a claimed job and records its result. """
+    try:
+        HANDLERS[job.kind](**json.loads(job.payload))
+    except Exception:
+        session.rollback()
+        job.last_error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.status = 'dead'
+        else:
+            job.status = 'pending'
+            job.run_after = datetime.utcnow() + timedelta(
+                seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+    else:
+        job.status = 'done'
+    session.commit()
+
+
+def work(stop=None, burst=False):
+    """ Runs jobs until `stop` is set.
+
+    Args:
+        stop: threading.Event ending the loop; defaults to `stop_workers()`.
+        burst: Return as soon as no job is due, instead of waiting.
+    """
+    stop = stop or _stopping
+    pruned_at = 0
+    while not stop.is_set():
+        session = db_setup.Session()
+        job = None
+        try:
+            job = claim(session)
+            if job is not None:
+                run(session, job)
+            elif time.time() - pruned_at > PRUNE_INTERVAL:
+                pruned_at = time.time()
+                prune_done(session)
+        except Exception:
+            # Keep the worker alive if the database is unavailable.
+            app.logger.exception('Background job worker failed')
+        finally:
+            db_setup.Session.remove()
+        if job is None:
+            if burst:
+                return
+            _wakeup.wait(POLL_INTERVAL)
+            _wakeup.clear()
+
+
+def requeue_stale(session):
+    """ Queues running jobs again that a dead worker left behind. """
+    count = session.query(Job).filter(
+        Job.status == 'running',
+        Job.updated_at < datetime.utcnow() - STALE_AFTER).update(
+        {Job.status: 'pending'}, synchronize_session=False)
+    session.commit()
+    return count
+
+
+def prune_done(session, keep=KEEP_DONE):
+    """ Deletes the jobs that were done longer than `keep` ago.
+
+    Returns:
+        The number of deleted jobs.
+    """
+    count = session.query(Job).filter(
+        Job.status == 'done',
+        Job.updated_at < datetime.utcnow() - keep).delete(
+        synchronize_session=False)
+    session.commit()
+    return count
+
+
+def start_workers(count=2):
+    """ Starts a pool of daemon threads running jobs in this process. """
+    session = db_setup.Session()
+    requeue_stale(session)
+    db_setup.Session.remove()
+    _stopping.clear()
+    for _ in range(count):
+        worker = threading.Thread(target=work, name='job-worker')
+        worker.daemon = True
+        worker.start()
+        _workers.append(worker)
+
+
+def stop_workers(timeout=None):
+    """ Stops the worker threads after their current job. """
+    _stopping.set()
+    _wakeup.set()
+    while _workers:
+        _workers.pop().join(timeout)
+
+
+##############################################################################
+# Inspection
+##############################################################################
+def is_queued(session, kind, **payload):
+    """ Returns True if a job with this kind and payload is pending. """
+    return session.query(Job.id).filter(
+        Job.kind == kind, Job.status == 'pending',
+        Job.payload == json.dumps(payload, sort_keys=True)).first() is not None
+
+
+def queue_depth(session):
+    """ Returns the number of jobs per (status, kind). """
+    rows = session.query(Job.status, Job.kind, func.count(Job.id)).group_by(
+        Job.status, Job.kind).order_by(Job.status, Job.kind)
+    return [(status, kind, count) for status, kind, count in rows]
+
+
+def retry_dead(session):
+    """ Queues all dead jobs again with a fresh number of attempts. """
+    count = session.query(Job).filter(Job.status == 'dead').update(
+        {Job.status: 'pending', Job.attempts: 0,
+         Job.run_after: datetime.utcnow()}, synchronize_session=False)
+    session.commit()
+    return count
+
+
+def main(argv):
+    app.start_session()
+    session = app.session
+    command = argv[1] if len(argv) > 1 else 'status'
+    if command == 'status':
+        print('%-8s %-20s %8s' % ('status', 'kind', 'jobs'))
+        for status, kind, count in queue_depth(session):
+            print('%-8s %-20s %8d' % (status, kind, count))
+    elif command == 'retry':
+        print('Queued %d dead jobs again.' % retry_dead(session))
+    elif command == 'prune':
+        print('Deleted %d done jobs.' % prune_done(session))
+    elif command == 'work':
+        requeue_stale(session)
+        try:
+            work()
+        except KeyboardInterrupt:
+            pass
+    else:
+        print('Usage: python -m moviecollection.jobs '
+              '[status|retry|prune|work]')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    import sys
+    # Run the imported module, which holds the handlers of all modules.
+    from moviecollection import jobs
+    sys.exit(jobs.main(sys.argv))
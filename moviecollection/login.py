@@ -1,16 +1,34 @@
+import hashlib
 import requests
 import string
 import random
 import json
-import httplib2
+import time
 from flask import request, flash, jsonify, render_template, redirect, url_for, make_response
 from flask import session as login_session
 from flask_sqlalchemy import xrange
 from oauth2client.client import flow_from_clientsecrets, FlowExchangeError
 from flask_seasurf import SeaSurf
 from moviecollection import app
+from moviecollection import outbound
+from moviecollection.cache import MemoryCache
 from moviecollection.database_setup import User
 
+# User ids by e-mail address, so that repeated logins do not look the user
+# up again. Only found users are kept: the caches of the other worker
+# processes would not learn about a new user.
+USER_ID_TTL = 3600  # seconds
+user_ids = MemoryCache(ttl=USER_ID_TTL, max_entries=10000)
+
+# Google token info that passed the checks in gconnect(), by hash of the
+# Google+ user id and the access token, so that logging in again with the
+# same token skips the tokeninfo call. Entries are dropped when the token
+# expires or is revoked by gdisconnect(). Each code exchange hands out a
+# new token, and each worker process has its own cache, so this rarely
+# hits: only when a client repeats a login within the token's lifetime.
+TOKEN_INFO_TTL = 300  # seconds
+verified_tokens = MemoryCache(ttl=TOKEN_INFO_TTL, max_entries=1000)
+
 ##############################################################################
 # User Helper funtion:
 ###############################################################################
@@ -30,9 +48,13 @@ def createUser(login_session):
                    email=login_session['email'],
                    picture=login_session['picture'])
     app.session.add(newUser)
+    # The id is known after the flush; after the commit, reading it would
+    # load the user again.
+    app.session.flush()
+    user_id = newUser.id
     app.session.commit()
-    user = app.session.query(User).filter_by(email=login_session['email']).one()
-    return user.id
+    user_ids.set(login_session['email'], user_id)
+    return user_id
 
 
 def getUserInfo(user_id):
@@ -60,16 +82,53 @@ def getUserID(email):
 
     Returns:
         If successful, the user id to the given e-mail address, otherwise
-            nothing.
+            nothing. Found ids are cached in `user_ids`.
     """
 
-    user = app.session.query(User).filter_by(email=email).one()
+    user_id = user_ids.get(email)
+    if user_id is not None:
+        return user_id
+    user = app.session.query(User.id).filter_by(email=email).first()
 
     if user:
+        user_ids.set(email, user.id)
         return user.id
     else:
         return None
 
+
+def token_key(gplus_id, access_token):
+    """ Returns the key of a user's access token in `verified_tokens`. """
+    key = '%s:%s' % (gplus_id, access_token)
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return hashlib.sha256(key).hexdigest()
+
+
+def get_verified_token(gplus_id, access_token):
+    """ Returns the cached token info of a checked access token, or None.
+    """
+    entry = verified_tokens.get(token_key(gplus_id, access_token))
+    if entry is None:
+        return None
+    expires, result = entry
+    if expires < time.time():
+        return None
+    return result
+
+
+def remember_verified_token(gplus_id, access_token, result):
+    """ Caches the token info of an access token that passed the checks,
+    until the token expires.
+    """
+    expires = time.time() + int(result.get('expires_in', TOKEN_INFO_TTL))
+    verified_tokens.set(token_key(gplus_id, access_token), (expires, result))
+
+
+def forget_verified_token(gplus_id, access_token):
+    """ Drops the token info of a revoked access token. """
+    verified_tokens.delete(token_key(gplus_id, access_token))
+
 ##############################################################################
 # CSRF: for preventing cross-site request forgery
 ##############################################################################
@@ -84,6 +143,12 @@ app_token = json.loads(
     open('g_client_secret.json', 'r').read())['web']['client_id']
 APPLICATION_NAME = "Movie Collection App"
 
+# Endpoints of the providers. The login benchmark points them at a stub.
+GOOGLE_TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+GOOGLE_USERINFO_URL = 'https://www.googleapis.com/oauth2/v1/userinfo'
+GOOGLE_REVOKE_URL = 'https://accounts.google.com/o/oauth2/revoke'
+FACEBOOK_GRAPH_URL = 'https://graph.facebook.com'
+
 app_id = json.loads(
     open('fb_client_secret.json', 'r').read()) ['web']['app_id']
 
@@ -125,27 +190,49 @@ def gconnect():
         oauth_flow = flow_from_clientsecrets('g_client_secret.json', scope='')
         oauth_flow.redirect_uri = 'postmessage'
         # Exchange code for credentials object with token
-        credentials = oauth_flow.step2_exchange(code)
+        with outbound.httplib2_http() as http:
+            credentials = oauth_flow.step2_exchange(code, http=http)
     except FlowExchangeError:
         return jsonify(message='Failed to upgrade authorization code'), 401
 
-    # Check that access token is valid
+    # Check that access token is valid, unless it was checked before, and
+    # get the user info at the same time. The user info is only used once
+    # the token has been checked.
     access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token={}'
-           .format(access_token))
-    result = requests.get(url).json()
+    gplus_id = credentials.id_token['sub']
+    calls = [lambda: outbound.get(GOOGLE_USERINFO_URL, params={
+        'access_token': access_token, 'alt': 'json'}).json()]
+    result = get_verified_token(gplus_id, access_token)
+    if result is None:
+        calls.append(lambda: outbound.get(GOOGLE_TOKENINFO_URL, params={
+            'access_token': access_token}).json())
+    try:
+        responses = outbound.concurrently(*calls)
+    except (requests.RequestException, ValueError):
+        return jsonify(message='Failed to reach Google'), 502
+    data = responses[0]
+    verified = result is not None
+    if not verified:
+        result = responses[1]
     # Abort if error.
     if result.get('error') is not None:
         return jsonify(message=result.get('error')), 500
 
     # Verify that the access token is used for the intended user.
-    gplus_id = credentials.id_token['sub']
     if result['user_id'] != gplus_id:
         return jsonify(message="Token's user ID doesn't match login."), 401
 
     # Verify that the access token is valid for this app.
     if result['issued_to'] != app_token:
         return jsonify(message="Token's client ID does not match app's."), 401
+    # A cached token may have been revoked since, e.g. from the Google
+    # account page; then only the user info call notices.
+    if data.get('error') is not None or not all(
+            key in data for key in ('name', 'picture', 'email')):
+        forget_verified_token(gplus_id, access_token)
+        return jsonify(message='Failed to get the user info.'), 401
+    if not verified:
+        remember_verified_token(gplus_id, access_token, result)
 
     # Verify if user is already logged in.
     stored_credentials = login_session.get('access_token')
@@ -161,11 +248,6 @@ def gconnect():
     login_session['access_token'] = credentials.access_token
     login_session['gplus_id'] = gplus_id
 
-    # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    data = requests.get(userinfo_url, params=params).json()
-
     login_session['username'] = data['name']
     login_session['picture'] = data['picture']
     login_session['email'] = data['email']
@@ -199,9 +281,15 @@ def gdisconnect():
         login_session.clear()
         return jsonify(error='Current user not connected.'), 401
 
-    url = ('https://accounts.google.com/o/oauth2/revoke?token={}'.format(access_token))
-    result = requests.get(url)
-
+    try:
+        result = outbound.get(GOOGLE_REVOKE_URL,
+                              params={'token': access_token})
+    except requests.RequestException:
+        return jsonify(error='Failed to reach Google.'), 502
+
+    # Whether revoked now or invalid before, the token must not be trusted
+    # again.
+    forget_verified_token(login_session.get('gplus_id'), access_token)
     if result.status_code == 200:
         # Reset the user's sesson.
         login_session.clear()
@@ -241,43 +329,41 @@ def fbconnect():
     # Exchange client token for long-lived server-side token with GET
     # /oauth/access_token?grant_type=fb_exchange_token&client_id={app-id}
     # &client_secret={app-secret}&fb_exchange_token={short-lived-token}.
-    access_token = request.data
-    url = ("https://graph.facebook.com/oauth/access_token?grant_type="
-           "fb_exchange_token&client_id=%s&client_secret=%s&fb_exchange_token="
-           "%s" % (app_id, app_secret, access_token))
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-
-    # Use token to get user info from API
-    # not used: userinfo_url = "https://graph.facebook.com/v2.2/me"
-
-    # The long-lived token includes an expires-field that indicates how long
-    # this token is valid. Longterm tokens can last up to two months.
-    # Strip expire tag from access token since it is not needed to make API
-    # calls.
-    token = result.split("&")[0]
-
-    # If the token works API calls should be possible like in the following.
-    url = 'https://graph.facebook.com/v2.5/me?%s&fields=name,id,email'% token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-
-    data = json.loads(result)
+    access_token = request.get_data(as_text=True)
+    try:
+        result = outbound.get(FACEBOOK_GRAPH_URL + '/oauth/access_token',
+                              params={'grant_type': 'fb_exchange_token',
+                                      'client_id': app_id,
+                                      'client_secret': app_secret,
+                                      'fb_exchange_token': access_token})
+
+        # Use token to get user info from API
+        # not used: userinfo_url = "https://graph.facebook.com/v2.2/me"
+
+        # The long-lived token includes an expires-field that indicates how
+        # long this token is valid. Longterm tokens can last up to two
+        # months. Strip expire tag from access token since it is not needed
+        # to make API calls.
+        token = result.text.split("&")[0]
+
+        # Facebook uses a separate API call to retrieve a profile picture.
+        # Both calls only need the token, so they are made at the same time.
+        data, picture = outbound.concurrently(
+            lambda: outbound.get('%s/v2.5/me?%s&fields=name,id,email' % (
+                FACEBOOK_GRAPH_URL, token)).json(),
+            lambda: outbound.get('%s/v2.5/me/picture?%s&redirect=0&'
+                                 'height=200&width=200' % (
+                                     FACEBOOK_GRAPH_URL, token)).json())
+    except (requests.RequestException, ValueError):
+        return jsonify(message='Failed to reach Facebook'), 502
+
     # Populate the login session.
     login_session['provider'] = 'facebook'
     login_session['username'] = data["name"]
     login_session['email'] = data["email"]
     login_session['facebook_id'] = data["id"]
-
-    # Facebook uses a separate API call to retrieve a profile picture. So this
-    # call is made separetely. The login_session is then populated with the url
-    # for the users profile picture.
-    url = ('https://graph.facebook.com/v2.5/me/picture?%s&redirect=0&'
-           'height=200&width=200' % token)
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[1]
-    data = json.loads(result)
-    login_session['picture'] = data["data"]["url"]
+    # The url of the users profile picture.
+    login_session['picture'] = picture["data"]["url"]
 
     # Get user id from database or add new user.
     user_id = getUserID(login_session['email'])
@@ -302,8 +388,11 @@ def fbconnect():
 @app.route('/fbdisconnect')
 def fbdisconnect():
     facebook_id = login_session['facebook_id']
-    url = 'https://graph.facebook.com/%s/permissions' % facebook_id
-    result = requests.get(url, 'DELETE').json()
+    url = '%s/%s/permissions' % (FACEBOOK_GRAPH_URL, facebook_id)
+    try:
+        result = outbound.delete(url)
+    except requests.RequestException:
+        return jsonify(error='Failed to reach Facebook.'), 502
     if result.status_code == 200:
         # Reset the user's sesson.
         login_session.clear()
@@ -322,6 +411,8 @@ def disconnect():
 
     if 'provider' in login_session:
         if login_session['provider'] == 'google':
+            forget_verified_token(login_session.get('gplus_id'),
+                                  login_session.get('access_token'))
             del login_session['gplus_id']
             del login_session['access_token']
         if login_session['provider'] == 'facebook':
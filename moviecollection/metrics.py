@@ -0,0 +1,394 @@
+"""Opt-in instrumentation of requests, SQL statements and templates.
+
+Set METRICS = True in the app config before `app.start_session()` to turn
+it on. The app then records, per worker process:
+
+    moviecollection_requests_total: requests by view, method and status.
+    moviecollection_request_duration_seconds: latency histogram by view
+        and method, including the streaming of the response body.
+    moviecollection_request_sql_statements: histogram of the number of
+        SQL statements per request, by view.
+    moviecollection_sql_duration_seconds: histogram of the duration of
+        SQL statements by view ('-' outside of requests, e.g. in jobs).
+    moviecollection_slow_queries_total: statements that took at least
+        SLOW_QUERY_SECONDS, by view.
+    moviecollection_template_render_seconds: histogram of the render time
+        by template, including streamed templates.
+
+plus the hits and misses of the response cache and the connections in use
+per pool. `/metrics` serves them in the Prometheus text format, only to
+requests from the local machine. The counters are not aggregated across
+the worker processes of `server.py`: each request to `/metrics` is
+answered by whichever worker accepts it, with that worker's counters
+since it started. Run a single worker (--workers 1) for complete numbers,
+or treat a scrape as a sample of one worker.
+
+Slow statements are also logged to the 'moviecollection.slow_queries'
+logger with their parameters and view. With PROFILE_SAMPLE_RATE between
+0 and 1, that share of the requests runs under cProfile, and the stats are
+written to PROFILE_DIR as '<view>-<milliseconds>-<pid>.prof', to be read
+with pstats.
+"""
+import bisect
+import cProfile
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from flask import Response, abort, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from moviecollection import app
+from moviecollection import database_setup as db_setup
+from moviecollection.cache import response_cache
+
+# Default settings, overridden by the config keys of the same name.
+SLOW_QUERY_SECONDS = 0.5
+PROFILE_SAMPLE_RATE = 0
+PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'moviecollection-profiles')
+
+# Upper bounds of the buckets of the duration histograms, in seconds.
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                    0.5, 1, 2.5, 5, 10)
+
+# Upper bounds of the buckets of the statements per request histogram.
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Parameters longer than this are cut in the slow-query log (characters).
+MAX_LOGGED_PARAMETERS = 1000
+
+# Addresses allowed to read `/metrics` and `/cache/JSON`.
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+slow_query_log = logging.getLogger('moviecollection.slow_queries')
+
+# Set by `install()`.
+enabled = False
+slow_query_seconds = SLOW_QUERY_SECONDS
+profile_sample_rate = PROFILE_SAMPLE_RATE
+profile_dir = PROFILE_DIR
+
+
+##############################################################################
+# Metric types
+##############################################################################
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+class Counter(object):
+    """ Counts by label values, e.g. requests by view. """
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = (
+                self._values.get(label_values, 0) + amount)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, list(zip(self.labels, label_values)), value
+
+
+class Histogram(object):
+    """ Distribution of observed values by label values. """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        # Label values: [count per bucket, sum, count].
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        # Index of the first bucket whose upper bound is >= value.
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [
+                    [0] * len(self.buckets), 0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted((label_values, (list(counts), total, count))
+                            for label_values, (counts, total, count)
+                            in self._values.items())
+        for label_values, (counts, total, count) in values:
+            labels = list(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield (self.name + '_bucket',
+                       labels + [('le', format_value(float(bound)))],
+                       cumulative)
+            yield self.name + '_bucket', labels + [('le', '+Inf')], count
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, count
+
+
+class Callback(object):
+    """ Metric read from a function when it is exported.
+
+    The function returns a list of (label values, value).
+    """
+
+    def __init__(self, name, description, kind, labels, function):
+        self.name = name
+        self.description = description
+        self.kind = kind
+        self.labels = labels
+        self.function = function
+
+    def samples(self):
+        for label_values, value in self.function():
+            yield self.name, list(zip(self.labels, label_values)), value
+
+
+def pool_connections():
+    """ Returns the connections in use per pool, see `get_engine()`. """
+    engines = [('primary', db_setup.engine)]
+    if db_setup.replicas is not None:
+        engines.extend(('replica%d' % n, replica) for n, replica
+                       in enumerate(db_setup.replicas.engines))
+    return [((name,), engine.pool.checkedout()) for name, engine in engines
+            if engine is not None and hasattr(engine.pool, 'checkedout')]
+
+
+requests = Counter('moviecollection_requests_total',
+                   'Requests by view, method and status.',
+                   ('view', 'method', 'status'))
+request_duration = Histogram('moviecollection_request_duration_seconds',
+                             'Request latency by view and method.',
+                             ('view', 'method'))
+request_statements = Histogram('moviecollection_request_sql_statements',
+                               'SQL statements per request by view.',
+                               ('view',), STATEMENT_BUCKETS)
+sql_duration = Histogram('moviecollection_sql_duration_seconds',
+                         'SQL statement duration by view.', ('view',))
+slow_queries = Counter('moviecollection_slow_queries_total',
+                       'SQL statements slower than SLOW_QUERY_SECONDS.',
+                       ('view',))
+template_duration = Histogram('moviecollection_template_render_seconds',
+                              'Template render time by template.',
+                              ('template',))
+
+registry = [
+    requests, request_duration, request_statements, sql_duration,
+    slow_queries, template_duration,
+    Callback('moviecollection_cache_hits_total', 'Response cache hits.',
+             'counter', (), lambda: [((), response_cache.hits)]),
+    Callback('moviecollection_cache_misses_total', 'Response cache misses.',
+             'counter', (), lambda: [((), response_cache.misses)]),
+    Callback('moviecollection_db_connections_in_use',
+             'Database connections checked out of each pool.', 'gauge',
+             ('pool',), pool_connections),
+]
+
+
+def render():
+    """ Returns all metrics in the Prometheus text format. """
+    lines = []
+    for metric in registry:
+        lines.append('# HELP %s %s' % (metric.name, metric.description))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for name, labels, value in metric.samples():
+            lines.append('%s%s %s' % (name, format_labels(labels),
+                                      format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+##############################################################################
+# Collection
+##############################################################################
+class RequestStats(object):
+    """ Measurements of the current request, kept in `g`. """
+
+    def __init__(self):
+        self.start = time.time()
+        self.statements = 0
+        self.status = None
+        self.profiler = None
+
+
+def current_view():
+    """ Returns the view of the current request, or '-' outside one. """
+    if not has_request_context():
+        return '-'
+    return request.endpoint or 'unmatched'
+
+
+@app.before_request
+def start_request():
+    if not enabled:
+        return
+    stats = g.request_stats = RequestStats()
+    if profile_sample_rate and random.random() < profile_sample_rate:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active (Python 3.12+ allows only one).
+            return
+        stats.profiler = profiler
+
+
+@app.after_request
+def note_status(response):
+    stats = g.get('request_stats')
+    if stats is not None:
+        stats.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request(exception=None):
+    """ Records the request once its response has been sent.
+
+    Streamed responses keep the request context until the stream ends.
+    """
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return
+    duration = time.time() - stats.start
+    view = current_view()
+    status = stats.status or 500
+    requests.inc((view, request.method, str(status)))
+    request_duration.observe((view, request.method), duration)
+    request_statements.observe((view,), stats.statements)
+    if stats.profiler is not None:
+        stats.profiler.disable()
+        stats.profiler.dump_stats(os.path.join(
+            profile_dir, '%s-%d-%d.prof' % (view, stats.start * 1000,
+                                            os.getpid())))
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if context is not None:
+        context.metrics_start = time.time()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = getattr(context, 'metrics_start', None)
+    if start is None:
+        return
+    duration = time.time() - start
+    view = current_view()
+    if view != '-':
+        stats = g.get('request_stats')
+        if stats is not None:
+            stats.statements += 1
+    sql_duration.observe((view,), duration)
+    if slow_query_seconds is not None and duration >= slow_query_seconds:
+        slow_queries.inc((view,))
+        logged = repr(parameters)
+        if len(logged) > MAX_LOGGED_PARAMETERS:
+            logged = logged[:MAX_LOGGED_PARAMETERS] + '...'
+        slow_query_log.warning('%.3f s in %s: %s -- parameters: %s',
+                               duration, view, statement, logged)
+
+
+class TimedTemplate(Template):
+    """ Template recording the time it takes to render.
+
+    Streamed templates (`stream()` and `generate()`) record the time spent
+    producing their pieces, without the time the client takes to read them.
+    """
+
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            template_duration.observe((self.name or '-',),
+                                      time.time() - start)
+
+    def generate(self, *args, **kwargs):
+        pieces = Template.generate(self, *args, **kwargs)
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.time()
+                try:
+                    piece = next(pieces)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.time() - start
+                yield piece
+        finally:
+            # Also recorded if the client goes away before the end.
+            pieces.close()
+            template_duration.observe((self.name or '-',), elapsed)
+
+
+def install():
+    """ Turns the instrumentation on if the app config asks for it.
+
+    Called by `app.start_session()`. Templates loaded before are not timed.
+    """
+    global enabled, slow_query_seconds, profile_sample_rate, profile_dir
+    if enabled or not app.config.get('METRICS'):
+        return
+    slow_query_seconds = app.config.get('SLOW_QUERY_SECONDS',
+                                        SLOW_QUERY_SECONDS)
+    profile_sample_rate = app.config.get('PROFILE_SAMPLE_RATE',
+                                         PROFILE_SAMPLE_RATE)
+    profile_dir = app.config.get('PROFILE_DIR', PROFILE_DIR)
+    if profile_sample_rate and not os.path.isdir(profile_dir):
+        os.makedirs(profile_dir)
+    # Listening on the class covers the primary and all replica engines.
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    app.jinja_env.template_class = TimedTemplate
+    enabled = True
+
+
+##############################################################################
+# Export
+##############################################################################
+@app.route('/metrics')
+def metricsText():
+    """ Returns the metrics in the Prometheus text format.
+
+    Only answered for requests from the local machine while the
+    instrumentation is on; 404 otherwise.
+    """
+    if not enabled or request.remote_addr not in LOCAL_ADDRESSES:
+        abort(404)
+    return Response(render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,142 @@
+"""HTTP calls of the app to other servers, e.g. the OAuth providers.
+
+All calls go through one `requests` session per process, whose pool keeps
+the connections to each host open between logins, so a login does not pay
+for new TCP and TLS handshakes. Every call has a connect and a read
+timeout, and failed connections and 502/503/504 answers to idempotent
+requests are retried with a short backoff:
+
+    response = outbound.get('https://www.googleapis.com/oauth2/v1/userinfo',
+                            params={'access_token': token})
+
+Calls that do not depend on each other run at the same time with
+`concurrently()`. oauth2client speaks httplib2 instead of requests; its
+`Http` objects are reused through `httplib2_http()`.
+"""
+import sys
+import threading
+from contextlib import contextmanager
+import httplib2
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from queue import Empty, Full, LifoQueue
+except ImportError:  # Python 2
+    from Queue import Empty, Full, LifoQueue
+
+# Seconds to wait for a connection and for each read of the answer.
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+
+# Retries of failed connections and of answers with RETRY_STATUSES. The
+# n-th retry waits BACKOFF_FACTOR * 2 ** (n - 1) seconds.
+RETRIES = 2
+BACKOFF_FACTOR = 0.2
+RETRY_STATUSES = (502, 503, 504)
+
+# Open connections kept per host, at least the threads of a worker.
+POOL_SIZE = 10
+
+_session = None
+_session_lock = threading.Lock()
+_idle_http = LifoQueue(POOL_SIZE)
+
+
+def session():
+    """ Returns the shared `requests` session of this process. """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                retry = Retry(total=RETRIES, backoff_factor=BACKOFF_FACTOR,
+                              status_forcelist=RETRY_STATUSES,
+                              raise_on_status=False)
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE,
+                                      pool_maxsize=POOL_SIZE,
+                                      max_retries=retry)
+                new_session = requests.Session()
+                new_session.mount('https://', adapter)
+                new_session.mount('http://', adapter)
+                _session = new_session
+    return _session
+
+
+def get(url, **kwargs):
+    """ Sends a GET request through the shared session.
+
+    Args:
+        url: URL of the request.
+        kwargs: Further arguments of `requests.get`, e.g. params.
+
+    Returns:
+        A requests.Response.
+
+    Raises:
+        requests.RequestException: The request failed or timed out.
+    """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return session().get(url, **kwargs)
+
+
+def delete(url, **kwargs):
+    """ Sends a DELETE request through the shared session, like `get()`. """
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+    return session().delete(url, **kwargs)
+
+
+@contextmanager
+def httplib2_http():
+    """ Lends an `httplib2.Http` with open connections, e.g. for
+    oauth2client's `step2_exchange(code, http=...)`.
+
+    An Http object must not be used by two threads at once, so each is
+    lent to one caller at a time and kept for the next one afterwards.
+    """
+    try:
+        http = _idle_http.get_nowait()
+    except Empty:
+        http = httplib2.Http(timeout=READ_TIMEOUT)
+    try:
+        yield http
+    finally:
+        try:
+            _idle_http.put_nowait(http)
+        except Full:
+            pass
+
+
+def concurrently(*calls):
+    """ Runs functions without arguments at the same time.
+
+    The first runs in the calling thread, the others in threads of their
+    own, so two HTTP calls take as long as the slower one instead of both.
+
+    Returns:
+        The list of their results, in order.
+
+    Raises:
+        The exception of the first call that failed, once all ended.
+    """
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+
+    def run(index):
+        try:
+            results[index] = calls[index]()
+        except Exception:
+            errors[index] = sys.exc_info()
+
+    threads = [threading.Thread(target=run, args=(index,))
+               for index in range(1, len(calls))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    run(0)
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error is not None:
+            raise error[1]
+    return results
@@ -0,0 +1,305 @@
+"""Local copies of cover images given as an external URL.
+
+By default, pages link covers with an external URL directly, so every
+visitor loads them from the other site. With the config key COVER_URL_CACHE
+set, the image is downloaded once by a background job and stored like an
+upload, see `storage.py`, including its thumbnails. Pages show the local
+copy as soon as it exists and the external URL until then.
+
+The job revalidates its copy every COVER_URL_REFRESH seconds with a
+conditional request (If-None-Match / If-Modified-Since), so unchanged images
+are not downloaded again. Once no movie uses the URL any more, the copy is
+released.
+
+The URLs are given by users, so the server must not be made to fetch its own
+or internal services with them: the host of the URL and of every redirect
+must resolve to public addresses only, see `check_url()`. The name may
+resolve differently when the connection is made (DNS rebinding), so every
+connection also checks the address it reached before sending anything, see
+`PublicAddressAdapter`.
+"""
+import socket
+from datetime import datetime, timedelta
+import ipaddress
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from moviecollection import app
+from moviecollection import cache
+from moviecollection import database_setup as db_setup
+from moviecollection import jobs
+from moviecollection import storage
+from moviecollection import thumbnails
+from moviecollection.database_setup import Movie, RemoteCover
+
+try:
+    from urllib.parse import urljoin, urlparse
+except ImportError:  # Python 2
+    from urlparse import urljoin, urlparse
+
+# Default seconds between two revalidations of a copy.
+REFRESH_INTERVAL = 24 * 60 * 60
+
+# Seconds to wait for the other site to connect and to send data.
+TIMEOUT = 10
+
+# Redirects followed to the image.
+MAX_REDIRECTS = 5
+
+# Larger images are not copied; the same limit as for uploads.
+MAX_SIZE = 2 * 1024 * 1024
+
+# Image types that are copied, with the extension of the stored file.
+EXTENSIONS = {
+    'image/gif': 'gif',
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/webp': 'webp',
+}
+
+
+class CoverTooLarge(Exception):
+    """ Raised when a downloaded image exceeds MAX_SIZE. """
+
+
+class ForbiddenAddress(ValueError):
+    """ Raised when a cover URL points at a non-public address. """
+
+
+class LimitedReader(object):
+    """ File object reading a response body up to MAX_SIZE bytes. """
+
+    def __init__(self, response, limit=MAX_SIZE):
+        self.chunks = response.iter_content(storage.CHUNK_SIZE)
+        self.remaining = limit
+
+    def read(self, size):
+        chunk = next(self.chunks, b'')
+        self.remaining -= len(chunk)
+        if self.remaining < 0:
+            raise CoverTooLarge('Cover image larger than %d bytes' % MAX_SIZE)
+        return chunk
+
+
+def is_enabled():
+    """ Returns True if external covers are copied to the server. """
+    return bool(app.config.get('COVER_URL_CACHE'))
+
+
+def request_cover(session, url):
+    """ Queues the download of an external cover that has no copy yet.
+
+    Does nothing if COVER_URL_CACHE is not set, or if the URL is already
+    copied or queued. Call it in the transaction that saves the movie.
+    """
+    if not is_enabled() or not url.startswith(('http://', 'https://')):
+        return
+    if session.query(RemoteCover.id).filter_by(url=url).first() is not None:
+        return
+    if not jobs.is_queued(session, 'fetch_cover', url=url):
+        jobs.enqueue(session, 'fetch_cover', url=url)
+
+
+def is_public(address):
+    """ Returns True if an IP address may be fetched from.
+
+    Loopback, private (RFC 1918 and unique local), link-local (including
+    cloud metadata services at 169.254.169.254), multicast, reserved and
+    unspecified addresses are not public.
+    """
+    address = ipaddress.ip_address(u'%s' % address.split('%')[0])
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    return not (address.is_private or address.is_loopback or
+                address.is_link_local or address.is_multicast or
+                address.is_reserved or address.is_unspecified)
+
+
+class PublicPeerMixin(object):
+    """ Connection that closes its socket unless the peer is public.
+
+    The check runs right after the TCP connect, before the TLS handshake
+    and the request.
+    """
+
+    def _new_conn(self):
+        sock = super(PublicPeerMixin, self)._new_conn()
+        address = sock.getpeername()[0]
+        if not is_public(address):
+            sock.close()
+            raise ForbiddenAddress('%s connected to the non-public address '
+                                   '%s' % (self.host, address))
+        return sock
+
+
+class PublicHTTPConnection(PublicPeerMixin, HTTPConnection):
+    pass
+
+
+class PublicHTTPSConnection(PublicPeerMixin, HTTPSConnection):
+    pass
+
+
+class PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PublicHTTPConnection
+
+
+class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PublicHTTPSConnection
+
+
+class PublicAddressAdapter(HTTPAdapter):
+    """ Transport adapter connecting to public addresses only. """
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': PublicHTTPConnectionPool,
+            'https': PublicHTTPSConnectionPool,
+        }
+
+
+def public_session():
+    """ Returns a `requests` session for user given URLs.
+
+    Proxies from the environment are not used, as the proxy would be the
+    peer whose address is checked.
+    """
+    session = requests.Session()
+    session.trust_env = False
+    adapter = PublicAddressAdapter()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def check_url(url):
+    """ Makes sure a cover URL is http(s) and its host is public.
+
+    All addresses the host resolves to are checked.
+
+    Raises:
+        ForbiddenAddress: The URL may not be fetched.
+    """
+    parts = urlparse(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ForbiddenAddress('Not an http(s) URL: %r' % url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    try:
+        addresses = socket.getaddrinfo(parts.hostname, port, 0,
+                                       socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise requests.ConnectionError('Cannot resolve %s: %s'
+                                       % (parts.hostname, e))
+    for info in addresses:
+        if not is_public(info[4][0]):
+            raise ForbiddenAddress('%s resolves to the non-public address '
+                                   '%s' % (parts.hostname, info[4][0]))
+
+
+def download(cover):
+    """ Downloads an external cover unless it is unchanged since last time.
+
+    Redirects are followed one by one, and the URL of each is checked with
+    `check_url()` before it is requested. The connections check the address
+    they reached once more.
+
+    Args:
+        cover: RemoteCover holding the validators of the last download.
+
+    Returns:
+        The response if there is a new image, or None if it is unchanged.
+
+    Raises:
+        ForbiddenAddress: The URL or a redirect points at a non-public
+            address.
+    """
+    headers = {}
+    if cover.blob is not None:
+        if cover.etag:
+            headers['If-None-Match'] = cover.etag
+        if cover.last_modified:
+            headers['If-Modified-Since'] = cover.last_modified
+    url = cover.url
+    http = public_session()
+    for _ in range(MAX_REDIRECTS + 1):
+        check_url(url)
+        response = http.get(url, headers=headers, timeout=TIMEOUT,
+                            stream=True, allow_redirects=False)
+        if not response.is_redirect:
+            break
+        response.close()
+        url = urljoin(url, response.headers['Location'])
+    else:
+        raise requests.TooManyRedirects('More than %d redirects'
+                                        % MAX_REDIRECTS)
+    if response.status_code == 304 and cover.blob is not None:
+        response.close()
+        return None
+    response.raise_for_status()
+    content_type = response.headers.get('Content-Type', '')
+    if content_type.split(';')[0].strip().lower() not in EXTENSIONS:
+        response.close()
+        raise ValueError('Not a supported image type: %r' % content_type)
+    length = response.headers.get('Content-Length')
+    if length and length.isdigit() and int(length) > MAX_SIZE:
+        response.close()
+        raise CoverTooLarge('Cover image larger than %d bytes' % MAX_SIZE)
+    return response
+
+
+@jobs.handler('fetch_cover')
+def fetch_cover(url):
+    """ Copies or revalidates an external cover and queues the next refresh.
+    """
+    session = db_setup.Session()
+    collection_ids = [row[0] for row in session.query(
+        Movie.collection_id).filter_by(
+        cover_source='url', cover_image=url).distinct()]
+    cover = session.query(RemoteCover).filter_by(url=url).first()
+    if not collection_ids:
+        # No movie shows this cover any more.
+        if cover is not None:
+            storage.release(session, cover.blob)
+            session.delete(cover)
+            session.commit()
+        return
+    if cover is None:
+        cover = RemoteCover(url=url)
+        session.add(cover)
+    old_blob = cover.blob
+    try:
+        response = download(cover)
+        if response is not None:
+            extension = EXTENSIONS[
+                response.headers['Content-Type'].split(';')[0].strip().lower()]
+            try:
+                name, created = storage.store(
+                    session, LimitedReader(response), extension)
+            finally:
+                response.close()
+            if created:
+                thumbnails.create_thumbnails(storage.blob_path(name))
+            if name != cover.blob:
+                storage.release(session, cover.blob)
+                cover.blob = name
+            else:
+                # The same content again; keep a single reference.
+                storage.release(session, name)
+            cover.etag = response.headers.get('ETag')
+            cover.last_modified = response.headers.get('Last-Modified')
+        cover.last_error = None
+    except (requests.RequestException, ValueError, CoverTooLarge) as e:
+        # Pages keep the last copy, or the external URL if there is none.
+        cover.last_error = '%s: %s' % (type(e).__name__, e)
+    cover.fetched_at = datetime.utcnow()
+    interval = app.config.get('COVER_URL_REFRESH', REFRESH_INTERVAL)
+    if not jobs.is_queued(session, 'fetch_cover', url=url):
+        jobs.enqueue(session, 'fetch_cover', url=url,
+                     run_after=cover.fetched_at + timedelta(seconds=interval))
+    session.commit()
+    if cover.blob != old_blob:
+        # Cached pages still link the external URL or the old copy.
+        for collection_id in collection_ids:
+            cache.invalidate('collection:%d' % collection_id)
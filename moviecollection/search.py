@@ -0,0 +1,170 @@
+"""Full-text search over movies.
+
+On SQLite, searches the FTS5 table created by
+`database_setup.create_search_index()`. The write views keep the table in
+sync by calling `index_movie()` and `unindex_movie()` in the same
+transaction as the change to the movie itself.
+
+On PostgreSQL, searches the GIN index over `database_setup.search_document`
+instead, which needs no syncing; the index functions do nothing there.
+Other databases fall back to an unranked LIKE scan.
+"""
+import re
+from sqlalchemy import desc, or_, text
+from moviecollection.database_setup import (Movie, search_document,
+                                            search_table)
+
+# Number of results per page if the client does not ask for a limit.
+DEFAULT_RESULTS = 20
+
+# Upper bound for the `limit` query parameter.
+MAX_RESULTS = 100
+
+# Words of a search query; everything else separates words.
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def match_expression(terms):
+    """ Builds an FTS5 MATCH expression from user input.
+
+    Every word is quoted, so user input cannot inject FTS5 query syntax,
+    and matched as a prefix. All words have to match.
+
+    Args:
+        terms: The search text entered by the user.
+
+    Returns:
+        The MATCH expression, or None if the text contains no words.
+    """
+    words = WORD.findall(terms)
+    if not words:
+        return None
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def dialect_name(session):
+    """ Returns the name of the database behind a session, e.g. 'sqlite'. """
+    return session.get_bind().dialect.name
+
+
+def search(session, terms, limit=DEFAULT_RESULTS, offset=0):
+    """ Returns movies matching the search text, best matches first.
+
+    Results are ranked with the FTS5 bm25 function, which weighs how often
+    and in how short a column the words occur, or with ts_rank on
+    PostgreSQL.
+
+    Args:
+        session: Session used to query the database.
+        terms: The search text entered by the user.
+        limit: Maximum number of movies returned.
+        offset: Number of best matches to skip, for pagination.
+
+    Returns:
+        A list of Movie objects.
+    """
+    dialect = dialect_name(session)
+    if dialect != 'sqlite':
+        words = WORD.findall(terms)
+        if not words:
+            return []
+        if dialect == 'postgresql':
+            query = ts_query(session, words)
+        else:
+            query = like_query(session, words)
+        return query.limit(limit).offset(offset).all()
+    expression = match_expression(terms)
+    if expression is None:
+        return []
+    statement = text(
+        'SELECT movie.* FROM %s JOIN movie ON movie.id = %s.rowid '
+        'WHERE %s MATCH :expression ORDER BY rank LIMIT :limit '
+        'OFFSET :offset' % (search_table, search_table, search_table))
+    return session.query(Movie).from_statement(statement).params(
+        expression=expression, limit=limit, offset=offset).all()
+
+
+def ts_query(session, words):
+    """ Returns a query for movies matching all words as prefixes, using the
+    PostgreSQL GIN index.
+    """
+    # Words only contain word characters, so they cannot inject tsquery
+    # syntax.
+    condition = text("%s @@ to_tsquery('simple', :tsquery)" % search_document)
+    rank = text("ts_rank(%s, to_tsquery('simple', :tsquery))"
+                % search_document)
+    return session.query(Movie).filter(condition).order_by(
+        desc(rank), Movie.id).params(
+        tsquery=' & '.join('%s:*' % word for word in words))
+
+
+def like_query(session, words):
+    """ Returns an unranked query for movies containing all words. """
+    query = session.query(Movie)
+    for word in words:
+        pattern = '%' + word + '%'
+        query = query.filter(or_(Movie.name.ilike(pattern),
+                                 Movie.director.ilike(pattern),
+                                 Movie.genre.ilike(pattern),
+                                 Movie.description.ilike(pattern)))
+    return query.order_by(Movie.id)
+
+
+def index_movie(session, movie):
+    """ Adds a movie to the search index or updates its entry.
+
+    The movie needs an id, so flush the session first for new movies.
+    """
+    if dialect_name(session) != 'sqlite':
+        return
+    session.execute(
+        text('INSERT OR REPLACE INTO %s (rowid, name, director, genre, '
+             'description) VALUES (:id, :name, :director, :genre, '
+             ':description)' % search_table),
+        {'id': movie.id, 'name': movie.name, 'director': movie.director,
+         'genre': movie.genre, 'description': movie.description or ''})
+
+
+def unindex_movie(session, movie_id):
+    """ Removes a movie from the search index. """
+    if dialect_name(session) != 'sqlite':
+        return
+    session.execute(text('DELETE FROM %s WHERE rowid = :id' % search_table),
+                    {'id': movie_id})
+
+
+def index_new_movies(session, first_id, last_id):
+    """ Adds new movies with ids in a range to the search index at once.
+
+    Unlike `index_movie()`, this does not replace existing entries, which
+    makes bulk loads faster; the movies must not be in the index yet.
+    """
+    if dialect_name(session) != 'sqlite':
+        return
+    session.execute(text(
+        "INSERT INTO %s (rowid, name, director, genre, "
+        "description) SELECT id, name, director, genre, "
+        "coalesce(description, '') FROM movie WHERE id BETWEEN :first AND "
+        ":last" % search_table), {'first': first_id, 'last': last_id})
+
+
+def reindex_movies(session, first_id, last_id):
+    """ Replaces the index entries of the movies with ids in a range. """
+    if dialect_name(session) != 'sqlite':
+        return
+    session.execute(text('DELETE FROM %s WHERE rowid BETWEEN :first AND '
+                         ':last' % search_table),
+                    {'first': first_id, 'last': last_id})
+    index_new_movies(session, first_id, last_id)
+
+
+def rebuild_index(session):
+    """ Refills the search index from the movie table, e.g. after bulk loads.
+    """
+    if dialect_name(session) != 'sqlite':
+        return
+    session.execute(text('DELETE FROM %s' % search_table))
+    session.execute(text(
+        "INSERT INTO %s (rowid, name, director, genre, description) "
+        "SELECT id, name, director, genre, coalesce(description, '') "
+        "FROM movie" % search_table))
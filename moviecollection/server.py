@@ -0,0 +1,448 @@
+"""Production server: preforked worker processes serving the app.
+
+    python movie_app.py --workers 4 --threads 8 --port 5000
+    kill -HUP <master pid>     # reload the code and config without downtime
+    kill -TERM <master pid>    # stop after the requests in progress
+
+The master process binds the listening socket and starts the workers. Each
+worker is a new Python process, running `worker()`, that inherits the
+socket, loads the config and sets up its own database engine, pools and
+job threads in `init_worker()`. No database connection is shared between
+processes. Workers serve up to --threads requests at a time; a worker
+that dies is replaced.
+
+On SIGHUP the master starts a new set of workers, which load the current
+code and config. Once they accept requests, the old workers get SIGTERM,
+stop accepting and finish their requests in progress within
+--graceful-timeout seconds. If the new workers fail to start, the old
+ones keep running.
+
+The session cookies are signed with SECRET_KEY, which must be the same in
+all workers and across restarts; see `configure()` for where it is read
+from. `python movie_app.py --debug` runs the development server instead,
+which reloads itself when the code changes and makes up a secret key if
+there is none.
+
+The response cache must be shared by the workers: an in-process cache of
+one worker would keep serving pages that another worker changed. With
+more than one worker, CACHE_BACKEND defaults to 'disk' instead of
+'memory', and 'memory' is refused. The cache directory, CACHE_DIR, is
+'instance/cache' in the repository by default; the server refuses to start
+if other users could write to it.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from werkzeug.serving import ThreadedWSGIServer
+from moviecollection import app
+from moviecollection import cache
+from moviecollection import database_setup as db_setup
+from moviecollection import jobs
+
+# Environment variable with the path of a Python file of config keys, e.g.
+#     SECRET_KEY = '...'
+#     DATABASE_URL = 'postgresql://vagrant@localhost/moviecollections'
+SETTINGS_VARIABLE = 'MOVIECOLLECTION_SETTINGS'
+
+# Defaults of the command line options.
+HOST = '0.0.0.0'
+PORT = 5000
+WORKERS = multiprocessing.cpu_count()
+THREADS = 8
+GRACEFUL_TIMEOUT = 30  # seconds
+
+# Pending connections the socket holds while all workers are busy.
+BACKLOG = 128
+
+# Seconds a new worker may take to load the app and connect.
+BOOT_TIMEOUT = 60
+
+# Exit status of a worker that could not start.
+WORKER_BOOT_ERROR = 3
+
+# Seconds between two checks of the master on its workers.
+CHECK_INTERVAL = 1.0
+
+log = logging.getLogger(__name__)
+
+
+##############################################################################
+# Worker
+##############################################################################
+def configure(debug=False, workers=1):
+    """ Loads the app config shared by all workers.
+
+    Reads the Python file named by the MOVIECOLLECTION_SETTINGS environment
+    variable, if set. The environment variable SECRET_KEY takes precedence
+    over the file.
+
+    Args:
+        debug: Make up a secret key if there is none. Sessions then do not
+            survive a restart.
+        workers: Number of worker processes serving the app.
+
+    Raises:
+        RuntimeError: There is no secret key, the response cache of one
+            worker would go stale when another one changes the data, or
+            the cache directory is not private, see
+            `cache.private_directory()`.
+    """
+    if os.environ.get(SETTINGS_VARIABLE):
+        app.config.from_envvar(SETTINGS_VARIABLE)
+    if os.environ.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+    if not app.config.get('SECRET_KEY'):
+        if not debug:
+            raise RuntimeError('Set SECRET_KEY in the environment or in the '
+                               'file named by %s' % SETTINGS_VARIABLE)
+        app.config['SECRET_KEY'] = uuid.uuid4().hex
+    if workers > 1:
+        backend = app.config.setdefault('CACHE_BACKEND', 'disk')
+        if backend == 'memory':
+            raise RuntimeError("CACHE_BACKEND 'memory' is not shared by the "
+                               "%d workers; use 'disk' or None" % workers)
+    if app.config.get('CACHE_BACKEND', cache.CACHE_BACKEND) == 'disk':
+        cache.private_directory(app.config.get('CACHE_DIR', cache.CACHE_DIR))
+
+
+def init_worker(workers=1):
+    """ Prepares a worker process to serve requests.
+
+    Loads the config, creates the database engine with its pools and starts
+    the job threads (JOB_WORKERS in the config, default 2). This must run
+    in the worker itself, after the fork: pooled connections cannot be
+    shared between processes. The same goes for servers like gunicorn,
+    whose post_fork hook should call it with the number of workers.
+
+    Args:
+        workers: Number of worker processes serving the app.
+
+    Raises:
+        RuntimeError: The engine was already created before the fork, or
+            the config is not usable, see `configure()`.
+    """
+    if db_setup.engine is not None:
+        raise RuntimeError('The database engine was created before the '
+                           'worker started; its connections would be shared')
+    configure(workers=workers)
+    app.start_session()
+    jobs.start_workers(app.config.get('JOB_WORKERS', 2))
+
+
+class WorkerServer(ThreadedWSGIServer):
+    """ Serves the app on an inherited socket, with at most `threads`
+    requests at a time.
+
+    While all threads are busy, the worker stops accepting, so that idle
+    workers take the next connections.
+    """
+
+    def __init__(self, fd, threads):
+        ThreadedWSGIServer.__init__(self, HOST, 0, app, fd=fd)
+        self.threads = threads
+        self.active = 0
+        self.condition = threading.Condition()
+
+    def process_request(self, request, client_address):
+        with self.condition:
+            while self.active >= self.threads:
+                self.condition.wait()
+            self.active += 1
+        ThreadedWSGIServer.process_request(self, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            ThreadedWSGIServer.process_request_thread(self, request,
+                                                      client_address)
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def drain(self, timeout):
+        """ Waits for the requests in progress.
+
+        Returns:
+            True if all of them finished within `timeout` seconds.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.active and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return not self.active
+
+
+def worker(fd, ready_fd, threads, graceful_timeout, workers=1):
+    """ Runs a worker process until SIGTERM or until the master is gone.
+
+    Args:
+        fd: File descriptor of the listening socket.
+        ready_fd: Pipe to the master, written to once requests are served.
+        threads: Requests served at a time.
+        graceful_timeout: Seconds the requests in progress have to finish.
+        workers: Number of worker processes the master runs.
+
+    Returns:
+        The exit status.
+    """
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    # Ctrl-C and hangups of the terminal are handled by the master.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    master = os.getppid()
+    try:
+        init_worker(workers)
+        server = WorkerServer(fd, threads)
+    except Exception:
+        log.exception('Worker %d failed to start', os.getpid())
+        return WORKER_BOOT_ERROR
+    os.close(fd)
+    # Another worker may accept a connection first; then accept() fails
+    # instead of blocking.
+    server.socket.setblocking(False)
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    os.write(ready_fd, b'.')
+    os.close(ready_fd)
+
+    while not stopping.is_set() and os.getppid() == master:
+        stopping.wait(CHECK_INTERVAL)
+    server.shutdown()
+    thread.join()
+    if not server.drain(graceful_timeout):
+        log.warning('Worker %d stopped with %d requests in progress',
+                    os.getpid(), server.active)
+    jobs.stop_workers(graceful_timeout)
+    db_setup.engine.dispose()
+    if db_setup.replicas is not None:
+        db_setup.replicas.dispose()
+    return 0
+
+
+##############################################################################
+# Master
+##############################################################################
+class Master(object):
+    """ Starts, watches, replaces and stops the worker processes. """
+
+    def __init__(self, options):
+        self.options = options
+        self.workers = []
+        # Old workers finishing their requests after a reload.
+        self.retiring = []
+        # Workers that could not start.
+        self.failed = 0
+        self.reloading = False
+        self.stopping = False
+
+    def listen(self):
+        family = socket.AF_INET6 if ':' in self.options.host else \
+            socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.options.host, self.options.port))
+        self.socket.listen(BACKLOG)
+
+    def spawn(self, count):
+        """ Starts workers and waits until they serve requests.
+
+        Returns:
+            The started workers; those that failed to start are stopped.
+        """
+        fd = self.socket.fileno()
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [root] + [path for path in [env.get('PYTHONPATH')] if path])
+        starting = {}
+        for _ in range(count):
+            read_fd, ready_fd = os.pipe()
+            command = [sys.executable, '-m', 'moviecollection.server',
+                       'worker', '--fd', str(fd), '--ready-fd', str(ready_fd),
+                       '--threads', str(self.options.threads),
+                       '--workers', str(self.options.workers),
+                       '--graceful-timeout',
+                       str(self.options.graceful_timeout)]
+            if sys.version_info[0] >= 3:
+                process = subprocess.Popen(command, env=env,
+                                           pass_fds=(fd, ready_fd))
+            else:  # Python 2 passes all file descriptors.
+                process = subprocess.Popen(command, env=env)
+            os.close(ready_fd)
+            starting[read_fd] = process
+
+        started = []
+        deadline = time.time() + BOOT_TIMEOUT
+        while starting and time.time() < deadline:
+            try:
+                ready, _, _ = select.select(list(starting), [], [],
+                                            deadline - time.time())
+            except (select.error, OSError):
+                continue  # Interrupted by a signal.
+            for read_fd in ready:
+                process = starting.pop(read_fd)
+                # Empty if the worker exited before it was ready.
+                if os.read(read_fd, 1):
+                    started.append(process)
+                os.close(read_fd)
+        for read_fd, process in starting.items():
+            log.error('Worker %d did not start within %d seconds',
+                      process.pid, BOOT_TIMEOUT)
+            process.kill()
+            os.close(read_fd)
+        return started
+
+    def check(self):
+        """ Replaces workers that died and forgets retired ones.
+
+        Workers that fail to start are not replaced until the next reload.
+
+        Returns:
+            False if no worker is left.
+        """
+        self.retiring = [process for process in self.retiring
+                         if process.poll() is None]
+        alive = []
+        for process in self.workers:
+            status = process.poll()
+            if status is None:
+                alive.append(process)
+            else:
+                log.warning('Worker %d exited with status %d, replacing it',
+                            process.pid, status)
+        self.workers = alive
+        missing = self.options.workers - len(alive) - self.failed
+        if missing > 0 and not self.stopping:
+            started = self.spawn(missing)
+            self.failed += missing - len(started)
+            self.workers.extend(started)
+        return bool(self.workers)
+
+    def reload(self):
+        log.info('Reloading: starting %d new workers', self.options.workers)
+        started = self.spawn(self.options.workers)
+        if len(started) < self.options.workers:
+            log.error('Only %d of %d new workers started, keeping the old '
+                      'ones', len(started), self.options.workers)
+            self.stop(started)
+            return
+        old, self.workers = self.workers, started
+        self.failed = 0
+        for process in old:
+            process.terminate()
+        self.retiring.extend(old)
+
+    def stop(self, processes):
+        """ Lets workers finish their requests, then kills the rest. """
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.time() + self.options.graceful_timeout + 5
+        for process in processes:
+            while process.poll() is None and time.time() < deadline:
+                time.sleep(0.1)
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    def handle_reload(self, signum, frame):
+        self.reloading = True
+
+    def handle_stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        """ Serves until SIGTERM or SIGINT.
+
+        Returns:
+            The exit status.
+        """
+        self.listen()
+        signal.signal(signal.SIGHUP, self.handle_reload)
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        log.info('Master %d listening on %s:%d', os.getpid(),
+                 self.options.host, self.options.port)
+        status = 0
+        while not self.stopping:
+            if self.reloading:
+                self.reloading = False
+                self.reload()
+            if not self.check():
+                log.error('No worker is running')
+                status = 1
+                break
+            time.sleep(CHECK_INTERVAL)
+        log.info('Stopping %d workers', len(self.workers + self.retiring))
+        self.stop(self.workers + self.retiring)
+        self.socket.close()
+        return status
+
+
+##############################################################################
+# Command line
+##############################################################################
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(
+        prog='python movie_app.py',
+        description='Serves the movie collection app.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='worker processes')
+    parser.add_argument('--threads', type=int, default=THREADS,
+                        help='requests served at a time per worker')
+    parser.add_argument('--graceful-timeout', type=float,
+                        default=GRACEFUL_TIMEOUT,
+                        help='seconds workers have to finish requests')
+    parser.add_argument('--debug', action='store_true',
+                        help='run the development server')
+    # Used by the master to start the workers.
+    parser.add_argument('command', nargs='?', choices=('worker',),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--fd', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--ready-fd', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_arguments(sys.argv[1:] if argv is None else argv)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(process)d] %(levelname)s %(message)s')
+    if options.command == 'worker':
+        return worker(options.fd, options.ready_fd, options.threads,
+                      options.graceful_timeout, options.workers)
+    if options.debug:
+        # The development server runs in this process and reloads itself
+        # each time it notices a code change.
+        configure(debug=True)
+        app.start_session()
+        jobs.start_workers(app.config.get('JOB_WORKERS', 2))
+        app.run(host=options.host, port=options.port, debug=True)
+        return 0
+    try:
+        # Fail in the master, not in every worker.
+        configure(workers=options.workers)
+    except RuntimeError as e:
+        log.error('%s', e)
+        return 1
+    return Master(options).run()
+
+
+if __name__ == '__main__':
+    # Run the imported module, like `python -m moviecollection.jobs`.
+    from moviecollection import server
+    sys.exit(server.main())
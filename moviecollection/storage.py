@@ -0,0 +1,249 @@
+"""Content-addressed storage for uploaded cover images.
+
+Uploads are stored in the upload folder under the SHA-256 hash of their
+content, e.g. '9f86d0...0a08.jpg'. Identical images are stored once, and
+the `blob` table counts how many movies use each file. A file is deleted
+by a background job once no movie uses it any more. As the content of a
+file never changes, covers are served with immutable cache headers.
+
+Covers uploaded before this storage existed keep their original file
+name. They can be moved into the storage with:
+
+    python -m moviecollection.storage adopt
+"""
+import hashlib
+import os
+import re
+import tempfile
+from flask import url_for
+from sqlalchemy.dialects import postgresql
+from moviecollection import app
+from moviecollection import database_setup as db_setup
+from moviecollection import jobs
+from moviecollection import thumbnails
+from moviecollection.database_setup import Blob, Movie
+
+# Size of the pieces in which uploads are hashed and written.
+CHUNK_SIZE = 64 * 1024
+
+BLOB_NAME = re.compile(r'^[0-9a-f]{64}\.\w+$')
+
+
+def is_blob(name):
+    """ Returns True if a cover file name is a content hash. """
+    return bool(name and BLOB_NAME.match(name))
+
+
+def blob_path(name):
+    """ Returns the path of a stored file. """
+    return os.path.join(app.config['UPLOAD_FOLDER'], name)
+
+
+def store(session, stream, extension):
+    """ Writes a file into the storage and counts a reference to it.
+
+    The content is hashed while it is written to a temporary file, which is
+    then renamed to its hash. If the same content is already stored, the
+    stored file is reused. The reference is counted before the rename: the
+    update locks the `blob` row, so `release_blob` cannot delete the file
+    between the rename and the commit of this session.
+
+    Args:
+        session: Session of the change that uses the file.
+        stream: File object to read the content from.
+        extension: File extension without the dot, e.g. 'jpg'.
+
+    Returns:
+        name: File name of the stored content.
+        created: True if the content was not stored before.
+    """
+    folder = app.config['UPLOAD_FOLDER']
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        name = '%s.%s' % (digest.hexdigest(), extension.lower())
+        created = acquire(session, name, size)
+        # Identical content, so replacing an existing file is harmless.
+        os.rename(tmp_path, blob_path(name))
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    return name, created
+
+
+def acquire(session, name, size=None):
+    """ Counts one more movie using a stored file.
+
+    The count is changed by the database, not read and written back, so
+    concurrent uploads of the same content do not lose a reference. A
+    missing row is inserted in the same statement on PostgreSQL (an
+    upsert). On SQLite the update already holds the only write lock, so
+    the row can be inserted after it.
+
+    Returns:
+        True if no movie used the file before.
+    """
+    table = Blob.__table__
+    if session.get_bind().dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(
+            name=name, refcount=1, size=size)
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.name],
+            set_={'refcount': table.c.refcount + 1})
+        count = session.execute(
+            statement.returning(table.c.refcount)).scalar()
+        return count == 1
+    if not change_refcount(session, name, 1):
+        session.execute(table.insert().values(name=name, refcount=1,
+                                              size=size))
+        return True
+    return read_refcount(session, name) == 1
+
+
+def change_refcount(session, name, delta):
+    """ Adds `delta` to the count of a stored file, locking its row.
+
+    Returns:
+        False if the file is not in the storage.
+    """
+    return session.query(Blob).filter_by(name=name).update(
+        {Blob.refcount: Blob.refcount + delta},
+        synchronize_session=False) > 0
+
+
+def read_refcount(session, name):
+    """ Returns the count of a stored file, as seen by the session. """
+    return session.query(Blob.refcount).filter_by(name=name).scalar()
+
+
+def release(session, name, keep=None):
+    """ Counts one movie less using a cover file.
+
+    Files no movie uses any more are deleted by a background job. Legacy
+    files, which are not in the storage, are deleted right away by a job.
+
+    Args:
+        session: Session of the change that stops using the file.
+        name: File name of the cover.
+        keep: File name of the movie's new cover, which is not deleted
+            even if it is the same file.
+    """
+    if not name:
+        return
+    if not change_refcount(session, name, -1):
+        if name != keep:
+            jobs.enqueue(session, 'remove_file', path=blob_path(name))
+        return
+    # The row stays locked until the session ends, so the count read back
+    # is the one this session commits.
+    if read_refcount(session, name) <= 0:
+        jobs.enqueue(session, 'release_blob', name=name)
+
+
+@app.template_global()
+def cover_url(movie, size=None):
+    """ Returns the URL of a movie's cover image in the given width.
+
+    Falls back to the original image if there is no thumbnail of that size.
+    Covers with an external URL are returned unchanged, unless a local copy
+    exists, see `remote_covers.py`.
+    """
+    if movie.cover_source == 'url':
+        remote = movie.remote_cover if app.config.get(
+            'COVER_URL_CACHE') else None
+        if remote is None or remote.blob is None:
+            return movie.cover_image
+        filename = remote.blob
+    else:
+        filename = movie.cover_image or 'no_cover.png'
+    if size is not None:
+        path = blob_path(thumbnails.thumbnail_name(filename, size))
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            pass
+        else:
+            if is_blob(filename):
+                return url_for('coverThumbnail', size=size, filename=filename)
+            # The modification time makes the URL change with the image.
+            return url_for('coverThumbnail', size=size, filename=filename,
+                           v=int(mtime))
+    if is_blob(filename):
+        return url_for('coverImage', filename=filename)
+    return url_for('static', filename='uploads/' + filename)
+
+
+@jobs.handler('release_blob')
+def release_blob(name):
+    """ Deletes a stored file and its thumbnails if no movie uses it.
+
+    A new upload of the same content may have used the file again. The
+    count is checked by the delete, which locks the row, and the file is
+    removed before the commit releases that lock. An upload waiting for
+    the lock then inserts a new row and renames its file into place after
+    the removal.
+    """
+    session = db_setup.Session()
+    deleted = session.query(Blob).filter(
+        Blob.name == name, Blob.refcount <= 0).delete(
+        synchronize_session=False)
+    if deleted:
+        jobs.remove_file(blob_path(name))
+    session.commit()
+
+
+def adopt(session):
+    """ Moves legacy cover files into the storage.
+
+    Every movie whose local cover has its original file name gets the name
+    of the stored content instead. Legacy files are deleted afterwards.
+
+    Returns:
+        The number of movies changed.
+    """
+    changed = 0
+    legacy = set()
+    movies = session.query(Movie).filter(Movie.cover_source == 'local')
+    for movie in movies.all():
+        if is_blob(movie.cover_image):
+            continue
+        path = blob_path(movie.cover_image)
+        extension = os.path.splitext(movie.cover_image)[1].lstrip('.')
+        try:
+            with open(path, 'rb') as f:
+                name, created = store(session, f, extension or 'bin')
+        except IOError:
+            continue
+        if created:
+            jobs.enqueue(session, 'thumbnails', path=blob_path(name),
+                         collection_id=movie.collection_id)
+        movie.cover_image = name
+        legacy.add(path)
+        changed += 1
+    session.commit()
+    for path in legacy:
+        jobs.remove_file(path)
+    return changed
+
+
+if __name__ == '__main__':
+    import sys
+    from moviecollection import storage
+    if sys.argv[1:] != ['adopt']:
+        print('Usage: python -m moviecollection.storage adopt')
+        sys.exit(1)
+    app.start_session()
+    print('Moved the covers of %d movies into the storage.'
+          % storage.adopt(app.session))
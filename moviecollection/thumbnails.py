@@ -0,0 +1,110 @@
+"""Resized variants (thumbnails) of uploaded cover images.
+
+When a cover image is uploaded, smaller copies in THUMBNAIL_SIZES are
+written next to the original, e.g. 'poster.jpg' gets 'poster.jpg.120.webp'.
+Pages show the thumbnails through `storage.cover_url()` and the `/cover`
+route in `views.py`, which sends them with long-lived cache headers. Images
+uploaded before thumbnails existed can be processed with:
+
+    python -m moviecollection.thumbnails
+
+Thumbnails need Pillow. Without it, pages keep showing the originals.
+"""
+import os
+import re
+from moviecollection import app
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow is optional.
+    Image = None
+
+# Widths in pixels; the movie lists show covers 120px wide.
+THUMBNAIL_SIZES = (120, 240, 480)
+
+# WebP is much smaller than JPEG at the same quality, if Pillow supports it.
+if Image is not None and features.check('webp'):
+    THUMBNAIL_FORMAT, THUMBNAIL_EXTENSION = 'WEBP', 'webp'
+else:
+    THUMBNAIL_FORMAT, THUMBNAIL_EXTENSION = 'JPEG', 'jpg'
+THUMBNAIL_QUALITY = 80
+
+# Browsers may cache covers for a year; URLs change with the image.
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60
+
+THUMBNAIL_NAME = re.compile(r'\.\d+\.(webp|jpg)$')
+
+
+def thumbnail_name(filename, size):
+    """ Returns the file name of a thumbnail of an uploaded image. """
+    return '%s.%d.%s' % (filename, size, THUMBNAIL_EXTENSION)
+
+
+def create_thumbnails(path):
+    """ Writes all thumbnails of an image next to it.
+
+    Images narrower than a thumbnail size are not enlarged.
+
+    Args:
+        path: Path of the original image.
+
+    Returns:
+        The number of thumbnails written; 0 without Pillow or if the file is
+        not a readable image.
+    """
+    if Image is None:
+        return 0
+    try:
+        original = Image.open(path)
+        original.load()
+    except (IOError, OSError):
+        return 0
+    if original.mode not in ('RGB', 'RGBA'):
+        original = original.convert('RGBA' if 'transparency' in original.info
+                                    else 'RGB')
+    if THUMBNAIL_FORMAT == 'JPEG' and original.mode == 'RGBA':
+        original = original.convert('RGB')
+    directory, filename = os.path.split(path)
+    for size in THUMBNAIL_SIZES:
+        image = original.copy()
+        image.thumbnail((size, size * 4), Image.LANCZOS)
+        image.save(os.path.join(directory, thumbnail_name(filename, size)),
+                   THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY)
+    return len(THUMBNAIL_SIZES)
+
+
+def remove_thumbnails(path):
+    """ Deletes the thumbnails of an image, if they exist. """
+    directory, filename = os.path.split(path)
+    for size in THUMBNAIL_SIZES:
+        try:
+            os.remove(os.path.join(directory, thumbnail_name(filename, size)))
+        except OSError:
+            pass
+
+
+def backfill(folder):
+    """ Creates missing thumbnails for all images in the upload folder.
+
+    Returns:
+        The number of images that got thumbnails.
+    """
+    processed = 0
+    for filename in sorted(os.listdir(folder)):
+        path = os.path.join(folder, filename)
+        if THUMBNAIL_NAME.search(filename) or not os.path.isfile(path):
+            continue
+        if all(os.path.exists(os.path.join(folder, thumbnail_name(filename, s)))
+               for s in THUMBNAIL_SIZES):
+            continue
+        if create_thumbnails(path):
+            processed += 1
+    return processed
+
+
+if __name__ == '__main__':
+    if Image is None:
+        print('Pillow is not installed, no thumbnails created.')
+    else:
+        print('Created thumbnails for %d images.'
+              % backfill(app.config['UPLOAD_FOLDER']))
@@ -1,10 +1,18 @@
 import os
 from sqlalchemy import asc
+from sqlalchemy.orm import joinedload
 from werkzeug.utils import secure_filename
 from moviecollection import app
 from functools import wraps
 from moviecollection.login import login_session
-from flask import render_template, redirect, url_for, flash, request
+from moviecollection.cache import cached, collection_tags, collections_tags, invalidate
+from moviecollection import search
+from moviecollection import counters
+from moviecollection import jobs
+from moviecollection import remote_covers
+from moviecollection import storage
+from moviecollection import thumbnails
+from flask import render_template, redirect, url_for, flash, request, send_from_directory
 from moviecollection.database_setup import User, Collection, Movie
 
 
@@ -58,6 +66,23 @@ def getUserInfo(user_id):
     return user
 
 
+def getCollection(collection_id):
+    """ Returns a collection together with its creator.
+
+    The creator is loaded in the same query (joined eager loading), so
+    `collection.user` does not cost an additional query.
+
+    Args:
+        collection_id: An integer identifying a distinct collection.
+
+    Returns:
+        The collection object with its `user` relationship loaded.
+    """
+
+    return app.Collection().options(joinedload(Collection.user)).filter_by(
+        id=collection_id).one()
+
+
 def getUserID(email):
     """ Return a user ID from the database.
 
@@ -112,7 +137,7 @@ def file_extension_allowed(filename):
            filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS
 
 
-def image_source_process(image_source):
+def image_source_process(image_source, collection_id=None):
     """ Save image information to the database, depending on its source.
 
     Save image when local file is uploaded, save the path when url is
@@ -120,8 +145,13 @@ def image_source_process(image_source):
 
     This method is called from the editAlbum und deleteAlbum methods.
 
+    Uploaded images are stored under their content hash, see `storage.py`.
+    Thumbnails of new images are created by a background job. External
+    images may be copied to the server, see `remote_covers.py`.
+
     Args:
         image_source: selected image_source in form.
+        collection_id: collection whose cached pages show the image.
 
     Returns:
         source: Local file, external url or no image.
@@ -134,23 +164,69 @@ def image_source_process(image_source):
         file = request.files['file']
         if file and file_extension_allowed(file.filename):
             # Validate filename in case it is forged.
-            filename = secure_filename(file.filename)
+            extension = secure_filename(file.filename).rsplit('.', 1)[1]
             # Save the image in the defined upload folder on the server.
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
+            filename, created = storage.store(app.session, file.stream,
+                                              extension)
+            if created:
+                jobs.enqueue(app.session, 'thumbnails',
+                             path=storage.blob_path(filename),
+                             collection_id=collection_id)
     elif image_source == 'url':
         source = 'url'
         filename = request.form['URL']
+        remote_covers.request_cover(app.session, filename)
     else:
         source = None
         filename = 'no_cover.png'
     return (source, filename)
 
 
+@app.route('/cover/<int:size>/<path:filename>')
+def coverThumbnail(size, filename):
+    """ Sends a thumbnail of an uploaded cover with long-lived cache headers.
+
+    Args:
+        size: Width of the thumbnail, one of thumbnails.THUMBNAIL_SIZES.
+        filename: Name of the original image in the upload folder.
+    """
+    if size not in thumbnails.THUMBNAIL_SIZES:
+        return 'Unknown thumbnail size', 404
+    response = send_from_directory(app.config['UPLOAD_FOLDER'],
+                                   thumbnails.thumbnail_name(filename, size))
+    return cover_cache_headers(response, filename)
+
+
+@app.route('/cover/<path:filename>')
+def coverImage(filename):
+    """ Sends an uploaded cover with long-lived cache headers.
+
+    Args:
+        filename: Name of the image in the upload folder.
+    """
+    response = send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return cover_cache_headers(response, filename)
+
+
+def cover_cache_headers(response, filename):
+    """ Lets browsers cache a cover image for a long time.
+
+    Images stored under their content hash never change, so they are marked
+    immutable and browsers do not revalidate them.
+    """
+    response.cache_control.public = True
+    response.cache_control.max_age = thumbnails.THUMBNAIL_MAX_AGE
+    if storage.is_blob(filename):
+        response.headers['Cache-Control'] += ', immutable'
+    return response
+
+
 ##############################################################################
 # Render template - These app.routes respond with web pages.
 ###############################################################################
 @app.route('/')
 @app.route('/collection/')
+@cached(collections_tags, per_user=True)
 def showCollections():
     """"Shows all movie collection in the database"""
 
@@ -177,6 +253,7 @@ def newCollection():
         app.session.add(newCollection)
         flash('New Collection %s Successfully Created' % newCollection.name)
         app.session.commit()
+        invalidate('collections')
         return redirect(url_for('showCollections'))
 
     else:
@@ -197,9 +274,8 @@ def editCollection(collection_id):
         Login page when user is not signed in.
         Alert when user is trying to edit a collection he is not authorized to.
     """
-    editedCollection = app.session.query(Collection).filter_by(id=collection_id).one()
-    collection = app.session.query(Collection).filter_by(id=collection_id).one()
-    creator = getUserInfo(collection.user_id)
+    editedCollection = collection = getCollection(collection_id)
+    creator = collection.user
     if editedCollection.user_id != login_session['user_id']:
         return ("<script>function myFunction() {alert('You are not authorized "
                 "to edit this collection. Please create your own collection in"
@@ -208,6 +284,8 @@ def editCollection(collection_id):
     if request.method == 'POST':
         if request.form['name']:
             editedCollection.name = request.form['name']
+            app.session.commit()
+            invalidate('collections', 'collection:%d' % collection_id)
             flash('Collection Successfully Edited: %s' % editedCollection.name)
             return redirect(url_for('showCollections'))
     else:
@@ -229,9 +307,8 @@ def deleteCollection(collection_id):
         Login page when user is not signed in.
         Alert when user tries to delete a collection he is not authorized to.
     """
-    collectionToDelete = app.session.query(Collection).filter_by(id=collection_id).one()
-    collection = app.session.query(Collection).filter_by(id=collection_id).one()
-    creator = getUserInfo(collection.user_id)
+    collectionToDelete = collection = getCollection(collection_id)
+    creator = collection.user
     if collectionToDelete.user_id != login_session['user_id']:
         return ("<script>function myFunction() {alert('You are not authorized "
                 "to delete this collection. Plaease create your own collection"
@@ -240,8 +317,12 @@ def deleteCollection(collection_id):
                 ">")
     if request.method == 'POST':
         app.session.delete(collectionToDelete)
+        # The movies of the collection are deleted in the background.
+        jobs.enqueue(app.session, 'delete_collection',
+                     collection_id=collection_id)
         flash('%s Successfully Deleted' % collectionToDelete.name)
         app.session.commit()
+        invalidate('collections', 'collection:%d' % collection_id)
         return redirect(url_for('showCollections', collection_id=collection_id))
     else:
         return render_template('deleteCollection.html', collection=collection,
@@ -251,14 +332,16 @@ def deleteCollection(collection_id):
 @app.route('/collection/<int:collection_id>/')
 @app.route('/collection/<int:collection_id>/movie/')
 @login_required
+@cached(collection_tags, per_user=True)
 def showMovies(collection_id):
     """show all movies of a distinct collection
     Args:
         collection_id: An integer identifying a distinct collection.
     """
-    collection = app.session.query(Collection).filter_by(id=collection_id).one()
-    creator = getUserInfo(collection.user_id)
-    movies = app.session.query(Movie).filter_by(
+    collection = getCollection(collection_id)
+    creator = collection.user
+    movies = app.session.query(Movie).options(
+        joinedload(Movie.remote_cover)).filter_by(
         collection_id=collection_id).all()
     if 'username' not in login_session or creator.id != login_session['user_id']:
         return render_template('publicMovies.html', movies=movies,
@@ -282,10 +365,11 @@ def newMovie(collection_id):
             Login page when user is not signed in.
             Alert when user is trying to create an album he is not authorized to.
         """
-    collection = app.session.query(Collection).filter_by(id=collection_id).one()
-    creator = getUserInfo(collection.user_id)
+    collection = getCollection(collection_id)
+    creator = collection.user
     if request.method == 'POST':
-        source, filename = image_source_process(request.form['image_source'])
+        source, filename = image_source_process(request.form['image_source'],
+                                                collection_id)
         newMovie = Movie(name=request.form['name'],
                          director=request.form['director'],
                          genre=request.form['genre'],
@@ -296,7 +380,11 @@ def newMovie(collection_id):
                          collection_id=collection_id,
                          user_id=login_session['user_id'])
         app.session.add(newMovie)
+        app.session.flush()
+        search.index_movie(app.session, newMovie)
+        counters.update(app.session, added=[counters.key(newMovie)])
         app.session.commit()
+        invalidate('collections', 'collection:%d' % collection_id)
         flash('New movie: %s,  was Successfully Created' % newMovie.name)
         return redirect(url_for('showMovies', collection_id=collection_id))
     else:
@@ -323,8 +411,8 @@ def editMovie(collection_id, movie_id):
     """
 
     editedMovie = app.session.query(Movie).filter_by(id=movie_id).one()
-    collection = app.session.query(Collection).filter_by(id=collection_id).one()
-    creator = getUserInfo(collection.user_id)
+    collection = getCollection(collection_id)
+    creator = collection.user
     if login_session['user_id'] != collection.user_id:
         return ("<script>function myFunction() {alert('You are not authorized "
                 "to edit movies to this collection. Please create your own"
@@ -332,6 +420,7 @@ def editMovie(collection_id, movie_id):
                 "</script><body "
                 "onload='myFunction()'>")
     if request.method == 'POST':
+        old_key = counters.key(editedMovie)
         if request.form['name']:
             editedMovie.name = request.form['name']
         if request.form['director']:
@@ -343,17 +432,25 @@ def editMovie(collection_id, movie_id):
         if request.form['description']:
             editedMovie.description = request.form['description']
         if request.form['image_source'] != 'no_change':
-            if editedMovie.cover_source == 'local':
-                # Delete the old image from the server if it still exists.
-                try:
-                    os.remove(os.path.join(app.config['UPLOAD_FOLDER'],
-                                           editedMovie.cover_image))
-                except OSError:
-                    pass
+            old_source = editedMovie.cover_source
+            old_image = editedMovie.cover_image
             editedMovie.cover_source, editedMovie.cover_image = \
-                image_source_process(request.form['image_source'])
+                image_source_process(request.form['image_source'],
+                                     collection_id)
+            # Released after the new image is stored, so that uploading the
+            # same image again never deletes it.
+            if old_source == 'local':
+                storage.release(app.session, old_image,
+                                keep=editedMovie.cover_image)
         app.session.add(editedMovie)
+        search.index_movie(app.session, editedMovie)
+        counted = counters.update(app.session,
+                                  added=[counters.key(editedMovie)],
+                                  removed=[old_key])
         app.session.commit()
+        invalidate('collection:%d' % collection_id)
+        if counted:
+            invalidate('collections')
         flash('Movie Successfully Edited')
         return redirect(url_for('showMovies', collection_id=collection_id))
     else:
@@ -378,9 +475,9 @@ def deleteMovie(collection_id, movie_id):
 
     """
 
-    collection = app.session.query(Collection).filter_by(id=collection_id).one()
+    collection = getCollection(collection_id)
     movieToDelete = app.session.query(Movie).filter_by(id=movie_id).one()
-    creator = getUserInfo(collection.user_id)
+    creator = collection.user
     if login_session['user_id'] != collection.user_id:
         return ("<script>function myFunction() {alert('You are not authorized "
                 "to delete movies to this collection. Please create your "
@@ -389,16 +486,35 @@ def deleteMovie(collection_id, movie_id):
                 "onload='myFunction()'>")
     if request.method == 'POST':
         if movieToDelete.cover_source == 'local':
-            # Delete the old image from the server if it still exists.
-            try:
-                os.remove(os.path.join(app.config['UPLOAD_FOLDER'],
-                          movieToDelete.cover_image))
-            except OSError:
-                pass
+            # Delete the old image from the server if no movie uses it.
+            storage.release(app.session, movieToDelete.cover_image)
         app.session.delete(movieToDelete)
+        search.unindex_movie(app.session, movie_id)
+        # Also marks the collection as changed for the Last-Modified header.
+        counters.update(app.session, removed=[counters.key(movieToDelete)])
         app.session.commit()
+        invalidate('collections', 'collection:%d' % collection_id)
         flash('Movie Successfully Deleted')
         return redirect(url_for('showMovies', collection_id=collection_id))
     else:
         return render_template('deleteMovie.html', movie=movieToDelete,
                                collection=collection, creator=creator)
+
+
+@app.route('/search')
+def searchMovies():
+    """ Shows the movies matching a search text, best matches first.
+
+    Query parameters:
+        q: The search text. Words are matched as prefixes.
+        page: Number of the result page, starting at 1.
+    """
+    terms = request.args.get('q', '')
+    page = max(1, request.args.get('page', 1, type=int))
+    limit = search.DEFAULT_RESULTS
+    # Fetch one extra movie to find out whether there is a next page.
+    movies = search.search(app.session, terms, limit=limit + 1,
+                           offset=(page - 1) * limit)
+    return render_template('search.html', terms=terms, page=page,
+                           movies=movies[:limit],
+                           has_next=len(movies) > limit)
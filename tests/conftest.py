@@ -0,0 +1,61 @@
+"""Fixtures of the tests: the app on a temporary SQLite database.
+
+Run the tests from the repository root with `python -m pytest`. The
+database engine is created once per process (see
+`database_setup.get_engine()`), so all tests share one database, which is
+created and seeded once per test session.
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from moviecollection import app
+from moviecollection import database_setup as db_setup
+from moviecollection.database_setup import User, Collection, Movie
+
+
+@pytest.fixture(scope='session')
+def owner():
+    """ Creates the database with one collection of 20 movies.
+
+    Returns:
+        The serialized owner of the collection.
+    """
+    tmpdir = tempfile.mkdtemp()
+    db_setup.database_url = 'sqlite:///' + os.path.join(tmpdir, 'tests.db')
+    db_setup.create_all()
+    app.secret_key = 'tests'
+    app.config['TESTING'] = True
+    app.config['CACHE_BACKEND'] = None
+    app.start_session()
+
+    session = app.session
+    user = User(name='Owner', email='owner@example.com', picture='')
+    session.add(user)
+    session.flush()
+    collection = Collection(name='Collection', user_id=user.id)
+    session.add(collection)
+    session.flush()
+    session.add_all([Movie(name='Movie %d' % m, director='Director',
+                           genre='Drama', year='2000',
+                           collection_id=collection.id, user_id=user.id)
+                     for m in range(20)])
+    session.commit()
+    serialized = user.serialize
+    session.remove()
+    yield serialized
+    shutil.rmtree(tmpdir)
+
+
+@pytest.fixture
+def client(owner):
+    """ A test client logged in as the owner. """
+    client = app.test_client()
+    with client.session_transaction() as login_session:
+        login_session['username'] = owner['name']
+        login_session['email'] = owner['email']
+        login_session['picture'] = owner['picture']
+        login_session['user_id'] = owner['id']
+    return client
@@ -0,0 +1,35 @@
+"""Bulk import of movies."""
+from moviecollection import bulk
+from moviecollection import database_setup as db_setup
+from moviecollection import jobs
+from moviecollection import search
+from moviecollection.database_setup import Collection, Movie
+
+
+def test_import_indexes_movies_in_background(owner, monkeypatch):
+    # Batches of 3 movies: one full INSERT page of 2 and the rest.
+    monkeypatch.setattr(bulk, 'INSERT_PAGE_SIZE', 2)
+    session = db_setup.Session()
+    collection = Collection(name='Imported', user_id=owner['id'])
+    session.add(collection)
+    session.commit()
+    rows = [{'name': 'Zyzzyva %d' % number, 'director': 'Director',
+             'genre': 'Drama', 'year': '2001'} for number in range(7)]
+    rows.append({'name': 'No director'})
+
+    result = bulk.import_movies(session, rows, owner['id'], collection.id,
+                                batch_size=3)
+    assert result == {'imported': 7, 'failed': 1, 'errors': [
+        {'row': 8, 'error': 'director is required'}]}
+    names = sorted(name for name, in session.query(Movie.name).filter_by(
+        collection_id=collection.id))
+    assert names == ['Zyzzyva %d' % number for number in range(7)]
+    assert session.query(Collection.movie_count).filter_by(
+        id=collection.id).scalar() == 7
+    # Found once the queued jobs ran.
+    assert search.search(session, 'zyzzyva') == []
+    db_setup.Session.remove()
+    jobs.work(burst=True)
+    session = db_setup.Session()
+    assert len(search.search(session, 'zyzzyva')) == 7
+    db_setup.Session.remove()
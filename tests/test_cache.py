@@ -0,0 +1,67 @@
+"""Disk backend of the response cache."""
+import os
+
+import pytest
+
+from moviecollection.cache import DiskCache, private_directory
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path / 'cache')
+
+
+def test_round_trip(directory):
+    backend = DiskCache(directory)
+    response = (b'{"Movies": []}\n\x00\xff', 200,
+                [('Content-Type', 'application/json'), ('ETag', '"1"')])
+    backend.set('response:/collection/JSON', response)
+    backend.set('generation:collections', '0:abc')
+    assert backend.get('response:/collection/JSON') == response
+    assert backend.get('generation:collections') == '0:abc'
+    assert backend.get('missing') is None
+
+
+def test_expired_entries_are_missed(directory):
+    backend = DiskCache(directory, ttl=-1)
+    backend.set('generation:collections', '0:abc')
+    assert backend.get('generation:collections') is None
+
+
+def test_other_files_are_not_loaded(directory):
+    backend = DiskCache(directory)
+    backend.set('generation:collections', '0:abc')
+    name, = os.listdir(directory)
+    with open(os.path.join(directory, name), 'wb') as f:
+        f.write(b'\x80\x04\x95 not a cache entry')
+    assert backend.get('generation:collections') is None
+
+
+def test_directory_is_created_private(directory):
+    DiskCache(directory)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+
+@pytest.mark.parametrize('mode', [0o770, 0o1777])
+def test_shared_directory_is_refused(directory, mode):
+    os.mkdir(directory)
+    os.chmod(directory, mode)
+    with pytest.raises(RuntimeError):
+        DiskCache(directory)
+
+
+def test_symbolic_link_is_refused(directory, tmp_path):
+    target = str(tmp_path / 'elsewhere')
+    os.mkdir(target, 0o700)
+    os.symlink(target, directory)
+    with pytest.raises(RuntimeError):
+        private_directory(directory)
+
+
+@pytest.mark.skipif(not hasattr(os, 'geteuid') or os.geteuid() != 0,
+                    reason='needs root to give the directory away')
+def test_directory_of_another_user_is_refused(directory):
+    os.mkdir(directory, 0o700)
+    os.chown(directory, 12345, -1)
+    with pytest.raises(RuntimeError):
+        DiskCache(directory)
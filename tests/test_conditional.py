@@ -0,0 +1,33 @@
+"""Conditional GET requests of the list APIs."""
+import time
+from datetime import datetime
+
+import pytest
+from werkzeug.http import http_date
+
+from moviecollection import database_setup as db_setup
+from moviecollection.database_setup import Collection
+
+
+@pytest.mark.parametrize('url', ['/collection/JSON', '/collection/atom'])
+def test_deleting_a_collection_modifies_the_list(owner, client, url):
+    session = db_setup.Session()
+    # Older than the other collections, so it is not the latest change.
+    collection = Collection(name='Deleted', user_id=owner['id'],
+                            updated_at=datetime(2000, 1, 1))
+    session.add(collection)
+    session.commit()
+    response = client.get(url)
+    response.get_data()
+    assert response.status_code == 200
+    since = {'If-Modified-Since': http_date(time.time())}
+    both = dict(since, **{'If-None-Match': response.headers['ETag']})
+    assert client.get(url, headers=both).status_code == 304
+
+    session.delete(collection)
+    session.commit()
+    db_setup.Session.remove()
+    for headers in (both, since):
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200
+        assert 'Deleted' not in response.get_data(as_text=True)
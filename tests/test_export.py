@@ -0,0 +1,48 @@
+"""Export of movies in JSON and NDJSON, with both JSON encoders.
+
+orjson and the json module both write non-ASCII characters unescaped, so
+the export has to keep them intact, including the ones that
+str.splitlines() treats as line breaks.
+"""
+import json
+from datetime import datetime
+
+import pytest
+
+from moviecollection import export
+from moviecollection import fastjson
+
+DESCRIPTIONS = (u'a\x85b', u'line\u2028separator', u'paragraph\u2029end',
+                u'tab\tand\nnewline', u'plain')
+
+
+def movie_rows():
+    return [(number, u'Movie %d' % number, u'Director', u'Drama', u'2000',
+             description, 1, 1, datetime(2016, 9, 15, 12, 0))
+            for number, description in enumerate(DESCRIPTIONS, 1)]
+
+
+@pytest.fixture(params=['orjson', 'json'])
+def encoder(request, monkeypatch):
+    if request.param == 'orjson':
+        if fastjson.orjson is None:
+            pytest.skip('orjson is not installed')
+    else:
+        monkeypatch.setattr(fastjson, 'orjson', None)
+    return request.param
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 1000])
+def test_json_round_trip(encoder, batch_size):
+    document = ''.join(export.generate_json(movie_rows(), batch_size))
+    movies = json.loads(document)['Movies']
+    assert [movie['description'] for movie in movies] == list(DESCRIPTIONS)
+
+
+@pytest.mark.parametrize('batch_size', [1, 2, 1000])
+def test_ndjson_round_trip(encoder, batch_size):
+    document = ''.join(export.generate_ndjson(movie_rows(), batch_size))
+    lines = document.split('\n')
+    assert lines.pop() == ''
+    movies = [json.loads(line) for line in lines]
+    assert [movie['description'] for movie in movies] == list(DESCRIPTIONS)
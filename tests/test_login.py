@@ -0,0 +1,52 @@
+"""Google login with the cache of verified tokens."""
+import pytest
+
+from moviecollection import app
+from moviecollection import login
+
+GPLUS_ID = '1234567890'
+TOKEN = 'google-token'
+
+
+class Credentials(object):
+    access_token = TOKEN
+    id_token = {'sub': GPLUS_ID}
+
+
+class Flow(object):
+    def step2_exchange(self, code, http=None):
+        return Credentials()
+
+
+@pytest.fixture
+def verified(owner, monkeypatch):
+    """ A token that passed the checks before and is cached. """
+    monkeypatch.setattr(login, 'flow_from_clientsecrets',
+                        lambda *args, **kwargs: Flow())
+    login.remember_verified_token(GPLUS_ID, TOKEN, {
+        'user_id': GPLUS_ID, 'issued_to': login.app_token})
+    yield
+    login.verified_tokens.clear()
+
+
+def test_revoked_cached_token_fails_login(verified, monkeypatch):
+    # The cached token skips tokeninfo; only the user info call is made.
+    monkeypatch.setattr(login.outbound, 'concurrently', lambda *calls: [
+        {'error': {'code': 401, 'message': 'Invalid Credentials'}}])
+    client = app.test_client()
+    with client.session_transaction() as login_session:
+        login_session['state'] = 'state'
+    response = client.post('/gconnect?state=state', data='one-time-code')
+    assert response.status_code == 401
+    assert login.get_verified_token(GPLUS_ID, TOKEN) is None
+
+
+def test_disconnect_forgets_token(verified):
+    client = app.test_client()
+    with client.session_transaction() as login_session:
+        login_session.update(provider='google', gplus_id=GPLUS_ID,
+                             access_token=TOKEN, username='User',
+                             email='user@example.com', picture='',
+                             user_id=1)
+    assert client.get('/disconnect').status_code == 302
+    assert login.get_verified_token(GPLUS_ID, TOKEN) is None
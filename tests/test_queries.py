@@ -0,0 +1,65 @@
+"""Query budgets: SQL statements executed per route.
+
+Requests every read route as the owner of the collections, with the
+response cache off. The SQL statements of each request are counted
+through SQLAlchemy engine events. A route fails if it runs more
+statements than its budget in QUERY_BUDGET, which guards against N+1
+query regressions, or none at all, which means that its statements ran on
+an engine that is not counted.
+"""
+import pytest
+from sqlalchemy import event
+
+from moviecollection import database_setup as db_setup
+
+# Maximum number of SQL statements per request.
+QUERY_BUDGET = {
+    '/': 1,
+    '/collection/1/movie/': 2,
+    '/collection/1/edit/': 1,
+    '/collection/1/delete/': 1,
+    '/collection/1/movie/new': 1,
+    '/collection/1/1/edit': 2,
+    '/collection/1/1/delete': 2,
+    '/collection/JSON': 2,
+    '/collection/1/movie/JSON': 2,
+    '/collection/1/movie/1/JSON': 3,
+    '/collection/atom': 3,
+    '/collection/1/movie/atom': 4,
+    '/collection/1/movie/1/atom': 3,
+}
+
+
+class QueryCounter(object):
+    """ Counts the statements executed by the given engines. """
+
+    def __init__(self, *engines):
+        self.count = 0
+        self.engines = engines
+        for engine in engines:
+            event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+    def remove(self):
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self._count)
+
+
+@pytest.fixture(scope='module')
+def counter(owner):
+    # Read requests run on the read pool, see `RoutingSession`.
+    counter = QueryCounter(db_setup.get_engine(),
+                           *db_setup.replicas.engines)
+    yield counter
+    counter.remove()
+
+
+@pytest.mark.parametrize('url', sorted(QUERY_BUDGET))
+def test_query_budget(client, counter, url):
+    counter.count = 0
+    response = client.get(url)
+    response.get_data()
+    assert response.status_code == 200
+    assert 0 < counter.count <= QUERY_BUDGET[url]
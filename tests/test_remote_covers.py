@@ -0,0 +1,129 @@
+"""Downloads of external covers against a local stub server.
+
+The stub listens on 127.0.0.1, which `remote_covers.check_url()` rejects
+like every other non-public address. The tests that download from it allow
+exactly that address.
+"""
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from moviecollection import remote_covers
+from moviecollection.database_setup import RemoteCover
+from moviecollection.remote_covers import ForbiddenAddress
+
+IMAGE = b'GIF89a-cover'
+ETAG = '"cover-1"'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Serves IMAGE on /cover.gif and redirects /redirect?to=<url>. """
+
+    # Requests received, by all handlers.
+    received = 0
+
+    def do_GET(self):
+        StubHandler.received += 1
+        if self.path.startswith('/redirect?to='):
+            self.send_response(302)
+            self.send_header('Location', self.path.split('=', 1)[1])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/gif')
+            self.send_header('Content-Length', str(len(IMAGE)))
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            self.wfile.write(IMAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def stub_url():
+    server = HTTPServer(('127.0.0.1', 0), StubHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def allow_stub(monkeypatch):
+    """ Lets the downloads reach the stub, and nothing else local. """
+    is_public = remote_covers.is_public
+    monkeypatch.setattr(remote_covers, 'is_public', lambda address:
+                        address == '127.0.0.1' or is_public(address))
+
+
+def test_download(stub_url, allow_stub):
+    cover = RemoteCover(url=stub_url + '/cover.gif')
+    response = remote_covers.download(cover)
+    assert response.status_code == 200
+    assert response.content == IMAGE
+    assert response.headers['ETag'] == ETAG
+
+
+def test_download_not_modified(stub_url, allow_stub):
+    cover = RemoteCover(url=stub_url + '/cover.gif', blob='stored.gif',
+                        etag=ETAG)
+    assert remote_covers.download(cover) is None
+
+
+def test_download_follows_redirects(stub_url, allow_stub):
+    cover = RemoteCover(url=stub_url + '/redirect?to=/cover.gif')
+    assert remote_covers.download(cover).content == IMAGE
+
+
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1/cover.gif',
+    'http://localhost/cover.gif',
+    'http://[::1]/cover.gif',
+    'http://10.0.0.1/cover.gif',
+    'http://172.16.0.1/cover.gif',
+    'http://192.168.1.1/cover.gif',
+    'http://169.254.169.254/latest/meta-data/',
+    'http://0.0.0.0/cover.gif',
+    'http://[::ffff:127.0.0.1]/cover.gif',
+    'file:///etc/passwd',
+])
+def test_download_rejects_non_public_addresses(url):
+    with pytest.raises(ForbiddenAddress):
+        remote_covers.download(RemoteCover(url=url))
+
+
+def test_download_rejects_redirect_to_private_address(stub_url, allow_stub):
+    cover = RemoteCover(
+        url=stub_url + '/redirect?to=http://169.254.169.254/latest/')
+    with pytest.raises(ForbiddenAddress):
+        remote_covers.download(cover)
+
+
+def test_download_rejects_rebound_address(stub_url, monkeypatch):
+    # The name resolved to a public address when it was checked, and to the
+    # stub on 127.0.0.1 when the connection was made.
+    monkeypatch.setattr(remote_covers, 'check_url', lambda url: None)
+    received = StubHandler.received
+    with pytest.raises(ForbiddenAddress):
+        remote_covers.download(RemoteCover(url=stub_url + '/cover.gif'))
+    assert StubHandler.received == received
+
+
+def test_public_addresses():
+    assert remote_covers.is_public('93.184.216.34')
+    assert remote_covers.is_public('2606:2800:220:1:248:1893:25c8:1946')
+    assert not remote_covers.is_public('fe80::1%eth0')
+    assert not remote_covers.is_public('fd00::1')
@@ -0,0 +1,48 @@
+"""Config checks of the production server."""
+import os
+
+import pytest
+
+from moviecollection import app
+from moviecollection import server
+
+
+@pytest.fixture
+def config(monkeypatch, tmp_path):
+    """ Config without settings file and without a cache backend set. """
+    monkeypatch.delenv(server.SETTINGS_VARIABLE, raising=False)
+    monkeypatch.delenv('SECRET_KEY', raising=False)
+    monkeypatch.setitem(app.config, 'SECRET_KEY', 'tests')
+    monkeypatch.delitem(app.config, 'CACHE_BACKEND', raising=False)
+    monkeypatch.setitem(app.config, 'CACHE_DIR', str(tmp_path / 'cache'))
+    return app.config
+
+
+def test_single_worker_keeps_default_cache(config):
+    server.configure(workers=1)
+    assert 'CACHE_BACKEND' not in config
+
+
+def test_several_workers_share_the_cache(config):
+    server.configure(workers=4)
+    assert config['CACHE_BACKEND'] == 'disk'
+
+
+@pytest.mark.parametrize('backend', ['disk', None])
+def test_several_workers_keep_shared_backend(config, backend):
+    config['CACHE_BACKEND'] = backend
+    server.configure(workers=4)
+    assert config['CACHE_BACKEND'] == backend
+
+
+def test_several_workers_refuse_memory_cache(config):
+    config['CACHE_BACKEND'] = 'memory'
+    with pytest.raises(RuntimeError):
+        server.configure(workers=4)
+
+
+def test_cache_directory_must_be_private(config):
+    os.makedirs(config['CACHE_DIR'])
+    os.chmod(config['CACHE_DIR'], 0o777)
+    with pytest.raises(RuntimeError):
+        server.configure(workers=4)